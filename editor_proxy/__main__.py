@@ -1,12 +1,37 @@
-"""TODO(asanka): DO NOT SUBMIT without one-line documentation for __main__.
+"""Runs ycmd behind a ChunkedPipe on stdin and stdout.
 
-TODO(asanka): DO NOT SUBMIT without a detailed description of __main__.
+The pipe is opened before ycmd is loaded, so that the editor can start sending
+requests right away. Loading ycmd happens on a background thread. Requests that
+arrive in the meantime are held until it's done, except for /healthy and
+/ready, which are answered with a 503 right away.
+
+The proxy reports its state on the out-of-band stream 0 with objects such as
+'{"state":"starting"}'. Once ycmd is loaded it sends '{"state":"ready"}'
+along with how long each phase of startup took, or '{"state":"failed"}' along
+with an error message.
+
+With --zygote, the proxy loads ycmd once and then serves sessions handed to it
+by proxies started with --via_zygote. See zygote.py.
+
+With --daemon, the proxy hands its stdin and stdout to a daemon that keeps
+ycmd running after the session ends, so that the next one can resume where it
+left off. See daemon.py.
+
+With --shards N, the proxy spreads requests over N proxies of its own, each
+running ycmd in a separate process. See shard.py.
+
+With --listen or --listen_tcp, other clients can share the proxy by connecting
+to it on a socket. See listener.py.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+
+START_TIME = time.time()
+
 import os
 import sys
 import argparse
@@ -19,20 +44,49 @@ sys.path.insert(
     os.path.normpath(
         os.path.join(DIR_OF_CURRENT_SCRIPT, '..', 'third_party', 'ycmd')))
 
-from ycmd.server_utils import SetUpPythonPath
-SetUpPythonPath()
-
 import logging
 import atexit
 import signal
 import json
+import socket
+import tempfile
+from threading import Thread
 
-from ycmd import extra_conf_store, user_options_store, utils
-from ycmd.utils import ToBytes, ReadFile, OpenForStdHandle
-from ycmd.server_utils import CompatibleWithCurrentCore
 from .pipe_server import PipeServer
-from .chunked import ChunkedPipe, ChunkedFileStream
-from bottle import debug
+from .worker_pool import DEFAULT_WORKERS
+from .response_cache import (DEFAULT_ALLOWLIST, DEFAULT_MAX_ENTRIES,
+                             ResponseCache)
+from .chunked import ChunkedPipe, ChunkedFileStream, FlushPolicy
+from .daemon import DEFAULT_IDLE_SECONDS, Attach, Daemon, Daemonize, NewToken
+from .listener import Listener
+from .metrics import DEFAULT_DUMP_INTERVAL, MetricsDumper
+from .select_pipe import SelectPipe
+from .shard import FiletypeKey, ProjectRoots, Shard, ShardedApp, ShardRouter
+from .zygote import DEFAULT_CHILDREN, Launch, Zygote
+
+
+class StartupTimer:
+  """Measures how long each phase of startup takes."""
+
+  def __init__(self, start):
+    self.start = start
+    self.last = start
+    self.phases = []
+
+  def Lap(self, name):
+    """Ends the phase |name|, which started when the previous one ended."""
+    now = time.time()
+    self.phases.append((name, now - self.last))
+    self.last = now
+
+  def Breakdown(self):
+    breakdown = dict(self.phases)
+    breakdown['total'] = self.last - self.start
+    return breakdown
+
+  def Log(self):
+    logging.info('Startup took %.3fs: %s', self.last - self.start, ', '.join(
+        '{} {:.3f}s'.format(name, seconds) for (name, seconds) in self.phases))
 
 
 def SetupLogging(log_level):
@@ -43,12 +97,12 @@ def SetupLogging(log_level):
   # Has to be called before any call to logging.getLogger()
   logging.basicConfig(
       format='%(asctime)s - %(levelname)s - %(message)s', level=numeric_level)
+  # basicConfig() does nothing in a session forked by a zygote, which has
+  # configured logging already.
+  logging.getLogger().setLevel(numeric_level)
 
-  if log_level == 'debug':
-    debug(True)
 
-
-def ParseArguments():
+def ParseArguments(argv=None):
   parser = argparse.ArgumentParser()
   parser.add_argument(
       '--log',
@@ -66,7 +120,118 @@ def ParseArguments():
       default=600,
       help='interval in seconds to check server '
       'inactivity and keep subservers alive')
-  return parser.parse_args()
+  parser.add_argument(
+      '--flush_bytes',
+      type=int,
+      default=64 * 1024,
+      help='while busy, coalesce output frames until this many bytes are '
+      'pending. 0 flushes after every batch')
+  parser.add_argument(
+      '--flush_delay_ms',
+      type=float,
+      default=5,
+      help='while busy, never hold coalesced output for longer than this')
+  parser.add_argument(
+      '--engine',
+      type=str,
+      default='threaded',
+      choices=['threaded', 'select'],
+      help='threaded uses one thread for each direction of the pipe. select '
+      'multiplexes both on a single thread')
+  parser.add_argument(
+      '--workers',
+      type=int,
+      default=DEFAULT_WORKERS,
+      help='number of threads handling requests. With --shards, each shard '
+      'gets this many threads waiting for its responses as well')
+  parser.add_argument(
+      '--response_cache_entries',
+      type=int,
+      default=DEFAULT_MAX_ENTRIES,
+      help='number of responses to idempotent requests to keep around. 0 '
+      'disables the response cache')
+  parser.add_argument(
+      '--metrics_file',
+      type=str,
+      default=None,
+      help='file to periodically write metrics to, in JSON format')
+  parser.add_argument(
+      '--metrics_interval_seconds',
+      type=float,
+      default=DEFAULT_DUMP_INTERVAL,
+      help='interval in seconds between writes to --metrics_file')
+  parser.add_argument(
+      '--zygote',
+      type=str,
+      default=None,
+      metavar='SOCKET',
+      help='load ycmd once and fork a proxy for each session handed over on '
+      'the Unix socket SOCKET')
+  parser.add_argument(
+      '--zygote_children',
+      type=int,
+      default=DEFAULT_CHILDREN,
+      help='number of forks of the zygote to keep waiting for sessions')
+  parser.add_argument(
+      '--via_zygote',
+      type=str,
+      default=None,
+      metavar='SOCKET',
+      help='hand this session to the zygote listening on SOCKET. Starts '
+      'normally if there is none')
+  parser.add_argument(
+      '--daemon',
+      type=str,
+      default=None,
+      metavar='SOCKET',
+      help='hand this session to the daemon listening on the Unix socket '
+      'SOCKET, which keeps ycmd running once the session is over. Starts one '
+      'if there is none')
+  parser.add_argument(
+      '--session',
+      type=str,
+      default=None,
+      help='token of the session to resume with --daemon, as reported by the '
+      'daemon when the session started')
+  parser.add_argument(
+      '--daemon_idle_seconds',
+      type=float,
+      default=DEFAULT_IDLE_SECONDS,
+      help='time after which a daemon without sessions exits. 0 keeps it '
+      'around forever')
+  parser.add_argument(
+      '--daemon_log',
+      type=str,
+      default=None,
+      help='file a daemon started with --daemon logs to')
+  parser.add_argument(
+      '--shards',
+      type=int,
+      default=0,
+      help='number of ycmd processes to spread requests over. 0 runs ycmd in '
+      'this process')
+  parser.add_argument(
+      '--shard_by',
+      type=str,
+      default='filetype',
+      choices=['filetype', 'project'],
+      help='what decides which shard serves a request. Requests without a '
+      'filetype or outside of any project go to the first shard')
+  parser.add_argument(
+      '--listen',
+      type=str,
+      default=None,
+      metavar='SOCKET',
+      help='also serve clients connecting on the Unix socket SOCKET')
+  parser.add_argument(
+      '--listen_tcp',
+      type=int,
+      default=None,
+      metavar='PORT',
+      help='also serve clients connecting on PORT of the loopback interface. '
+      '0 picks a free port. The port and the token clients have to send are '
+      'reported on stream 0')
+  return parser.parse_args(argv)
 
 
 def SetUpSignalHandler():
@@ -79,6 +244,9 @@ def SetUpSignalHandler():
 
 
 def SetupOptions(options_file):
+  from ycmd import user_options_store, utils
+  from ycmd.utils import ReadFile
+
   options = user_options_store.DefaultOptions()
   if options_file is not None:
     user_options = json.loads(ReadFile(options_file))
@@ -93,9 +261,19 @@ def YcmCoreSanityCheck():
     raise RuntimeError('ycm_core already imported, ycmd has a bug!')
 
 
-def OpenStdPipe():
+def FlushPolicyFromArgs(args):
+  return FlushPolicy(
+      max_bytes=args.flush_bytes, max_delay=args.flush_delay_ms / 1000.0)
+
+
+def OpenPipe(input_file, output_file, flush_policy=None, engine='threaded'):
+  pipe_class = SelectPipe if engine == 'select' else ChunkedPipe
+  return pipe_class(input_file, output_file, flush_policy)
+
+
+def OpenStdPipe(flush_policy=None, engine='threaded'):
   global _pipe
-  _pipe = ChunkedPipe(sys.stdin, sys.stdout)
+  _pipe = OpenPipe(sys.stdin, sys.stdout, flush_policy, engine)
   stdiofile = ChunkedFileStream(_pipe.CreateStream(0, out_of_band=True))
   stderrfile = ChunkedFileStream(
       _pipe.CreateStream(
@@ -108,32 +286,356 @@ def OpenStdPipe():
   return _pipe
 
 
-def Main():
-  args = ParseArguments()
+def ReportState(state, **fields):
+  """Tells the client about the state of the proxy on the stdio stream."""
+  sys.stdout.stream.Write(dict(fields, state=state))
 
-  SetupLogging(args.log)
+
+class StartupError(Exception):
+
+  def __init__(self, message, exit_code):
+    super(StartupError, self).__init__(message)
+    self.exit_code = exit_code
+
+
+def PreloadYcmd(args, timer):
+  """Does the part of loading ycmd that doesn't involve a server. Returns the
+  user options."""
+  from ycmd.server_utils import SetUpPythonPath
+  SetUpPythonPath()
+  timer.Lap('python_path')
+
+  from ycmd import extra_conf_store
+  from ycmd.server_utils import CompatibleWithCurrentCore
   options = SetupOptions(args.options_file)
+  timer.Lap('options')
 
   YcmCoreSanityCheck()
   extra_conf_store.CallGlobalExtraConfYcmCorePreloadIfExists()
+  timer.Lap('extra_conf_preload')
 
   code = CompatibleWithCurrentCore()
   if code:
-    sys.exit(code)
+    raise StartupError('ycm_core is incompatible with this ycmd', code)
+  timer.Lap('core_check')
 
-  # These can't be top-level imports because they transitively import
+  # These can't be imported any earlier because they transitively import
   # ycm_core which we want to be imported ONLY after extra conf
   # preload has executed.
   from ycmd import handlers
+  timer.Lap('handlers_import')
+  return options
+
+
+def LoadApp(args, server, timer, preloaded=False):
+  """Loads ycmd and returns its WSGI app.
+
+  If |preloaded|, PreloadYcmd() was called before already, and only the user
+  options are read again."""
+  if preloaded:
+    options = SetupOptions(args.options_file)
+    timer.Lap('options')
+  else:
+    options = PreloadYcmd(args, timer)
+
+  from bottle import debug
+  from ycmd import handlers
+  if args.log == 'debug':
+    debug(True)
   handlers.UpdateUserOptions(options)
   handlers.KeepSubserversAlive(args.check_interval_seconds)
+  atexit.register(handlers.ServerCleanup)
+  handlers.wsgi_server = server
+  timer.Lap('handlers')
+  return handlers.app
+
+
+def StartApp(args,
+             server,
+             timer,
+             result,
+             preloaded=False,
+             report=ReportState):
+  """Loads ycmd and hands it to |server|. Sets result['exit_code'] if that
+  failed. The outcome is passed on to |report|."""
+  try:
+    app = LoadApp(args, server, timer, preloaded)
+  except Exception as e:
+    logging.exception('ycmd failed to start')
+    result['exit_code'] = getattr(e, 'exit_code', 1)
+    server.FailStartup(str(e))
+    report('failed', message=str(e))
+    return
+
+  server.SetApp(app)
+  timer.Log()
+  report('ready', startup=timer.Breakdown())
+
+
+def RunSession(args, timer, preloaded=False):
+  """Serves requests on stdin and stdout until the client goes away. Returns
+  the exit code of ycmd if it failed to start, None otherwise."""
+  pipe = OpenStdPipe(FlushPolicyFromArgs(args), engine=args.engine)
+  server = NewServer(args, pipe)
+  listener = StartListener(args, server)
+  ReportState('starting', **(listener.Details() if listener else {}))
+  timer.Lap('pipe')
+
+  result = {}
+  startup = Thread(
+      target=StartApp, args=(args, server, timer, result, preloaded))
+  startup.daemon = True
+  startup.start()
+
+  server.Serve(pipe)
+  if listener is not None:
+    # The app stays around for clients that are still connected.
+    listener.Close()
+  server.Shutdown()
+  return result.get('exit_code')
+
+
+def StartListener(args, server):
+  """Starts serving clients on args.listen and args.listen_tcp with |server|.
+  Returns the Listener, or None if there's nothing to listen on."""
+  if args.listen is None and args.listen_tcp is None:
+    return None
+
+  def OpenClientPipe(input_file, output_file):
+    return OpenPipe(input_file, output_file, FlushPolicyFromArgs(args),
+                    args.engine)
+
+  listener = Listener(server, OpenClientPipe, NewToken())
+  if args.listen is not None:
+    try:
+      listener.ListenUnix(args.listen)
+    except (RuntimeError, socket.error) as e:
+      logging.warning("Can't listen on %s: %s", args.listen, e)
+  if args.listen_tcp is not None:
+    try:
+      listener.ListenTcp(args.listen_tcp)
+    except socket.error as e:
+      logging.warning("Can't listen on port %d: %s", args.listen_tcp, e)
+  if not listener.IsListening():
+    return None
+
+  listener.Start()
+  server.metrics.Track('listener', listener.Stats)
+  return listener
+
+
+def NewServer(args, pipe):
+  cache = ResponseCache(
+      allowlist=DEFAULT_ALLOWLIST if args.response_cache_entries else {},
+      max_entries=args.response_cache_entries)
+  server = PipeServer(None, pipe, workers=args.workers, cache=cache)
+
+  if args.metrics_file:
+    dumper = MetricsDumper(args.metrics_file, server.Stats,
+                           args.metrics_interval_seconds)
+    dumper.start()
+    atexit.register(dumper.Stop)
+  return server
+
+
+def ShardCommand(args, options):
+  """Returns a function that returns the command line of a shard.
+
+  A shard deletes its options file once it has read it, so each one gets a
+  copy of the user options |options|."""
+
+  def Command():
+    command = [
+        sys.executable, '-m', __package__, '--log', args.log, '--engine',
+        args.engine, '--workers', str(args.workers), '--check_interval_seconds',
+        str(args.check_interval_seconds), '--response_cache_entries', '0'
+    ]
+    if options is not None:
+      command += ['--options_file', WriteOptionsFile(options, 'shard')]
+    return command
+
+  return Command
+
+
+def WriteOptionsFile(contents, owner):
+  """Writes |contents| to a new options file for |owner| and returns its
+  path."""
+  (fd, path) = tempfile.mkstemp(prefix='ycmd_{}_options_'.format(owner))
+  with os.fdopen(fd, 'w') as options_file:
+    options_file.write(contents)
+  return path
+
+
+def ShardEnvironment():
+  """Returns the environment of a shard, which has to be able to import this
+  package."""
+  paths = [os.path.dirname(DIR_OF_CURRENT_SCRIPT)]
+  if os.environ.get('PYTHONPATH'):
+    paths.append(os.environ['PYTHONPATH'])
+  return dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+
+
+def RunSharded(args, timer):
+  """Serves requests on stdin and stdout with args.shards proxies running
+  ycmd, until the client goes away."""
+  pipe = OpenStdPipe(FlushPolicyFromArgs(args), engine=args.engine)
+  server = NewServer(args, pipe)
+  ReportState('starting')
+  timer.Lap('pipe')
+
+  options = None
+  if args.options_file is not None:
+    with open(args.options_file) as options_file:
+      options = options_file.read()
+    os.remove(args.options_file)
+
+  control = sys.stdout.stream
+  errors = sys.stderr.stream
+
+  def Forward(shard, stream, obj):
+    """Passes what shards write on their out-of-band streams on to the
+    client."""
+    if stream == 0:
+      control.Write(dict(obj, shard=shard))
+    else:
+      errors.Write(obj)
+
+  command = ShardCommand(args, options)
+  shards = [
+      Shard(index, command, ShardEnvironment(), Forward)
+      for index in range(args.shards)
+  ]
+  for shard in shards:
+    shard.Start()
+  key = FiletypeKey if args.shard_by == 'filetype' else ProjectRoots()
+  app = ShardedApp(shards, ShardRouter(args.shards, key), args.workers)
+  server.metrics.Track('shards', app.Stats)
+
+  # Each shard holds requests until its own ycmd is ready.
+  server.SetApp(app)
+  timer.Log()
+  ReportState('ready', startup=timer.Breakdown(), shards=args.shards)
+  try:
+    server.Run()
+  finally:
+    for shard in shards:
+      shard.Stop()
+    app.Shutdown()
+
+
+def ReadSessionOptions(options_file):
+  """Returns the user options in |options_file|, or None if there's none, and
+  removes the file.
+
+  The HMAC secret is left out. Requests on the pipe aren't signed, and a
+  daemon outlives the session that made it up."""
+  if options_file is None:
+    return None
+  with open(options_file) as contents:
+    options = json.load(contents)
+  os.remove(options_file)
+  options.pop('hmac_secret', None)
+  return options
+
+
+def UpdateOptions(options):
+  """Makes the loaded ycmd use the user |options|."""
+  from ycmd import handlers, user_options_store
+
+  full = user_options_store.DefaultOptions()
+  full.update(options)
+  handlers.UpdateUserOptions(full)
+
+
+def RunDaemon(args, options):
+  """Serves sessions attaching on args.daemon until the daemon is done. ycmd
+  is loaded with the user |options| of the session that started it."""
+  timer = StartupTimer(time.time())
+  server = NewServer(args, None)
+
+  def OpenSessionPipe(input_file, output_file):
+    return OpenPipe(input_file, output_file, FlushPolicyFromArgs(args),
+                    args.engine)
+
+  daemon = Daemon(args.daemon, server, OpenSessionPipe,
+                  args.daemon_idle_seconds, options, UpdateOptions)
+  try:
+    daemon.Listen()
+  except RuntimeError as e:
+    # Another proxy started a daemon at the same time.
+    logging.info('Not starting a daemon: %s', e)
+    return 0
+  logging.info('Daemon serving sessions on %s', args.daemon)
+
+  result = {}
+  startup = Thread(
+      target=StartApp,
+      args=(args, daemon, timer, result, False, daemon.ReportState))
+  startup.daemon = True
+  startup.start()
+
+  daemon.Serve()
+  server.Shutdown()
+  return result.get('exit_code')
+
+
+def StartDaemon(args, options):
+  """Starts a daemon for args.daemon in the background."""
+  if Daemonize(args.daemon_log):
+    args.options_file = None
+    if options is not None:
+      args.options_file = WriteOptionsFile(json.dumps(options), 'daemon')
+    sys.exit(RunDaemon(args, options))
+
+
+def RunForkedSession(argv):
+  """Runs a session handed to a zygote, in the fork that took it."""
+  timer = StartupTimer(time.time())
+  args = ParseArguments(argv)
+  SetupLogging(args.log)
   SetUpSignalHandler()
+  return RunSession(args, timer, preloaded=True)
 
-  atexit.register(handlers.ServerCleanup)
 
-  pipe = OpenStdPipe()
-  handlers.wsgi_server = PipeServer(handlers.app, pipe)
-  handlers.wsgi_server.Run()
+def Main():
+  timer = StartupTimer(START_TIME)
+  args = ParseArguments()
+  SetupLogging(args.log)
+  SetUpSignalHandler()
+
+  if args.via_zygote:
+    try:
+      sys.exit(Launch(args.via_zygote, sys.argv[1:]))
+    except socket.error as e:
+      logging.warning("Can't reach a zygote on %s, starting normally: %s",
+                      args.via_zygote, e)
+
+  if args.daemon:
+    options = ReadSessionOptions(args.options_file)
+    sys.exit(
+        Attach(
+            args.daemon,
+            args.session,
+            lambda: StartDaemon(args, options),
+            options=options))
+
+  if args.zygote:
+    try:
+      PreloadYcmd(args, timer)
+    except StartupError as e:
+      logging.error('Zygote failed to load ycmd: %s', e)
+      sys.exit(e.exit_code)
+    timer.Log()
+    Zygote(args.zygote, RunForkedSession, args.zygote_children).Serve()
+    return
+
+  if args.shards:
+    RunSharded(args, timer)
+    return
+
+  exit_code = RunSession(args, timer)
+  if exit_code is not None:
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,4 @@
+"""Micro benchmarks for editor_proxy. Run them as modules, e.g.
+
+  python -m editor_proxy.benchmarks.scheduling_bench
+"""
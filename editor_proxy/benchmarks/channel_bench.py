@@ -0,0 +1,128 @@
+"""Items per second through a Channel, compared with the original one.
+
+A producer thread hands payload sized items to a consumer thread, either one
+at a time or in batches. Logging is at INFO level as it would be in
+production.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from ..channel import Channel
+
+
+class LegacyChannel:
+  """The Channel implementation this benchmark compares against."""
+
+  def __init__(self, name=None):
+    self.cond = Condition()
+    self.queue = deque()
+    self.done = False
+    self.name = name
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    o = self.Get()
+    if o is None:
+      raise StopIteration
+    logging.debug("%s returning %s", repr(self), repr(o))
+    return o
+
+  def Put(self, o):
+    if o is None:
+      raise ValueError("'None' is not a value datum")
+
+    logging.debug("%s adding %s", repr(self), repr(o))
+    with self.cond:
+      self.queue.append(o)
+      self.cond.notify()
+
+  def Get(self):
+    with self.cond:
+      while len(self.queue) == 0 and not self.done:
+        self.cond.wait()
+
+      if self.done:
+        return None
+
+      o = self.queue.popleft()
+      if o is None:
+        self.done = True
+    return o
+
+  def Close(self):
+    with self.cond:
+      self.queue.append(None)
+      self.cond.notify()
+
+  def __repr__(self):
+    return "Channel({})".format(repr(self.name))
+
+
+def RunSingle(channel, items):
+  """Puts and iterates items one at a time."""
+
+  def Produce():
+    for item in items:
+      channel.Put(item)
+    channel.Close()
+
+  producer = Thread(target=Produce)
+  start = time.time()
+  producer.start()
+  count = sum(1 for _ in channel)
+  producer.join()
+  return count / (time.time() - start)
+
+
+def RunBatched(channel, items, batch_size):
+  """Puts items in batches of |batch_size| and takes them using GetAll()."""
+
+  def Produce():
+    for offset in range(0, len(items), batch_size):
+      channel.PutMany(items[offset:offset + batch_size])
+    channel.Close()
+
+  producer = Thread(target=Produce)
+  start = time.time()
+  producer.start()
+  count = 0
+  while True:
+    batch = channel.GetAll()
+    if not batch:
+      break
+    count += len(batch)
+  producer.join()
+  return count / (time.time() - start)
+
+
+def Main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--items', type=int, default=200000)
+  parser.add_argument('--payload_size', type=int, default=1024)
+  parser.add_argument('--batch_size', type=int, default=64)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  items = [{'d': 'x' * args.payload_size}] * args.items
+
+  results = [
+      ('legacy Put/Get', RunSingle(LegacyChannel(), items)),
+      ('Put/Get', RunSingle(Channel(), items)),
+      ('PutMany/GetAll', RunBatched(Channel(), items, args.batch_size)),
+  ]
+  for (name, rate) in results:
+    print('{:<16} {:>12,.0f} items/s'.format(name, rate))
+
+
+if __name__ == '__main__':
+  Main()
@@ -0,0 +1,116 @@
+"""Input decoding throughput of FrameDecoder.
+
+Decodes the captures in tests/streams, repeated until they add up to the
+requested size, and synthetic traffic with large payloads. The input is fed
+to the decoder in chunks of several sizes, as os.read() would return it. The
+large payloads are also fed in chunks that each end halfway into a header. The
+line by line reader the proxy used before is measured for comparison.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import time
+from StringIO import StringIO
+
+from ..framing import LINE, FrameDecoder, JsonFraming
+
+STREAMS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'streams')
+
+
+def LegacyDecode(data):
+  """Decodes |data| reading one header line and then one payload at a time."""
+  framing = JsonFraming()
+  input_file = StringIO(data)
+  count = 0
+  while True:
+    line = input_file.readline()
+    if line == '':
+      return count
+    if line.strip() == '':
+      continue
+
+    frame, size = framing._ParseHeader(line)
+    if size is LINE:
+      input_file.readline()
+    elif size is not None:
+      input_file.read(size)
+    count += 1
+
+
+def Decode(data, chunk_size, skew=0):
+  """Decodes |data| fed in chunks of |chunk_size| after a first one of |skew|
+  bytes."""
+  framing = JsonFraming()
+  decoder = FrameDecoder()
+  count = 0
+  if skew:
+    decoder.Feed(data[:skew])
+  for offset in range(skew, len(data), chunk_size):
+    decoder.Feed(data[offset:offset + chunk_size])
+    while decoder.Next(framing) is not None:
+      count += 1
+  return count
+
+
+def Captures(size):
+  captures = ''.join(
+      open(path, 'rb').read()
+      for path in sorted(glob.glob(os.path.join(STREAMS_DIR, '*.in'))))
+  return captures * max(1, size // len(captures))
+
+
+def LargeFrame(payload_size):
+  """Returns the header and payload of a frame with |payload_size| bytes."""
+  return JsonFraming().EncodeData(1, 'x' * payload_size)
+
+
+def LargeFrames(size, payload_size):
+  frame = ''.join(LargeFrame(payload_size))
+  return frame * max(1, size // len(frame))
+
+
+def Measure(decode, data):
+  start = time.time()
+  frames = decode(data)
+  elapsed = time.time() - start
+  return (frames / elapsed, len(data) / elapsed / (1024 * 1024))
+
+
+def Main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--size', type=int, default=16 * 1024 * 1024)
+  parser.add_argument('--payload_size', type=int, default=1024 * 1024)
+  args = parser.parse_args()
+
+  inputs = [
+      ('captures', Captures(args.size)),
+      ('large frames', LargeFrames(args.size, args.payload_size)),
+  ]
+  print('{:<14} {:<16} {:>14} {:>10}'.format('input', 'reader', 'frames/s',
+                                             'MB/s'))
+  for (name, data) in inputs:
+    decoders = [('legacy', LegacyDecode)] + [
+        ('decoder {}k'.format(chunk_size // 1024),
+         lambda data, chunk_size=chunk_size: Decode(data, chunk_size))
+        for chunk_size in (4096, 64 * 1024, 1024 * 1024)
+    ]
+    if name == 'large frames':
+      (header, payload) = LargeFrame(args.payload_size)
+      decoders.append(
+          ('decoder split',
+           lambda data: Decode(data, len(header) + len(payload),
+                               len(header) // 2)))
+    for (reader, decode) in decoders:
+      frames, megabytes = Measure(decode, data)
+      print('{:<14} {:<16} {:>14,.0f} {:>10.1f}'.format(name, reader, frames,
+                                                        megabytes))
+
+
+if __name__ == '__main__':
+  Main()
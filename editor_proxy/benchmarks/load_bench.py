@@ -0,0 +1,289 @@
+"""Load test of PipeServer over OS pipes.
+
+A client thread sends a synthetic mix of ycmd requests over a pipe to a
+PipeServer, keeping a fixed number of them in flight. The server runs a stub
+WSGI app that reads each request body, sleeps for the request's service time
+and answers with a JSON body of the configured size. A reader thread decodes
+the server's output and times each request from when its header was written
+until its close frame arrived.
+
+Each entry of --mix reads path:weight:request_bytes:response_bytes:service_ms.
+Results are printed and can be saved as JSON with --output. Passing a saved
+file as --baseline prints how the current run compares to it.
+
+Peak RSS is that of the whole benchmark process, client included.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import time
+from threading import Semaphore, Thread
+
+from ..chunked import ChunkedPipe
+from ..framing import FRAMINGS, FrameDecoder, JsonFraming, Serialize
+from ..pipe_server import PipeServer
+from ..select_pipe import SelectPipe
+from ..worker_pool import DEFAULT_WORKERS
+
+DEFAULT_MIX = ('/completions:8:20000:4000:5,'
+               '/event_notification:3:20000:200:20,'
+               '/detailed_diagnostic:1:20000:2000:10,'
+               '/healthy:1:0:10:0')
+
+ENGINES = {'threaded': ChunkedPipe, 'select': SelectPipe}
+
+READ_SIZE = 64 * 1024
+
+
+class RequestKind:
+
+  def __init__(self, path, weight, request_bytes, response_bytes, service_ms):
+    self.path = path
+    self.weight = weight
+    self.request_bytes = request_bytes
+    self.response_bytes = response_bytes
+    self.service_ms = service_ms
+
+
+def ParseMix(spec):
+  kinds = []
+  for entry in spec.split(','):
+    path, weight, request_bytes, response_bytes, service_ms = entry.split(':')
+    kinds.append(
+        RequestKind(path, int(weight), int(request_bytes), int(response_bytes),
+                    float(service_ms)))
+  return kinds
+
+
+def StubApp(kinds):
+  """Returns a WSGI app answering requests as described by |kinds|."""
+  by_path = dict((kind.path, kind) for kind in kinds)
+
+  def App(environ, start_response):
+    environ['wsgi.input'].read()
+    kind = by_path[environ['PATH_INFO']]
+    if kind.service_ms:
+      time.sleep(kind.service_ms / 1000)
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [Serialize({'data': 'x' * kind.response_bytes})]
+
+  return App
+
+
+def RequestHeader(kind, serial):
+  """Returns the first frame payload of a request. Requests differ in their
+  line number so that none of them supersede each other."""
+  filepath = '/bench/file{}.cc'.format(serial % 16)
+  body = {
+      'filepath': filepath,
+      'line_num': serial + 1,
+      'column_num': 1,
+      'file_data': {
+          filepath: {
+              'contents': 'x' * kind.request_bytes,
+              'filetypes': ['cpp']
+          }
+      }
+  }
+  return Serialize({'p': kind.path, 'm': 'POST', 'o': body})
+
+
+def Percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Client:
+  """Sends requests to the server's input and times their responses."""
+
+  def __init__(self, input_fd, output_fd, kinds, requests, concurrency,
+               framing, features, seed):
+    self.input_fd = input_fd
+    self.output_fd = output_fd
+    self.kinds = kinds
+    self.requests = requests
+    self.in_flight = Semaphore(concurrency)
+    self.framing = framing
+    self.features = features
+    self.rng = random.Random(seed)
+    self.sent = {}
+    self.latencies = {}
+    self.bytes_out = 0
+    self.bytes_in = 0
+
+  def _Write(self, data):
+    self.bytes_out += len(data)
+    while data:
+      data = data[os.write(self.input_fd, data):]
+
+  def _PickKind(self):
+    point = self.rng.uniform(0, sum(kind.weight for kind in self.kinds))
+    for kind in self.kinds:
+      point -= kind.weight
+      if point <= 0:
+        return kind
+    return self.kinds[-1]
+
+  def Send(self):
+    framing = JsonFraming()
+    if self.framing != framing.name or self.features:
+      self._Write(''.join(
+          framing.EncodeHandshake({
+              'framing': [self.framing],
+              'features': self.features
+          })))
+      framing = FRAMINGS[self.framing]()
+
+    for serial in range(self.requests):
+      kind = self._PickKind()
+      payload = RequestHeader(kind, serial)
+      self.in_flight.acquire()
+      self.sent[serial] = (kind.path, time.time())
+      self._Write(''.join(framing.EncodeData(serial, payload)))
+
+  def Receive(self):
+    decoder = FrameDecoder()
+    framing = JsonFraming()
+    while len(self.latencies) < self.requests:
+      data = os.read(self.output_fd, READ_SIZE)
+      if not data:
+        raise IOError('Server output ended early')
+      self.bytes_in += len(data)
+      decoder.Feed(data)
+      while True:
+        frame = decoder.Next(framing)
+        if frame is None:
+          break
+        if frame.handshake is not None:
+          framing = FRAMINGS[frame.handshake['framing']]()
+        elif frame.IsClose() and frame.index not in self.latencies:
+          path, sent = self.sent[frame.index]
+          self.latencies[frame.index] = (path, time.time() - sent)
+          self.in_flight.release()
+
+
+def Run(kinds, requests, concurrency, engine, workers, framing, features,
+        seed):
+  server_in_r, server_in_w = os.pipe()
+  server_out_r, server_out_w = os.pipe()
+  pipe = ENGINES[engine](
+      os.fdopen(server_in_r, 'rb', 0), os.fdopen(server_out_w, 'wb', 0))
+  server = PipeServer(StubApp(kinds), pipe, workers=workers)
+  server_thread = Thread(target=server.Run)
+  server_thread.start()
+
+  client = Client(server_in_w, server_out_r, kinds, requests, concurrency,
+                  framing, features, seed)
+  receiver = Thread(target=client.Receive)
+  start = time.time()
+  receiver.start()
+  client.Send()
+  receiver.join()
+  elapsed = time.time() - start
+
+  os.close(server_in_w)
+  server_thread.join()
+  os.close(server_out_r)
+
+  latencies = [latency * 1000 for (_, latency) in client.latencies.values()]
+  by_path = {}
+  for (path, latency) in client.latencies.values():
+    by_path.setdefault(path, []).append(latency * 1000)
+
+  def Summary(values):
+    return {
+        'count': len(values),
+        'p50': Percentile(values, 0.5),
+        'p99': Percentile(values, 0.99),
+        'p999': Percentile(values, 0.999),
+        'max': max(values)
+    }
+
+  return {
+      'requests': requests,
+      'seconds': elapsed,
+      'requests_per_second': requests / elapsed,
+      'mb_per_second_sent': client.bytes_out / elapsed / (1024 * 1024),
+      'mb_per_second_received': client.bytes_in / elapsed / (1024 * 1024),
+      'latency_ms': Summary(latencies),
+      'latency_ms_by_path': dict(
+          (path, Summary(values)) for (path, values) in by_path.items()),
+      'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+
+
+def Print(result, baseline=None):
+  rows = [
+      ('requests/s', result['requests_per_second'], 'requests_per_second'),
+      ('MB/s sent', result['mb_per_second_sent'], 'mb_per_second_sent'),
+      ('MB/s received', result['mb_per_second_received'],
+       'mb_per_second_received'),
+      ('p50 ms', result['latency_ms']['p50'], 'p50'),
+      ('p99 ms', result['latency_ms']['p99'], 'p99'),
+      ('p999 ms', result['latency_ms']['p999'], 'p999'),
+      ('peak RSS kB', result['peak_rss_kb'], 'peak_rss_kb'),
+  ]
+  for (name, value, key) in rows:
+    line = '{:<16} {:>12.2f}'.format(name, value)
+    if baseline is not None:
+      old = baseline.get(key, baseline['latency_ms'].get(key))
+      if old:
+        line += ' {:>+9.1f}%'.format((value - old) / old * 100)
+    print(line)
+
+  print()
+  print('{:<24} {:>8} {:>10} {:>10} {:>10}'.format('path', 'count', 'p50 ms',
+                                                   'p99 ms', 'max ms'))
+  for (path, summary) in sorted(result['latency_ms_by_path'].items()):
+    print('{:<24} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+        path, summary['count'], summary['p50'], summary['p99'],
+        summary['max']))
+
+
+def Main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--mix', default=DEFAULT_MIX)
+  parser.add_argument('--requests', type=int, default=2000)
+  parser.add_argument('--concurrency', type=int, default=16)
+  parser.add_argument('--engine', choices=sorted(ENGINES), default='threaded')
+  parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+  parser.add_argument('--framing', choices=sorted(FRAMINGS), default='json')
+  parser.add_argument(
+      '--features',
+      default='',
+      help='comma separated features to negotiate, e.g. raw,frag,zlib')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', help='file to save the results to')
+  parser.add_argument('--baseline', help='results to compare against')
+  args = parser.parse_args()
+
+  config = dict(vars(args))
+  del config['output']
+  del config['baseline']
+  features = [f for f in args.features.split(',') if f]
+
+  result = Run(
+      ParseMix(args.mix), args.requests, args.concurrency, args.engine,
+      args.workers, args.framing, features, args.seed)
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['result']
+  Print(result, baseline)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'config': config, 'result': result}, f, indent=1,
+                sort_keys=True)
+
+
+if __name__ == '__main__':
+  Main()
@@ -0,0 +1,117 @@
+"""Tail latency of small responses queued behind large ones.
+
+Each round queues a large background response on one stream and then a small
+interactive response on another, all going out through an OutputDispatchThread
+whose output file only drains at a fixed rate. The latency of a small response
+is the time from Write() until its frame has made it out of the output file.
+This is measured with and without the 'frag' feature.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+from ..chunked import EncodedPayload, OutputDispatchThread
+from ..framing import FrameDecoder, JsonFraming
+from ..worker_pool import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+
+class SlowSink:
+  """Output file that takes |bandwidth| bytes per second to drain."""
+
+  def __init__(self, bandwidth):
+    self.bandwidth = bandwidth
+    self.framing = JsonFraming()
+    self.decoder = FrameDecoder()
+    self.arrivals = {}
+
+  def write(self, data):
+    time.sleep(len(data) / self.bandwidth)
+    now = time.time()
+    self.decoder.Feed(data)
+    while True:
+      frame = self.decoder.Next(self.framing)
+      if frame is None:
+        return
+      if frame.payload is not None and not frame.IsFragment():
+        self.arrivals.setdefault(frame.index, []).append(now)
+
+  def flush(self):
+    pass
+
+
+class Stream:
+
+  def __init__(self, index):
+    self.index = index
+
+
+def Percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def Run(fragment, rounds, large_size, small_size, bandwidth):
+  sink = SlowSink(bandwidth)
+  thread = OutputDispatchThread(sink)
+  thread.fragment_frames = fragment
+  thread.start()
+
+  background = Stream(1)
+  interactive = Stream(2)
+  thread.Attach(background)
+  thread.Attach(interactive)
+  thread.SetPriority(background, PRIORITY_BACKGROUND)
+  thread.SetPriority(interactive, PRIORITY_INTERACTIVE)
+
+  large = EncodedPayload('x' * large_size)
+  small = EncodedPayload('y' * small_size)
+  sent = []
+  for _ in range(rounds):
+    thread.Write(background, large)
+    # Give the large response a head start so that it is on its way out.
+    time.sleep(0.001)
+    sent.append(time.time())
+    thread.Write(interactive, small)
+    # Let the output drain before the next round.
+    time.sleep(2 * large_size / bandwidth)
+
+  thread.Quit()
+  thread.join()
+
+  latencies = [(arrived - queued) * 1000
+               for (queued, arrived) in zip(sent, sink.arrivals[2])]
+  return {
+      'p50': Percentile(latencies, 0.5),
+      'p99': Percentile(latencies, 0.99),
+      'max': max(latencies),
+  }
+
+
+def Main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--rounds', type=int, default=50)
+  parser.add_argument('--large_size', type=int, default=1024 * 1024)
+  parser.add_argument('--small_size', type=int, default=256)
+  parser.add_argument(
+      '--bandwidth',
+      type=float,
+      default=64 * 1024 * 1024,
+      help='Rate at which the output drains, in bytes per second.')
+  args = parser.parse_args()
+
+  print('{:<10} {:>10} {:>10} {:>10}'.format('frag', 'p50 ms', 'p99 ms',
+                                             'max ms'))
+  for fragment in (False, True):
+    result = Run(fragment, args.rounds, args.large_size, args.small_size,
+                 args.bandwidth)
+    print('{:<10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+        'on' if fragment else 'off', result['p50'], result['p99'],
+        result['max']))
+
+
+if __name__ == '__main__':
+  Main()
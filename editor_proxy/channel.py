@@ -1,25 +1,48 @@
-"""TODO(asanka): DO NOT SUBMIT without one-line documentation for channel.
+"""Thread safe queue used to hand items between the threads of a pipe.
 
-TODO(asanka): DO NOT SUBMIT without a detailed description of channel.
+A Channel is closed by its producer once no more items are coming. Consumers
+still receive everything that was queued before that, and then None. Any
+number of threads may produce into or consume from the same channel.
+
+Tracing every item is expensive, so it only happens if debug logging was
+enabled by the time the channel was created.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from threading import Condition
+from threading import Condition, Lock
 from collections import deque
 
 import logging
+import time
+
+
+class Empty(Exception):
+  """Raised when no item became available in time."""
 
 
 class Channel:
+  """Queue of items handed from one thread to another.
+
+  If |capacity| is set, Put() blocks while that many items are queued.
+  """
 
-  def __init__(self, name=None):
-    self.cond = Condition()
+  def __init__(self, name=None, capacity=None):
+    lock = Lock()
+    self.not_empty = Condition(lock)
+    self.not_full = Condition(lock)
+    self.capacity = capacity
     self.queue = deque()
-    self.done = False
+    self.closed = False
     self.name = name
+    self.trace = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    # Threads blocked in the respective Condition. Used to skip notifications
+    # that nobody is waiting for.
+    self.waiting_getters = 0
+    self.waiting_putters = 0
 
   def __iter__(self):
     return self
@@ -28,35 +51,115 @@ class Channel:
     o = self.Get()
     if o is None:
       raise StopIteration
-    logging.debug("%s returning %s", repr(self), repr(o))
     return o
 
-  def Put(self, o):
+  def Put(self, o, force=False):
+    """Queues |o|. |force| bypasses the capacity limit.
+
+    Items put after the channel was closed are dropped."""
     if o is None:
       raise ValueError("'None' is not a value datum")
+    self.PutMany((o,), force)
+
+  def PutMany(self, items, force=False):
+    """Queues all of |items| in order, blocking as necessary to respect the
+    capacity unless |force| is set. Waiting consumers are notified once per
+    batch rather than once per item."""
+    if self.trace:
+      logging.debug('%r adding %r', self, items)
+
+    offset = 0
+    with self.not_empty:
+      while offset < len(items) and not self.closed:
+        room = len(items) - offset
+        if self.capacity and not force:
+          while len(self.queue) >= self.capacity and not self.closed:
+            self.waiting_putters += 1
+            self.not_full.wait()
+            self.waiting_putters -= 1
+          room = min(room, self.capacity - len(self.queue))
+          if self.closed:
+            break
+
+        self.queue.extend(items[offset:offset + room])
+        offset += room
+        if self.waiting_getters:
+          self.not_empty.notify(room)
+
+  def _Wait(self, timeout):
+    """Waits until there's something to get. Raises Empty on timeout."""
+    deadline = time.time() + timeout if timeout is not None else None
+    while not self.queue and not self.closed:
+      remaining = None
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise Empty()
+      self.waiting_getters += 1
+      self.not_empty.wait(remaining)
+      self.waiting_getters -= 1
+
+  def Get(self, timeout=None):
+    """Returns the next item, or None once the channel is closed and drained.
+
+    Raises Empty if nothing arrived within |timeout| seconds."""
+    with self.not_empty:
+      self._Wait(timeout)
+      o = self._PopLocked()
+    if self.trace:
+      logging.debug('%r returning %r', self, o)
+    return o
 
-    logging.debug("%s adding %s", repr(self), repr(o))
-    with self.cond:
-      self.queue.append(o)
-      self.cond.notify()
+  def TryGet(self):
+    """Like Get(), but raises Empty instead of waiting."""
+    with self.not_empty:
+      if not self.queue and not self.closed:
+        raise Empty()
+      return self._PopLocked()
+
+  def _PopLocked(self):
+    if not self.queue:
+      return None
+    o = self.queue.popleft()
+    self._NotifyNotFull()
+    return o
+
+  def GetAll(self):
+    """Blocks until an item is available and returns every queued item.
+
+    Returns an empty list once the channel is closed and drained."""
+    with self.not_empty:
+      self._Wait(None)
+      return self._TakeAllLocked()
 
-  def Get(self):
-    with self.cond:
-      while len(self.queue) == 0 and not self.done:
-        self.cond.wait()
+  def TryGetAll(self):
+    """Returns every queued item without waiting.
 
-      if self.done:
+    Returns None once the channel is closed and drained."""
+    with self.not_empty:
+      if self.closed and not self.queue:
         return None
+      return self._TakeAllLocked()
 
-      o = self.queue.popleft()
-      if o is None:
-        self.done = True
-    return o
+  def _TakeAllLocked(self):
+    items = list(self.queue)
+    self.queue.clear()
+    self._NotifyNotFull()
+    return items
+
+  def _NotifyNotFull(self):
+    if self.waiting_putters:
+      self.not_full.notify_all()
+
+  def Pending(self):
+    with self.not_empty:
+      return len(self.queue)
 
   def Close(self):
-    with self.cond:
-      self.queue.append(None)
-      self.cond.notify()
+    with self.not_empty:
+      self.closed = True
+      self.not_empty.notify_all()
+      self.not_full.notify_all()
 
   def __repr__(self):
     return "Channel({})".format(repr(self.name))
@@ -7,15 +7,59 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import errno
+import io
 import json
 import logging
+import os
+import time
 
 from .channel import Channel
-from threading import Thread, Lock, Event
+from .framing import (FRAMINGS, FLAG_MORE, FLAG_RAW, Compressor,
+                      Decompressor, FrameDecoder, JsonFraming, Serialize)
+from .worker_pool import (PRIORITY_INTERACTIVE, PRIORITY_PARSE,
+                          PRIORITY_BACKGROUND)
+from threading import Thread, Lock, Event, Condition
 from StringIO import StringIO
+from collections import deque
 
 THREAD_TIMEOUT = 1.0
 
+# Frame encodings the proxy is willing to switch to during the handshake.
+DEFAULT_FRAMINGS = ('json', 'binary')
+
+# Optional protocol features the proxy agrees to during the handshake.
+DEFAULT_FEATURES = ('raw', 'flow', 'frag', 'zlib')
+
+# Number of payload bytes the peer may send on a stream before it has to wait
+# for a window update. Only applies once 'flow' has been negotiated.
+DEFAULT_RECEIVE_WINDOW = 256 * 1024
+
+# Number of frames that can be waiting for the output file before writers
+# block.
+OUTPUT_QUEUE_CAPACITY = 256
+
+# Most bytes of input read in one go.
+READ_SIZE = 64 * 1024
+
+# Index of the first stream opened by this end of the pipe. Streams 0 and 1
+# carry the peer's stdout and stderr.
+FIRST_OUTGOING_INDEX = 2
+
+# Largest payload sent in one frame once 'frag' has been negotiated. Larger
+# payloads are split so that other streams don't have to wait for them.
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024
+
+# Relative share of the output each priority class gets while classes are
+# competing for it. Streams that never had their priority set are in the None
+# class. Classes are served in this order.
+PRIORITY_WEIGHTS = [
+    (PRIORITY_INTERACTIVE, 8),
+    (PRIORITY_PARSE, 4),
+    (None, 4),
+    (PRIORITY_BACKGROUND, 1),
+]
+
 
 class NewStreamError(Exception):
 
@@ -24,44 +68,169 @@ class NewStreamError(Exception):
     self.body = body
 
 
+class RawPayload:
+  """Body chunk that is carried on the pipe without any JSON encoding.
+
+  Equivalent to a {'d': data} object. If the peer hasn't negotiated the 'raw'
+  feature it is sent as exactly that."""
+
+  def __init__(self, data):
+    self.data = data
+
+  def __repr__(self):
+    return 'RawPayload({} bytes)'.format(len(self.data))
+
+
+class JsonPayload:
+  """JSON payload as it was received from the peer.
+
+  The input thread hands these to streams without decoding them. They are
+  decoded by ChunkedStream.Read() on the thread that reads the stream, so that
+  a large payload doesn't hold up input for other streams."""
+
+  def __init__(self, data):
+    self.data = data
+
+  def Decode(self):
+    return json.loads(self.data)
+
+  def __repr__(self):
+    return 'JsonPayload({} bytes)'.format(len(self.data))
+
+
+class EncodedPayload:
+  """Payload that has already been serialized for the wire."""
+
+  def __init__(self, data, flags=0):
+    self.data = data
+    self.flags = flags
+
+  def __repr__(self):
+    return 'EncodedPayload({} bytes)'.format(len(self.data))
+
+
+def EncodePayload(obj, raw_frames):
+  """Serializes |obj| unless it is an EncodedPayload already.
+
+  RawPayload objects are only sent as raw frames if |raw_frames| is set."""
+  if isinstance(obj, EncodedPayload):
+    return obj
+  if isinstance(obj, RawPayload):
+    if raw_frames:
+      return EncodedPayload(_Bytes(obj.data), FLAG_RAW)
+    obj = {'d': obj.data}
+  return EncodedPayload(Serialize(obj))
+
+
+class SendWindow:
+  """Flow control credit for sending on a single stream.
+
+  A writer may go over its credit with a single frame so that frames larger
+  than the window don't stall forever. It then has to wait for the peer to
+  grant enough credit to bring the window above zero again."""
+
+  def __init__(self, credit):
+    self.cond = Condition()
+    self.credit = credit
+    self.closed = False
+
+  def Acquire(self, size):
+    with self.cond:
+      while self.credit <= 0 and not self.closed:
+        self.cond.wait()
+      self.credit -= size
+
+  def Release(self, size):
+    with self.cond:
+      self.credit += size
+      self.cond.notify_all()
+
+  def Close(self):
+    """Unblocks writers for good. Used once the stream or pipe is gone."""
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+
 class ChunkedPipe:
 
-  def __init__(self, input_file, output_file):
+  def __init__(self,
+               input_file,
+               output_file,
+               flush_policy=None,
+               framings=DEFAULT_FRAMINGS,
+               features=DEFAULT_FEATURES,
+               receive_window=DEFAULT_RECEIVE_WINDOW):
     assert hasattr(input_file, 'read')
     assert hasattr(input_file, 'readline')
     assert hasattr(output_file, 'write')
     assert hasattr(output_file, 'flush')
 
     self.active_channels = set()
+    # Set while no streams are active, so that a pipe that never had any can
+    # still be closed.
     self.quit_event = Event()
+    self.quit_event.set()
+    self.framings = framings
+    self.features = features
+    self.negotiated = False
+    self.raw_frames = False
+    self.compression = False
+    self.receive_window = receive_window
+    self.send_window = None
+    self.index_lock = Lock()
+    self.next_index = FIRST_OUTGOING_INDEX
 
     self.stream_channel = Channel(name='ChunkedPipe')
-    self.output_thread = OutputDispatchThread(output_file)
-    self.input_thread = InputDispatchThread(input_file, self)
+    self.input_dispatcher = InputDispatcher(self)
+    self._StartDispatch(input_file, output_file, flush_policy)
+
+  def _StartDispatch(self, input_file, output_file, flush_policy):
+    self.output_thread = OutputDispatchThread(output_file, flush_policy)
+    self.input_thread = InputDispatchThread(input_file, self.input_dispatcher)
 
     self.output_thread.start()
     self.input_thread.start()
 
   def Close(self):
     self.quit_event.wait()
-    self.input_thread.Quit()
     self.output_thread.Quit()
 
   def Join(self):
     self.Close()
-    self.input_thread.join(THREAD_TIMEOUT)
+    if self.input_thread:
+      self.input_thread.join(THREAD_TIMEOUT)
     self.output_thread.join(THREAD_TIMEOUT)
 
   def __iter__(self):
     return self.stream_channel.__iter__()
 
+  def Stats(self):
+    return {
+        'output': self.output_thread.Stats(),
+        'input': self.input_dispatcher.Stats(),
+        'streams': {
+            'active': len(self.active_channels),
+            'unclaimed': self.stream_channel.Pending()
+        }
+    }
+
   def WriteStream(self, stream, obj):
-    self.output_thread.Write(stream, obj)
+    if stream.cancelled:
+      return
+    payload = EncodePayload(obj, self.raw_frames)
+    if stream.first_write is None:
+      stream.first_write = time.time()
+    stream.frames_out += 1
+    stream.bytes_out += len(payload.data)
+    if stream.send_window is not None:
+      stream.send_window.Acquire(len(payload.data))
+    self.output_thread.Write(stream, payload)
 
   def CreateStream(self, index, out_of_band=False):
-    logging.debug('Creating stream with index {}'.format(index))
+    logging.debug('Creating stream with index %s', index)
     stream = ChunkedStream(self, index)
-    self.input_thread.Attach(stream)
+    self.input_dispatcher.Attach(stream)
     self.output_thread.Attach(stream)
 
     if not out_of_band:
@@ -74,15 +243,77 @@ class ChunkedPipe:
 
     return stream
 
+  def OpenStream(self):
+    """Opens a stream to send a request to the peer on.
+
+    This is for pipes to another proxy, with this end as the client. The peer
+    ends the stream by closing it once it has responded. Closing the stream
+    after that only forgets about it."""
+    with self.index_lock:
+      index = self.next_index
+      self.next_index += 1
+    stream = self.CreateStream(index, out_of_band=True)
+    stream.outgoing = True
+    return stream
+
+  def IsOutgoing(self, index):
+    """True if the stream |index| was opened by OpenStream()."""
+    return FIRST_OUTGOING_INDEX <= index < self.next_index
+
+  def CancelStream(self, stream):
+    """Asks the peer to stop working on the outgoing |stream|."""
+    self.output_thread.Cancel(stream)
+
   def CloseStream(self, stream):
-    self.output_thread.Close(stream)
-    self.input_thread.Close(stream)
+    if stream.send_window is not None:
+      stream.send_window.Close()
+    self.output_thread.Close(stream,
+                             notify=not (stream.outgoing and stream.ended))
+    self.input_dispatcher.Close(stream)
 
     if stream.index in self.active_channels:
       self.active_channels.remove(stream.index)
       if len(self.active_channels) == 0:
         self.quit_event.set()
 
+  def _Negotiate(self, request):
+    """Handles a handshake from the peer and returns the input framing."""
+    if self.negotiated:
+      raise IOError('Unexpected handshake: {}'.format(repr(request)))
+    self.negotiated = True
+
+    chosen = JsonFraming.name
+    for name in request.get('framing', []):
+      if name in self.framings and name in FRAMINGS:
+        chosen = name
+        break
+
+    reply = {'framing': chosen}
+    features = []
+    if 'features' in request:
+      features = [f for f in request['features'] if f in self.features]
+      reply['features'] = features
+    if 'flow' in features:
+      reply['window'] = self.receive_window
+
+    logging.debug('Negotiated %r', reply)
+    self.output_thread.SwitchFraming(reply, FRAMINGS[chosen]())
+
+    # Writers read these without holding a lock. Setting them only after the
+    # reply is queued ensures that frames which depend on them follow it.
+    self.raw_frames = 'raw' in features
+    self.compression = 'zlib' in features
+    if 'flow' in features:
+      self.send_window = int(request.get('window', DEFAULT_RECEIVE_WINDOW))
+    return FRAMINGS[chosen]()
+
+  def _Consumed(self, stream, size):
+    """Called as a flow controlled stream's reader consumes |size| bytes."""
+    stream.unacknowledged += size
+    if stream.unacknowledged >= self.receive_window // 2:
+      self.output_thread.UpdateWindow(stream, stream.unacknowledged)
+      stream.unacknowledged = 0
+
   def _InputDrained(self):
     self.stream_channel.Close()
 
@@ -94,111 +325,440 @@ class ChunkedStream:
     self.index = int(index)
     self.channel = Channel(name='ChunkedStream')
 
+    # Flow control only applies to streams that are created after it has been
+    # negotiated.
+    self.send_window = None
+    self.unacknowledged = 0
+    if pipe is not None and pipe.send_window is not None:
+      self.send_window = SendWindow(pipe.send_window)
+
+    self.created = time.time()
+    self.cancelled = False
+    self.on_cancel = None
+
+    # Whether this end opened the stream, and whether the peer has closed it.
+    self.outgoing = False
+    self.ended = False
+
+    # Payload frames and bytes received and sent on this stream, and when the
+    # first frame was sent.
+    self.frames_in = 0
+    self.bytes_in = 0
+    self.frames_out = 0
+    self.bytes_out = 0
+    self.first_write = None
+
   def __iter__(self):
-    return self.channel.__iter__()
+    while True:
+      o = self.Read()
+      if o is None:
+        return
+      yield o
 
   def Close(self):
     self.channel.Close()
     self.pipe.CloseStream(self)
 
   def Read(self):
-    return self.channel.Get()
+    """Returns the next object received on this stream, or None at the end of
+    input.
+
+    Raises ValueError if the object isn't valid JSON. The stream can still be
+    read after that."""
+    item = self.channel.Get()
+    if item is None:
+      return None
+
+    body, size = item
+    if self.send_window is not None:
+      self.pipe._Consumed(self, size)
+    if isinstance(body, JsonPayload):
+      return body.Decode()
+    return body
+
+  def _Deliver(self, body, size):
+    self.frames_in += 1
+    self.bytes_in += size
+    self.channel.Put((body, size))
+
+  def _EndOfInput(self):
+    self.ended = True
+    self.channel.Close()
+
+  def _Cancel(self):
+    self.cancelled = True
+    self._EndOfInput()
+    if self.send_window is not None:
+      self.send_window.Close()
+    if self.on_cancel is not None:
+      self.on_cancel()
+
+  def OnCancel(self, callback):
+    """Calls |callback| once the peer cancels this stream, or right away if it
+    has already. It's called on the thread that reads the pipe's input, so it
+    must not block."""
+    self.on_cancel = callback
+    if self.cancelled:
+      callback()
+
+  def IsCancelled(self):
+    """True once the peer has cancelled this stream.
+
+    Anything written to a cancelled stream is dropped."""
+    return self.cancelled
 
   def Write(self, obj):
     self.pipe.WriteStream(self, obj)
 
+  def Cancel(self):
+    self.pipe.CancelStream(self)
+
+  def SetPriority(self, priority):
+    """Sets the priority class used when scheduling this stream's output."""
+    self.pipe.output_thread.SetPriority(self, priority)
+
   def __repr__(self):
     return 'ChunkedStream(None, {})'.format(self.index)
 
 
+class FlushPolicy:
+  """Decides when OutputDispatchThread pushes coalesced frames to its file.
+
+  Pending frames are always flushed as soon as the output channel runs dry.
+  While more frames are already waiting, the flush is deferred until
+  |max_bytes| have accumulated or |max_delay| seconds have passed since the
+  oldest unflushed frame was encoded. A |max_bytes| of 0 flushes after every
+  batch regardless of load.
+  """
+
+  def __init__(self, max_bytes=64 * 1024, max_delay=0.005):
+    self.max_bytes = max_bytes
+    self.max_delay = max_delay
+
+  def ShouldFlush(self, pending_bytes, pending_since, idle):
+    if idle or pending_bytes >= self.max_bytes:
+      return True
+    return time.time() - pending_since >= self.max_delay
+
+
 class OutputDispatchThread(Thread):
 
   class CreateNewStream:
     pass
 
   class DeleteExistingStream:
+
+    def __init__(self, notify=True):
+      # Whether the peer is sent a close frame.
+      self.notify = notify
+
+  class CancelStream:
     pass
 
-  def __init__(self, output_file):
+  class FramingChange:
+
+    def __init__(self, reply, framing):
+      self.reply = reply
+      self.framing = framing
+
+  class WindowUpdate:
+
+    def __init__(self, credit):
+      self.credit = credit
+
+  class PriorityChange:
+
+    def __init__(self, priority):
+      self.priority = priority
+
+  def __init__(self,
+               output_file,
+               flush_policy=None,
+               max_frame_size=DEFAULT_MAX_FRAME_SIZE):
     super(OutputDispatchThread, self).__init__()
     self.output_file = output_file
-    self.channel = Channel(name='OutputDispatchThread')
+    self.framing = JsonFraming()
+    self.raw_frames = False
+    self.fragment_frames = False
+    self.compressor = None
+    self.max_frame_size = max_frame_size
+    self.flush_policy = flush_policy if flush_policy else FlushPolicy()
+    self.channel = Channel(
+        name='OutputDispatchThread', capacity=OUTPUT_QUEUE_CAPACITY)
+
+    # Output is queued per stream. Each priority class has a FIFO of turns,
+    # one per queued frame, that decides which stream goes next. Large
+    # payloads are sent one fragment per turn and go to the back of the line
+    # after each. The classes share the output using deficit round robin, each
+    # getting up to its weight times |max_frame_size| bytes per round.
+    self.queues = {}
+    self.offsets = {}
+    self.priorities = {}
+    self.turns = dict((p, deque()) for (p, _) in PRIORITY_WEIGHTS)
+    self.deficits = dict((p, 0) for (p, _) in PRIORITY_WEIGHTS)
+
+    self.active_channels = set()
+    self.pending = []
+    self.pending_bytes = 0
+    self.pending_frames = 0
+    self.pending_since = None
+    self.broken = False
+    self.stats = {'frames': 0, 'flushes': 0, 'bytes': 0, 'batches': 0}
 
   def Quit(self):
     self.channel.Close()
 
   def Attach(self, stream):
-    self.Write(stream, OutputDispatchThread.CreateNewStream())
+    self._Put((stream.index, OutputDispatchThread.CreateNewStream()), True)
 
-  def Close(self, stream):
-    self.Write(stream, OutputDispatchThread.DeleteExistingStream())
+  def Close(self, stream, notify=True):
+    self._Put((stream.index, OutputDispatchThread.DeleteExistingStream(notify)),
+              True)
+
+  def Cancel(self, stream):
+    self._Put((stream.index, OutputDispatchThread.CancelStream()), True)
 
   def Write(self, stream, body):
-    v = (stream.index, body)
-    self.channel.Put(v)
+    self._Put((stream.index, body))
+
+  def SwitchFraming(self, reply, framing):
+    change = OutputDispatchThread.FramingChange(reply, framing)
+    self._Put((None, change), True)
+
+  def UpdateWindow(self, stream, credit):
+    update = OutputDispatchThread.WindowUpdate(credit)
+    self._Put((stream.index, update), True)
+
+  def SetPriority(self, stream, priority):
+    change = OutputDispatchThread.PriorityChange(priority)
+    self._Put((stream.index, change), True)
+
+  def _Put(self, v, control=False):
+    # Control items must never block. They are queued by the input side, which
+    # in turn may be what the peer is waiting on before it reads our output.
+    self.channel.Put(v, force=control)
+
+  def Stats(self):
+    stats = dict(self.stats)
+    stats['frames_per_flush'] = (float(stats['frames']) / stats['flushes']
+                                 if stats['flushes'] else 0.0)
+    stats['queued_items'] = self.channel.Pending()
+    stats['queued_frames'] = sum(len(q) for q in self.queues.values())
+    if self.compressor is not None:
+      stats['compression'] = self.compressor.Stats()
+    return stats
+
+  def _Emit(self, *parts):
+    if self.pending_since is None:
+      self.pending_since = time.time()
+    for part in parts:
+      self.pending.append(part)
+      self.pending_bytes += len(part)
+    self.pending_frames += 1
+
+  def _TakeOutput(self):
+    """Returns the pending output as a single string and resets it."""
+    data = ''.join(self.pending)
+    self.stats['frames'] += self.pending_frames
+    self.stats['bytes'] += self.pending_bytes
+    self.pending = []
+    self.pending_bytes = 0
+    self.pending_frames = 0
+    self.pending_since = None
+    return data
+
+  def _Flush(self):
+    if not self.pending:
+      return
+    data = self._TakeOutput()
+    if self.broken:
+      return
+    try:
+      self.output_file.write(data)
+      self.output_file.flush()
+    except (IOError, OSError) as e:
+      self._OutputFailed(e)
+      return
+    self.stats['flushes'] += 1
+
+  def _OutputFailed(self, error):
+    """Called once the output can't be written to anymore, typically because
+    the peer went away. Output is dropped from then on, so that writers don't
+    get stuck waiting for it."""
+    logging.error("Can't write output, dropping it from now on: %s", error)
+    self.broken = True
+
+  def _Process(self, batch):
+    """Sorts a batch of channel items into the per-stream queues.
+
+    Items that aren't subject to scheduling are encoded right away."""
+    self.stats['batches'] += 1
+
+    for (index, body) in batch:
+
+      if isinstance(body, OutputDispatchThread.FramingChange):
+        self._Emit(*self.framing.EncodeHandshake(body.reply))
+        features = body.reply.get('features', [])
+        self.framing = body.framing
+        self.raw_frames = 'raw' in features
+        self.fragment_frames = 'frag' in features
+        if 'zlib' in features:
+          self.compressor = Compressor()
+        continue
+
+      if isinstance(body, OutputDispatchThread.CreateNewStream):
+        self.active_channels.add(index)
+        self.queues.setdefault(index, deque())
+        continue
+
+      if isinstance(body, OutputDispatchThread.DeleteExistingStream):
+        self.active_channels.remove(index)
+        self._Enqueue(index, body)
+        continue
+
+      if isinstance(body, OutputDispatchThread.CancelStream):
+        if index in self.active_channels:
+          self._Emit(*self.framing.EncodeCancel(index))
+        continue
+
+      if isinstance(body, OutputDispatchThread.WindowUpdate):
+        if index in self.active_channels:
+          self._Emit(*self.framing.EncodeWindowUpdate(index, body.credit))
+        continue
+
+      if isinstance(body, OutputDispatchThread.PriorityChange):
+        if body.priority in self.turns:
+          self.priorities[index] = body.priority
+        continue
+
+      if index not in self.active_channels:
+        raise ValueError('Writing to inactive channel')
+
+      self._Enqueue(index, EncodePayload(body, self.raw_frames))
+
+  def _Enqueue(self, index, item):
+    self.queues[index].append(item)
+    self.turns[self.priorities.get(index)].append(index)
+
+  def _Busy(self):
+    """True if there's queued output that hasn't been encoded yet."""
+    for turns in self.turns.itervalues():
+      if turns:
+        return True
+    return False
+
+  def _Schedule(self):
+    """Gives every priority class that has queued output one round."""
+    for (priority, weight) in PRIORITY_WEIGHTS:
+      turns = self.turns[priority]
+      if not turns:
+        continue
+
+      deficit = self.deficits[priority] + weight * self.max_frame_size
+      while turns and deficit > 0:
+        deficit -= self._EmitNext(turns.popleft(), turns)
+      self.deficits[priority] = deficit if turns else 0
+
+  def _EmitNext(self, index, turns):
+    """Emits the next frame queued for a stream and returns its size."""
+    queue = self.queues[index]
+    item = queue[0]
+
+    if isinstance(item, OutputDispatchThread.DeleteExistingStream):
+      queue.popleft()
+      if item.notify:
+        self._Emit(*self.framing.EncodeClose(index))
+      if not queue and index not in self.active_channels:
+        del self.queues[index]
+        self.priorities.pop(index, None)
+      return 0
+
+    offset = self.offsets.pop(index, 0)
+    remaining = len(item.data) - offset
+    if self.fragment_frames and remaining > self.max_frame_size:
+      end = offset + self.max_frame_size
+      self.offsets[index] = end
+      self._EmitData(index, item.data[offset:end], item.flags | FLAG_MORE)
+      turns.append(index)
+      return self.max_frame_size
+
+    queue.popleft()
+    data = item.data[offset:] if offset else item.data
+    self._EmitData(index, data, item.flags)
+    return remaining
+
+  def _EmitData(self, index, data, flags):
+    # Compression has to happen here rather than when the item is queued.
+    # Payloads share one zlib stream, so they must be compressed in the order
+    # they go out.
+    if self.compressor is not None:
+      data, compressed = self.compressor.Compress(data)
+      flags |= compressed
+    self._Emit(*self.framing.EncodeData(index, data, flags))
+
+  def _Finish(self):
+    """Sends what's still queued and closes streams that are still open."""
+    while self._Busy():
+      self._Schedule()
+    for v in self.active_channels:
+      self._Emit(*self.framing.EncodeClose(v))
+    self.active_channels = set()
 
   def run(self):
+    closed = False
+    try:
+      while not closed or self._Busy():
+        if self._Busy():
+          batch = self.channel.TryGetAll()
+        else:
+          batch = self.channel.GetAll() or None
 
-    def Serialize(o):
-      return json.dumps(o, separators=(',', ':'))
+        if batch is None:
+          closed = True
+        elif batch:
+          self._Process(batch)
 
-    try:
-      active_channels = set()
-
-      for (index, body) in self.channel:
-
-        if isinstance(body, OutputDispatchThread.CreateNewStream):
-          active_channels.add(index)
-          continue
-
-        if isinstance(body, OutputDispatchThread.DeleteExistingStream):
-          active_channels.remove(index)
-          d = dict()
-          d['i'] = index
-          d['close'] = True
-          self.output_file.write(Serialize(d) + '\n')
-          self.output_file.flush()
-          continue
-
-        if index not in active_channels:
-          raise ValueError('Writing to inactive channel')
-
-        data = Serialize(body)
-        d = dict()
-        d['s'] = len(data)
-        d['i'] = index
-        self.output_file.write(Serialize(d) + '\n')
-        self.output_file.write(data)
-        self.output_file.flush()
+        self._Schedule()
+        if self.pending and self.flush_policy.ShouldFlush(
+            self.pending_bytes, self.pending_since,
+            not self._Busy() and self.channel.Pending() == 0):
+          self._Flush()
 
     except ValueError as e:
       raise ValueError('While writing: {}'.format(e.message))
       return
 
     finally:
-      for v in active_channels:
-        d = dict()
-        d['i'] = v
-        d['close'] = True
-        self.output_file.write(Serialize(d) + '\n')
-      self.output_file.flush()
+      self._Finish()
+      self._Flush()
 
 
-class InputDispatchThread(Thread):
+class InputDispatcher:
+  """Routes frames received from the peer to their streams.
 
-  def __init__(self, input_file, pipe):
-    super(InputDispatchThread, self).__init__()
-    self.input_file = input_file
+  Streams that aren't known yet are created on the pipe when their first frame
+  arrives. Frames can either be handed over one at a time using Dispatch(), or
+  as raw bytes in arbitrary chunks using Feed().
+  """
+
+  def __init__(self, pipe):
     self.pipe = pipe
+    self.framing = JsonFraming()
+    self.decoder = FrameDecoder()
     self.lock = Lock()
     self.streams = {}
-
-  def Quit(self):
-    pass
+    self.fragments = {}
+    self.decompressor = None
+    self.drained = False
+    self.stats = {'frames': 0, 'bytes': 0}
 
   def Attach(self, stream):
     with self.lock:
       self.streams[stream.index] = stream
+      drained = self.drained
+    # No input is coming for streams attached after the fact.
+    if drained:
+      stream._EndOfInput()
 
   def Close(self, stream):
     if not isinstance(stream, ChunkedStream):
@@ -207,74 +767,182 @@ class InputDispatchThread(Thread):
       if stream.index in self.streams:
         del self.streams[stream.index]
 
+  def Feed(self, data):
+    self.decoder.Feed(data)
+    while True:
+      frame = self.decoder.Next(self.framing)
+      if frame is None:
+        return
+      self.Dispatch(frame)
+
+  def Dispatch(self, frame):
+    self.stats['frames'] += 1
+    if frame.payload is not None:
+      self.stats['bytes'] += len(frame.payload)
+
+    if frame.handshake is not None:
+      self.framing = self.pipe._Negotiate(frame.handshake)
+      if self.pipe.compression:
+        self.decompressor = Decompressor()
+      return
+
+    if frame.IsWindowUpdate():
+      with self.lock:
+        stream = self.streams.get(frame.index)
+      # Updates for streams that are already gone are expected and harmless.
+      if stream is not None and stream.send_window is not None:
+        stream.send_window.Release(frame.window)
+      return
+
+    if frame.IsCancel():
+      with self.lock:
+        stream = self.streams.get(frame.index)
+      # The stream may well have finished in the meantime.
+      if stream is not None:
+        logging.debug('Cancelling %r', stream)
+        stream._Cancel()
+      return
+
+    if frame.IsCompressed():
+      if self.decompressor is None:
+        raise IOError('Compressed frame received without negotiating zlib')
+      frame.payload = self.decompressor.Decompress(frame.payload)
+
+    if frame.IsFragment():
+      self.fragments.setdefault(frame.index, []).append(frame.payload)
+      return
+
+    if frame.index in self.fragments and frame.payload is not None:
+      pieces = self.fragments.pop(frame.index)
+      pieces.append(frame.payload)
+      frame.payload = ''.join(pieces)
+
+    if frame.IsClose():
+      body = None
+    elif frame.IsRaw():
+      body = RawPayload(frame.payload)
+    else:
+      body = JsonPayload(frame.payload)
+
+    logging.debug('Payload from input: %r', body)
+    stream = None
+    stream_id = frame.index
+    with self.lock:
+      if stream_id in self.streams:
+        stream = self.streams[stream_id]
+
+    if stream is None:
+      if self.pipe.IsOutgoing(stream_id):
+        # The peer finishing a stream this end has already closed, after
+        # cancelling it.
+        return
+      stream = self.pipe.CreateStream(stream_id)
+
+    if body is None:
+      stream._EndOfInput()
+    else:
+      stream._Deliver(body, len(frame.payload))
+
+  def Stats(self):
+    stats = dict(self.stats)
+    with self.lock:
+      streams = self.streams.values()
+    stats['queued'] = sum(stream.channel.Pending() for stream in streams)
+    if self.decompressor is not None:
+      stats['compression'] = self.decompressor.Stats()
+    return stats
+
+  def Drain(self):
+    """Called once no more input is coming. Closes all remaining streams."""
+    if self.decoder.HasPartialFrame():
+      logging.error('Discarding %d bytes of incomplete input',
+                    self.decoder.Pending())
+    with self.lock:
+      self.drained = True
+      streams = self.streams.values()
+    for stream in streams:
+      stream._EndOfInput()
+      if stream.send_window is not None:
+        stream.send_window.Close()
+    self.pipe._InputDrained()
+
+
+class InputDispatchThread(Thread):
+  """Reads the pipe's input in bulk and feeds it to an InputDispatcher.
+
+  Files backed by a file descriptor are read using os.read(), which returns
+  whatever is available instead of waiting for a full buffer. Other file-like
+  objects are read using their read() method."""
+
+  def __init__(self, input_file, dispatcher, read_size=READ_SIZE):
+    super(InputDispatchThread, self).__init__()
+    self.input_file = input_file
+    self.dispatcher = dispatcher
+    self.read_size = read_size
+
+  def _Reader(self):
+    try:
+      fd = self.input_file.fileno()
+    except (AttributeError, IOError, ValueError):
+      return self.input_file.read
+
+    def read(size):
+      while True:
+        try:
+          return os.read(fd, size)
+        except OSError as e:
+          if e.errno != errno.EINTR:
+            raise
+
+    return read
+
   def run(self):
-    line = None
     try:
+      read = self._Reader()
       while True:
-        line = self.input_file.readline()
-        if line == '':
+        data = read(self.read_size)
+        if not data:
           logging.debug('Done with input')
           return
+        self.dispatcher.Feed(data)
 
-        # Stray newlines?
-        if line.strip() == '' or line == '\n':
-          continue
-
-        logging.debug('Header %s', repr(line))
-        v = json.loads(line)
-        if not v or 'i' not in v:
-          raise IOError('Input malformed: [{}]'.format(line))
-
-        if 'close' in v:
-          body = None
-        elif 's' not in v:
-          raise IOError('Input malformed: [{}]'.format(line))
-        elif v.get('s') == 'l':
-          line = self.input_file.readline()
-          body = json.loads(line)
-        else:
-          line = self.input_file.read(int(v.get('s')))
-          body = json.loads(line)
-
-        logging.debug('Payload from input: %s', repr(body))
-        stream = None
-        stream_id = int(v.get('i'))
-        with self.lock:
-          if stream_id in self.streams:
-            stream = self.streams[stream_id]
-
-        if stream is None:
-          stream = self.pipe.CreateStream(stream_id)
-
-        if body is None:
-          stream.channel.Close()
-        else:
-          stream.channel.Put(body)
-
-    except ValueError as v:
+    except (IOError, OSError, ValueError):
       logging.exception("Can't process input stream.")
       return
 
     finally:
-      with self.lock:
-        streams = self.streams.values()
-      for stream in streams:
-        stream.channel.Close()
-      self.pipe._InputDrained()
+      self.dispatcher.Drain()
 
 
 class ChunkedFileStream:
+  """File object reading and writing the payloads of a stream.
+
+  Unless |output_filter| says otherwise, written data is sent as objects with
+  the data under the |out_token| key."""
 
-  def __init__(self, stream, input_filter=None, output_filter=None):
+  def __init__(self,
+               stream,
+               input_filter=None,
+               output_filter=None,
+               out_token='out'):
 
     def d(o):
+      if isinstance(o, RawPayload):
+        return o.data
       assert 'd' in o, 'No "d" field in received object {}.'.format(repr(o))
       return o.get('d')
 
     self.stream = stream
     self.output_filter = output_filter
     self.input_filter = input_filter if input_filter else d
-    self.buffer = ''
+    self.out_token = out_token
+
+    # Data received but not read yet. Chunks are kept as they arrived and
+    # |offset| is the read position within the first one, so that reads only
+    # ever copy the data they return.
+    self.chunks = deque()
+    self.offset = 0
+    self.buffered = 0
 
   def close(self):
     self.stream.Close()
@@ -291,45 +959,90 @@ class ChunkedFileStream:
       raise StopIteration
     return s
 
-  def read(self, size=-1):
-    if len(self.buffer) == 0:
+  def _Fill(self):
+    """Waits for another chunk of data. Returns False at the end of input."""
+    while True:
       o = self.stream.Read()
       if o is None:
-        return ''
-
-      self.buffer = self.input_filter(o)
+        return False
+
+      data = self.input_filter(o)
+      if isinstance(data, unicode):
+        data = data.encode('utf-8')
+      if data:
+        self.chunks.append(data)
+        self.buffered += len(data)
+        return True
+
+  def _Consume(self, size):
+    """Yields (chunk, start, end) spans making up the next |size| bytes of
+    buffered data and drops them from the buffer."""
+    while size > 0:
+      chunk = self.chunks[0]
+      start = self.offset
+      end = min(len(chunk), start + size)
+      size -= end - start
+      self.buffered -= end - start
+      if end == len(chunk):
+        self.chunks.popleft()
+        self.offset = 0
+      else:
+        self.offset = end
+      yield (chunk, start, end)
+
+  def _Take(self, size):
+    pieces = [
+        chunk if start == 0 and end == len(chunk) else chunk[start:end]
+        for (chunk, start, end) in self._Consume(size)
+    ]
+    return pieces[0] if len(pieces) == 1 else ''.join(pieces)
 
-    if size == -1 or size >= len(self.buffer):
-      s = self.buffer
-      self.buffer = ''
-      return s
-    else:
-      s = self.buffer[:size]
-      self.buffer = self.buffer[size:]
-      return s
+  def read(self, size=-1):
+    """Returns up to |size| bytes.
+
+    Like a pipe, this only waits for more input if nothing is buffered. Without
+    a |size| it returns everything that's buffered, which is at least the next
+    chunk."""
+    if self.buffered == 0 and not self._Fill():
+      return ''
+    if size is None or size < 0 or size > self.buffered:
+      size = self.buffered
+    return self._Take(size)
+
+  def readinto(self, b):
+    """Reads up to len(|b|) bytes into the writable buffer |b|."""
+    if self.buffered == 0 and not self._Fill():
+      return 0
+    filled = 0
+    for (chunk, start, end) in self._Consume(min(len(b), self.buffered)):
+      b[filled:filled + end - start] = memoryview(chunk)[start:end]
+      filled += end - start
+    return filled
 
   def readline(self, size=-1):
-    remaining_size = size
-    line_so_far = ''
-    while remaining_size == -1 or remaining_size > 0:
-      s = self.read(remaining_size)
-      if s == '':
-        return line_so_far
-
-      line_so_far += s
-      if remaining_size > 0:
-        remaining_size -= len(s)
-
-      if '\n' in s:
-        break
-
-    s = line_so_far
-    o = s.find('\n')
-    if o == -1 or o == len(s) - 1:
-      return s
-
-    self.buffer = s[o + 1:] + self.buffer
-    return s[:o + 1]
+    if size == 0:
+      return ''
+    limit = size if size > 0 else None
+    scanned = 0
+    index = 0
+    while True:
+      # Only the chunks that haven't been searched for a newline yet are
+      # looked at, so a line spread across many chunks is read in linear time.
+      while index < len(self.chunks):
+        chunk = self.chunks[index]
+        start = self.offset if index == 0 else 0
+        newline = chunk.find('\n', start)
+        if newline != -1:
+          scanned += newline + 1 - start
+          return self._Take(min(scanned, limit) if limit else scanned)
+
+        scanned += len(chunk) - start
+        index += 1
+        if limit is not None and scanned >= limit:
+          return self._Take(limit)
+
+      if not self._Fill():
+        return self._Take(self.buffered)
 
   def readlines(self, size=-1):
     return list(self)
@@ -337,7 +1050,7 @@ class ChunkedFileStream:
   def write(self, buf):
     if not self.output_filter:
       d = dict()
-      d['out'] = buf
+      d[self.out_token] = buf
     else:
       d = self.output_filter(buf)
     self.stream.Write(d)
@@ -369,3 +1082,31 @@ class ChunkedFileStream:
 
   def newlines(self):
     return None
+
+
+def _Bytes(data):
+  if isinstance(data, unicode):
+    return data.encode('utf-8')
+  return data
+
+
+class ChunkedRawReader(io.RawIOBase):
+  """Raw binary file reading a ChunkedFileStream.
+
+  Closing it leaves the stream open."""
+
+  def __init__(self, file_stream):
+    super(ChunkedRawReader, self).__init__()
+    self.file_stream = file_stream
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    return self.file_stream.readinto(b)
+
+
+def BufferedBody(stream, buffer_size=io.DEFAULT_BUFFER_SIZE):
+  """Returns a buffered binary file reading the body chunks of |stream|."""
+  return io.BufferedReader(
+      ChunkedRawReader(ChunkedFileStream(stream)), buffer_size)
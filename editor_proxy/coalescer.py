@@ -0,0 +1,164 @@
+"""Coalescing of requests that are superseded by newer ones.
+
+While the user is typing, every keystroke produces a /completions request for
+the same file, line and start column. Only the newest of those is of any use
+once it arrives. PipeServer asks a Coalescer about each request for a
+coalesced endpoint before queueing it. If an older request with the same key
+is still waiting for a worker, the older one is answered right away with a
+lightweight "superseded" response and never reaches the WSGI app.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+from threading import Lock
+
+# Header added to responses for requests that were superseded.
+SUPERSEDED_HEADER = 'X-Superseded'
+
+
+def _IsIdentifierChar(c):
+  return c.isalnum() or c == '_'
+
+
+def CompletionStartColumn(contents, line_num, column_num):
+  """Returns the 1-based column at which the identifier under the cursor
+  starts. |line_num| and |column_num| are 1-based as in ycmd requests, so
+  columns are byte offsets into the UTF-8 encoded line."""
+  lines = contents.split('\n')
+  if line_num < 1 or line_num > len(lines):
+    return column_num
+  line = lines[line_num - 1]
+  if isinstance(line, unicode):
+    line = line.encode('utf-8')
+  # Identifier characters are told apart by code point, but the column is
+  # counted in bytes.
+  before = line[:max(column_num - 1, 0)].decode('utf-8', 'ignore')
+  start = len(before)
+  while start > 0 and _IsIdentifierChar(before[start - 1]):
+    start -= 1
+  return len(before[:start].encode('utf-8')) + 1
+
+
+def CompletionKey(request):
+  """Returns (filepath, line, start column) for a /completions request."""
+  filepath = request['filepath']
+  line_num = int(request['line_num'])
+  column_num = int(request['column_num'])
+  contents = request.get('file_data', {}).get(filepath, {}).get('contents', '')
+  return (filepath, line_num,
+          CompletionStartColumn(contents, line_num, column_num))
+
+
+def EmptyCompletions(request):
+  return {
+      'completions': [],
+      'completion_start_column': CompletionKey(request)[2],
+      'errors': []
+  }
+
+
+class CoalescedEndpoint:
+  """How requests to one endpoint are coalesced.
+
+  |key| maps a decoded request body to a value that is equal for requests
+  that supersede each other. |superseded| maps it to the JSON body of the
+  response sent for a superseded request."""
+
+  def __init__(self, key, superseded):
+    self.key = key
+    self.superseded = superseded
+
+
+DEFAULT_ENDPOINTS = {
+    '/completions': CoalescedEndpoint(CompletionKey, EmptyCompletions),
+}
+
+
+class Coalescer:
+  """Tracks queued requests of coalesced endpoints.
+
+  Requests are handlers as seen by PipeServer. They are identified by a key
+  returned from Key() and must go through Admit() when they are queued and
+  through Start() right before they run. Which of two requests supersedes the
+  other depends on the order they arrived in, as told by Arrive(), not on the
+  order they were admitted in."""
+
+  def __init__(self, endpoints=DEFAULT_ENDPOINTS):
+    self.endpoints = endpoints
+    self.lock = Lock()
+    # (arrival, request) for each key.
+    self.queued = {}
+    self.arrivals = 0
+    self.stats = {}
+
+  def IsCoalesced(self, path):
+    return path in self.endpoints
+
+  def Key(self, path, body, scope=None):
+    """Returns the key of a request, or None if it can't be coalesced.
+
+    Only requests with the same |scope| supersede each other."""
+    endpoint = self.endpoints.get(path)
+    if endpoint is None or not body:
+      return None
+    try:
+      return (path, endpoint.key(json.loads(body)), scope)
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return None
+
+  def Arrive(self):
+    """Returns a number that's greater for requests that arrive later."""
+    with self.lock:
+      self.arrivals += 1
+      return self.arrivals
+
+  def Admit(self, key, request, arrival=None):
+    """Queues |request|, which arrived at |arrival| as returned by Arrive(),
+    or just now if it's None.
+
+    Returns the request that is superseded, if any. That's |request| itself
+    if a request that arrived after it is queued already."""
+    with self.lock:
+      if arrival is None:
+        self.arrivals += 1
+        arrival = self.arrivals
+      queued = self.queued.get(key)
+      if queued is None:
+        self.queued[key] = (arrival, request)
+        return None
+
+      path = key[0]
+      self.stats[path] = self.stats.get(path, 0) + 1
+      (queued_arrival, older) = queued
+      if queued_arrival > arrival:
+        return request
+      self.queued[key] = (arrival, request)
+      return older
+
+  def Start(self, key, request):
+    """Returns False if |request| has been superseded and shouldn't run."""
+    return self.Forget(key, request)
+
+  def Forget(self, key, request):
+    """Stops tracking |request|, which won't run. Returns False if it has been
+    superseded."""
+    with self.lock:
+      queued = self.queued.get(key)
+      if queued is None or queued[1] is not request:
+        return False
+      del self.queued[key]
+      return True
+
+  def SupersededResponse(self, path, body):
+    return {
+        'st': '200 OK',
+        'h': [('Content-Type', 'application/json'), (SUPERSEDED_HEADER, '1')],
+        'o': self.endpoints[path].superseded(json.loads(body))
+    }
+
+  def Stats(self):
+    with self.lock:
+      return {'coalesced': dict(self.stats), 'queued': len(self.queued)}
@@ -0,0 +1,301 @@
+"""Keeps ycmd running across sessions.
+
+A proxy started with --daemon SOCKET doesn't serve its stdin and stdout
+itself. Attach() hands them to the daemon listening on the Unix socket SOCKET
+and waits until the daemon is done with them. The daemon serves all sessions
+with one PipeServer, so when the connection to the editor drops, only the
+session ends. ycmd keeps its parsed translation units and identifier databases
+for the session that comes next.
+
+The first proxy that finds no daemon on SOCKET starts one in the background.
+The daemon makes up a session token and sends it on the out-of-band stream 0
+along with its state, as in '{"state":"ready","session":"..."}'. Only the
+first session gets to attach without the token. Later ones have to pass it
+with --session, so that an editor only ever resumes its own session.
+
+Each session passes its user options along. If they differ from the ones ycmd
+runs with, the daemon switches ycmd over to them, which throws away what ycmd
+kept from earlier sessions. It doesn't while other sessions are attached, and
+the session then runs with the options ycmd has.
+
+A daemon exits once it has had no session for a while. It also exits once the
+last session is gone if ycmd failed to start, or if a client asked ycmd to
+shut down.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import binascii
+import errno
+import hmac
+import logging
+import os
+import select
+import socket
+import time
+from threading import Lock, Thread
+
+from .handover import (Connect, HandOver, Listen, ReadMessage, TakeOver,
+                       WriteMessage)
+
+DEFAULT_IDLE_SECONDS = 3 * 60 * 60
+
+# How often the daemon checks whether it has been idle for long enough, in
+# seconds.
+IDLE_CHECK_INTERVAL = 5.0
+
+# How long Attach() waits for a daemon it started to listen, in seconds.
+START_TIMEOUT = 10.0
+
+SESSION_FDS = (0, 1)
+
+
+def NewToken():
+  return binascii.hexlify(os.urandom(16))
+
+
+def Daemonize(log_file=None):
+  """Forks a process that's detached from the caller's session.
+
+  The new process has its stdin and stdout redirected to /dev/null, and its
+  stderr to |log_file| if given. Returns True in the new process and False in
+  the caller."""
+  pid = os.fork()
+  if pid:
+    os.waitpid(pid, 0)
+    return False
+
+  # The intermediate child exits right away, so the daemon doesn't stay a
+  # child of the caller.
+  os.setsid()
+  if os.fork():
+    os._exit(0)
+
+  null = os.open(os.devnull, os.O_RDWR)
+  log = null
+  if log_file is not None:
+    log = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+  os.dup2(null, 0)
+  os.dup2(null, 1)
+  os.dup2(log, 2)
+  return True
+
+
+class Daemon:
+  """Serves the sessions attaching on the Unix socket |path| with |server|.
+
+  |open_pipe| is called with the input and output file of each session and
+  returns a ChunkedPipe for them. The daemon stands in for |server| towards
+  the code that loads the app.
+
+  |options| are the user options ycmd is loaded with. |update_options| is
+  called with the options of a session that brings different ones."""
+
+  def __init__(self,
+               path,
+               server,
+               open_pipe,
+               idle_timeout=DEFAULT_IDLE_SECONDS,
+               options=None,
+               update_options=None):
+    self.path = path
+    self.server = server
+    self.open_pipe = open_pipe
+    self.idle_timeout = idle_timeout
+    self.options = options
+    self.update_options = update_options
+    self.token = NewToken()
+    self.lock = Lock()
+    self.listener = None
+    # Out-of-band streams of the attached sessions.
+    self.sessions = set()
+    # Number of sessions that have attached, which names the next one.
+    self.attached = 0
+    self.claimed = False
+    self.stopping = False
+    self.state = {'state': 'starting'}
+    self.idle_since = time.time()
+
+  def Listen(self):
+    """Starts listening for sessions. Raises RuntimeError if another daemon
+    is listening on |path| already."""
+    self.listener = Listen(self.path)
+
+  def ReportState(self, state, **fields):
+    """Tells every session, and every one that attaches later, about the state
+    of the daemon."""
+    with self.lock:
+      self.state = dict(fields, state=state)
+      for control in self.sessions:
+        control.Write(dict(self.state, session=self.token))
+
+  def SetApp(self, app):
+    self.server.SetApp(app)
+
+  def FailStartup(self, message):
+    self.server.FailStartup(message)
+
+  def Shutdown(self):
+    """Called by ycmd when a client asks it to shut down. Lets the daemon exit
+    once the sessions attached now are over."""
+    with self.lock:
+      self.stopping = True
+
+  def Serve(self):
+    """Serves sessions until it's time for the daemon to exit."""
+    try:
+      while not self._ShouldExit():
+        try:
+          readable = select.select([self.listener], [], [],
+                                   IDLE_CHECK_INTERVAL)[0]
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          continue
+        if readable:
+          (connection, _) = self.listener.accept()
+          session = Thread(target=self._RunSession, args=(connection,))
+          session.daemon = True
+          session.start()
+    finally:
+      self.listener.close()
+      os.unlink(self.path)
+
+  def _ShouldExit(self):
+    with self.lock:
+      if self.sessions:
+        return False
+      if self.stopping:
+        return True
+      if self.state['state'] == 'failed' and self.claimed:
+        return True
+      return (self.idle_timeout and
+              time.time() - self.idle_since > self.idle_timeout)
+
+  def _Claim(self, token):
+    """Returns None if a session presenting |token| may attach, and why not
+    otherwise."""
+    with self.lock:
+      if self.stopping:
+        return 'Shutting down'
+      if not self.claimed:
+        self.claimed = True
+        return None
+    if not hmac.compare_digest(str(token or ''), self.token):
+      return 'Unknown session'
+    return None
+
+  def _UpdateOptions(self, options):
+    """Makes ycmd use the user |options| of a session if they differ from the
+    ones it runs with."""
+    if options is None or self.update_options is None:
+      return
+    with self.lock:
+      if options == self.options:
+        return
+      if self.state['state'] != 'ready':
+        logging.warning('ycmd is still loading, the session runs with the '
+                        'options of the first one')
+        return
+      if len(self.sessions) > 1:
+        logging.warning('Other sessions are attached, the session runs with '
+                        'their options')
+        return
+      self.options = options
+    logging.warning('Session brought different options, ycmd starts over')
+    self.update_options(options)
+
+  def _RunSession(self, connection):
+    try:
+      (fds, request) = TakeOver(connection, len(SESSION_FDS))
+    except (IOError, OSError, RuntimeError, ValueError):
+      logging.exception('Session failed to attach')
+      connection.close()
+      return
+
+    with os.fdopen(fds[0], 'rb', 0) as input_file, \
+        os.fdopen(fds[1], 'wb', 0) as output_file:
+      reply = self._Serve(request, input_file, output_file)
+
+    try:
+      WriteMessage(connection, reply)
+    except socket.error:
+      logging.debug('Launcher went away before its session ended')
+    finally:
+      connection.close()
+
+  def _Serve(self, request, input_file, output_file):
+    """Serves a session on |input_file| and |output_file|. Returns the reply
+    to the proxy that handed them over."""
+    error = self._Claim(request.get('session'))
+    if error is not None:
+      logging.warning('Refused a session: %s', error)
+      return {'exit_code': 1, 'error': error}
+
+    logging.info('Session attached')
+    pipe = self.open_pipe(input_file, output_file)
+    control = pipe.CreateStream(0, out_of_band=True)
+    with self.lock:
+      self.sessions.add(control)
+      self.attached += 1
+      name = 'session-{}'.format(self.attached)
+      control.Write(dict(self.state, session=self.token))
+    self._UpdateOptions(request.get('options'))
+
+    try:
+      # Sessions may overlap, and each one keeps its own buffers and
+      # coalescing scope.
+      self.server.Serve(pipe, name)
+    finally:
+      with self.lock:
+        self.sessions.discard(control)
+        self.idle_since = time.time()
+        code = 1 if self.state['state'] == 'failed' else 0
+    logging.info('Session detached')
+    return {'exit_code': code}
+
+
+def Attach(path, token, start, fds=SESSION_FDS, options=None):
+  """Serves a session on |fds| by the daemon listening on |path|.
+
+  Calls |start| to start a daemon first if there's none. A session created by
+  an earlier daemon can't be resumed, so |token| is ignored by a daemon
+  started here. The daemon runs ycmd with the user |options| if given.
+  Returns the exit code of the session."""
+  request = {'session': token}
+  if options is not None:
+    request['options'] = options
+  try:
+    connection = Connect(path)
+  except socket.error:
+    logging.info('Starting a daemon on %s', path)
+    start()
+    connection = _WaitForDaemon(path)
+
+  try:
+    reply = ReadMessage(HandOver(connection, fds, request))
+  except socket.error:
+    logging.exception('Lost the connection to the daemon')
+    return 1
+  finally:
+    connection.close()
+
+  if reply is None:
+    return 1
+  if 'error' in reply:
+    logging.error("Daemon on %s didn't take the session: %s", path,
+                  reply['error'])
+  return reply['exit_code']
+
+
+def _WaitForDaemon(path):
+  deadline = time.time() + START_TIMEOUT
+  while True:
+    try:
+      return Connect(path)
+    except socket.error:
+      if time.time() > deadline:
+        raise
+    time.sleep(0.05)
@@ -0,0 +1,233 @@
+"""Elision of buffer contents from the file_data of ycmd requests.
+
+Every ycmd request carries the full contents of the dirty buffers in its
+file_data. Clients that mark a request header with '"fd":1' may instead send
+each buffer as an edit of a version the proxy already has:
+
+  "file_data": {
+    "/a.cc": {
+      "filetypes": ["cpp"],
+      "base_version": 3,
+      "delta": [[120, 124, "bar"]],
+      "version": 4
+    }
+  }
+
+Each edit in |delta| replaces the characters in [start, end) of the base
+contents with the given text. Offsets count Unicode code points of the base
+version and edits must be sorted and mustn't overlap.
+
+Buffers that are unmodified copies of a file on the proxy's machine may be
+sent as the SHA-1 of their UTF-8 contents along with their size in bytes:
+
+  "/b.h": {"filetypes": ["cpp"], "sha1": "3f78...", "size": 812,
+           "mtime": 1500000000}
+
+The proxy then reads the file itself. It remembers the digests of files it has
+read by their size, mtime and inode, so unchanged files aren't hashed again.
+The client's mtime is informational only, since the two machines may disagree
+about time. Whether the contents match is decided by the digest.
+
+Buffers may still be sent in full using "contents". Any of these forms may
+carry a "version" under which the proxy keeps the resulting contents.
+
+The proxy rebuilds plain file_data before the request reaches the WSGI app.
+Versions it stored are acknowledged in the status frame of the response as
+'"fd":{"/a.cc":4}'. If a base version is unknown, e.g. because it was
+evicted, or a file on disk doesn't match its digest, the request fails with
+412 and lists the files in "need_contents". The client should then send those
+in full.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+from collections import OrderedDict
+from threading import Lock
+
+# Total number of characters of buffer contents the cache holds on to.
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Number of files whose digests are remembered.
+DEFAULT_MAX_DIGESTS = 4096
+
+
+class NeedContents(Exception):
+  """Raised if the contents of some buffers have to be sent in full."""
+
+  def __init__(self, filepaths):
+    super(NeedContents, self).__init__('Contents needed for {}'.format(
+        ', '.join(filepaths)))
+    self.filepaths = filepaths
+
+
+def ApplyDelta(base, delta):
+  """Returns |base| with the edits in |delta| applied."""
+  pieces = []
+  offset = 0
+  for (start, end, text) in delta:
+    if start < offset or end < start or end > len(base):
+      raise ValueError('Bad edit [{}, {}) of {} characters'.format(
+          start, end, len(base)))
+    pieces.append(base[offset:start])
+    pieces.append(text)
+    offset = end
+  pieces.append(base[offset:])
+  return u''.join(pieces)
+
+
+class DigestCache:
+  """Remembers the SHA-1 digests of files on disk.
+
+  Digests are keyed by the size, mtime and inode of the file they were
+  computed for. At most |max_entries| files are remembered."""
+
+  def __init__(self, max_entries=DEFAULT_MAX_DIGESTS):
+    self.max_entries = max_entries
+    self.lock = Lock()
+    self.entries = OrderedDict()
+    self.stats = {'hits': 0, 'hashed': 0, 'mismatches': 0}
+
+  def Contents(self, filepath, digest, size=None):
+    """Returns the contents of |filepath| if their digest is |digest|.
+
+    Returns None if they aren't, or if the file can't be read. |size| is the
+    expected size in bytes, which allows skipping files that can't match."""
+    try:
+      with open(filepath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if size is not None and st.st_size != size:
+          return self._Mismatch()
+        data = f.read()
+    except (IOError, OSError):
+      return None
+
+    key = (st.st_size, st.st_mtime, st.st_ino)
+    with self.lock:
+      known = self.entries.pop(filepath, None)
+      if known is not None and known[0] == key:
+        self.entries[filepath] = known
+        actual = known[1]
+        self.stats['hits'] += 1
+      else:
+        actual = None
+
+    if actual is None:
+      actual = hashlib.sha1(data).hexdigest()
+      with self.lock:
+        self.stats['hashed'] += 1
+        self.entries.pop(filepath, None)
+        self.entries[filepath] = (key, actual)
+        while len(self.entries) > self.max_entries:
+          self.entries.popitem(last=False)
+
+    if actual != digest:
+      return self._Mismatch()
+    return data.decode('utf-8', 'replace')
+
+  def _Mismatch(self):
+    with self.lock:
+      self.stats['mismatches'] += 1
+    return None
+
+  def Stats(self):
+    with self.lock:
+      stats = dict(self.stats)
+      stats['entries'] = len(self.entries)
+      return stats
+
+
+class BufferCache:
+  """LRU cache of buffer contents keyed by filepath and version.
+
+  Holds at most |max_size| characters of contents in total."""
+
+  def __init__(self, max_size=DEFAULT_MAX_SIZE):
+    self.max_size = max_size
+    self.lock = Lock()
+    self.entries = OrderedDict()
+    self.size = 0
+    self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+  def Get(self, filepath, version):
+    key = (filepath, version)
+    with self.lock:
+      contents = self.entries.pop(key, None)
+      if contents is None:
+        self.stats['misses'] += 1
+        return None
+      self.entries[key] = contents
+      self.stats['hits'] += 1
+      return contents
+
+  def Put(self, filepath, version, contents):
+    """Stores |contents|. Returns False if they're too large to keep."""
+    if len(contents) > self.max_size:
+      return False
+
+    key = (filepath, version)
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.size -= len(old)
+      self.entries[key] = contents
+      self.size += len(contents)
+      while self.size > self.max_size:
+        _, evicted = self.entries.popitem(last=False)
+        self.size -= len(evicted)
+        self.stats['evictions'] += 1
+    return True
+
+  def Expand(self, request, digests=None):
+    """Turns file_data in |request| back into full contents.
+
+    Buffers sent by digest are read using |digests|, a DigestCache. |request|
+    is modified in place. Returns a map of filepaths to the versions that were
+    stored. Raises NeedContents if some contents can't be rebuilt, in which
+    case nothing is stored."""
+    file_data = request.get('file_data', {})
+    missing = []
+    expanded = {}
+    for filepath, data in file_data.items():
+      contents = None
+      if 'delta' in data:
+        base = self.Get(filepath, data.get('base_version'))
+        if base is not None:
+          contents = ApplyDelta(base, data['delta'])
+      elif 'sha1' in data:
+        if digests is not None:
+          contents = digests.Contents(filepath, data['sha1'],
+                                      data.get('size'))
+      else:
+        continue
+
+      if contents is None:
+        missing.append(filepath)
+      else:
+        expanded[filepath] = contents
+
+    if missing:
+      raise NeedContents(sorted(missing))
+
+    acks = {}
+    for filepath, data in file_data.items():
+      if filepath in expanded:
+        data['contents'] = expanded[filepath]
+      for key in ('delta', 'base_version', 'sha1', 'size', 'mtime'):
+        data.pop(key, None)
+
+      version = data.pop('version', None)
+      if (version is not None and 'contents' in data and
+          self.Put(filepath, version, data['contents'])):
+        acks[filepath] = version
+    return acks
+
+  def Stats(self):
+    with self.lock:
+      stats = dict(self.stats)
+      stats['entries'] = len(self.entries)
+      stats['size'] = self.size
+      return stats
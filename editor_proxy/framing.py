@@ -0,0 +1,459 @@
+"""Frame header encodings used by ChunkedPipe.
+
+Every frame on the pipe carries a stream index, a set of flags and an optional
+payload. Two header encodings are supported:
+
+  json:   The default. Each header is a JSON object on its own line, e.g.
+          '{"i":1,"s":9}\\n', followed by |s| bytes of payload. A size of "l"
+          means the payload is terminated by a newline instead.
+
+  binary: A fixed size header packed as (magic, flags, index, length) in
+          network byte order, followed by |length| bytes of payload.
+
+The peer may give up on a stream by sending a cancel frame for it,
+'{"i":1,"cancel":true}\n' in json or a header with FLAG_CANCEL in binary. The
+proxy then stops working on the request and closes the stream. Its close frame
+is still the last frame of the stream.
+
+A pipe always starts out using the json encoding. The peer can ask for a
+different one by sending a handshake line such as
+'{"hs":{"framing":["binary","json"]}}\\n'. The proxy picks the first encoding
+in that list that it supports and answers with '{"hs":{"framing":"binary"}}\\n'
+using the old encoding. Frames after the handshake in either direction use the
+new encoding.
+
+The handshake may also list optional protocol features, as in
+'{"hs":{"framing":["json"],"features":["raw"]}}\\n'. The reply then carries
+the subset the proxy agreed to. Supported features:
+
+  raw:    Payloads of body chunks are sent verbatim instead of as a JSON
+          '{"d":...}' object. Such frames are marked by '"r":1' in a json
+          header or by FLAG_RAW in a binary header. The proxy always accepts
+          raw frames, but only sends them once the feature is negotiated.
+
+  flow:   Credit based flow control. Each side may only send as many payload
+          bytes on a stream as the other side has granted. The initial grant
+          for every stream is the "window" value of the handshake sent by the
+          receiver. Further credit is granted with window update frames,
+          '{"i":1,"w":4096}\n' in json or FLAG_WINDOW with the credit in the
+          length field in binary, as the receiver consumes data.
+
+  frag:   Payloads may be split across several frames of the same stream so
+          that frames of other streams can be sent in between. All but the
+          last piece are marked by '"m":1' in a json header or by FLAG_MORE in
+          a binary header. The receiver joins the pieces before decoding.
+
+  zlib:   Payloads may be compressed. Each direction of the pipe uses a single
+          zlib stream that is shared by all frames, so that keys repeated
+          across messages compress well. Every compressed payload ends with a
+          sync flush and can be inflated as soon as it arrives. Compressed
+          frames are marked by '"z":1' in a json header or by FLAG_COMPRESSED
+          in a binary header. The sender decides which frames are worth
+          compressing.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import struct
+import time
+import zlib
+from collections import deque
+
+FLAG_CLOSE = 0x01
+FLAG_LINE = 0x02
+FLAG_COMPRESSED = 0x04
+FLAG_RAW = 0x08
+FLAG_WINDOW = 0x10
+FLAG_MORE = 0x20
+FLAG_CANCEL = 0x40
+
+# Payload size of frames whose payload is terminated by a newline.
+LINE = 'l'
+
+# Payloads smaller than this aren't worth compressing.
+DEFAULT_COMPRESSION_THRESHOLD = 512
+
+BINARY_MAGIC = 0xFE
+BINARY_HEADER = struct.Struct('!BBII')
+
+# How much of the next chunk FrameDecoder copies at first to decode a header
+# that straddles two chunks. It tries twice as much each time that falls short.
+HEADER_PROBE_SIZE = 256
+
+
+def Serialize(o):
+  return json.dumps(o, separators=(',', ':'))
+
+
+class Frame:
+
+  def __init__(self,
+               index=None,
+               flags=0,
+               payload=None,
+               handshake=None,
+               window=None):
+    self.index = index
+    self.flags = flags
+    self.payload = payload
+    self.handshake = handshake
+    self.window = window
+
+  def IsClose(self):
+    return bool(self.flags & FLAG_CLOSE)
+
+  def IsRaw(self):
+    return bool(self.flags & FLAG_RAW)
+
+  def IsWindowUpdate(self):
+    return bool(self.flags & FLAG_WINDOW)
+
+  def IsCancel(self):
+    return bool(self.flags & FLAG_CANCEL)
+
+  def IsCompressed(self):
+    return bool(self.flags & FLAG_COMPRESSED)
+
+  def IsFragment(self):
+    """True if more pieces of this frame's payload follow."""
+    return bool(self.flags & FLAG_MORE)
+
+  def __repr__(self):
+    return 'Frame({}, {}, {}, {})'.format(
+        repr(self.index), self.flags, repr(self.payload), repr(self.handshake))
+
+
+class JsonFraming:
+  name = 'json'
+
+  def EncodeData(self, index, payload, flags=0):
+    header = {'i': index, 's': len(payload)}
+    if flags & FLAG_RAW:
+      header['r'] = 1
+    if flags & FLAG_MORE:
+      header['m'] = 1
+    if flags & FLAG_COMPRESSED:
+      header['z'] = 1
+    return (Serialize(header) + '\n', payload)
+
+  def EncodeClose(self, index):
+    return (Serialize({'i': index, 'close': True}) + '\n',)
+
+  def EncodeWindowUpdate(self, index, credit):
+    return (Serialize({'i': index, 'w': credit}) + '\n',)
+
+  def EncodeCancel(self, index):
+    return (Serialize({'i': index, 'cancel': True}) + '\n',)
+
+  def EncodeHandshake(self, reply):
+    return (Serialize({'hs': reply}) + '\n',)
+
+  def _ParseHeader(self, line):
+    """Returns (frame, payload size) for a header line.
+
+    The size is None for frames without a payload and LINE for payloads that
+    are terminated by a newline."""
+    v = json.loads(line)
+    if v and 'hs' in v:
+      return (Frame(handshake=v['hs']), None)
+
+    if not v or 'i' not in v:
+      raise IOError('Input malformed: [{}]'.format(line))
+
+    index = int(v['i'])
+    flags = FLAG_RAW if v.get('r') else 0
+    if v.get('m'):
+      flags |= FLAG_MORE
+    if v.get('z'):
+      flags |= FLAG_COMPRESSED
+    if 'close' in v:
+      return (Frame(index, FLAG_CLOSE), None)
+    elif 'cancel' in v:
+      return (Frame(index, FLAG_CANCEL), None)
+    elif 'w' in v:
+      return (Frame(index, FLAG_WINDOW, window=int(v['w'])), None)
+    elif 's' not in v:
+      raise IOError('Input malformed: [{}]'.format(line))
+    elif v['s'] == 'l':
+      return (Frame(index, flags | FLAG_LINE), LINE)
+    else:
+      return (Frame(index, flags), int(v['s']))
+
+  def ParseHeader(self, buffer, offset):
+    """Decodes the frame header starting at |offset| in |buffer|.
+
+    Returns (frame, payload size, offset just past the header), or None if
+    |buffer| doesn't hold the complete header yet. Stray newlines in front of
+    the header are skipped."""
+    while True:
+      end = buffer.find('\n', offset)
+      if end == -1:
+        return None
+
+      line = buffer[offset:end + 1]
+      # Stray newlines?
+      if line.strip() != '':
+        break
+      offset = end + 1
+
+    frame, size = self._ParseHeader(line)
+    return (frame, size, end + 1)
+
+
+class BinaryFraming:
+  name = 'binary'
+
+  def _Header(self, index, flags, length):
+    return BINARY_HEADER.pack(BINARY_MAGIC, flags, index, length)
+
+  def EncodeData(self, index, payload, flags=0):
+    return (self._Header(index, flags, len(payload)), payload)
+
+  def EncodeClose(self, index):
+    return (self._Header(index, FLAG_CLOSE, 0),)
+
+  def EncodeWindowUpdate(self, index, credit):
+    return (self._Header(index, FLAG_WINDOW, credit),)
+
+  def EncodeCancel(self, index):
+    return (self._Header(index, FLAG_CANCEL, 0),)
+
+  def EncodeHandshake(self, reply):
+    raise ValueError('Handshakes are only exchanged using the json framing')
+
+  def _ParseHeader(self, header):
+    magic, flags, index, length = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC:
+      raise IOError('Bad frame header: [{}]'.format(repr(header)))
+
+    if flags & (FLAG_CLOSE | FLAG_CANCEL):
+      return (Frame(index, flags), None)
+    if flags & FLAG_WINDOW:
+      return (Frame(index, flags, window=length), None)
+    if flags & FLAG_LINE:
+      return (Frame(index, flags), LINE)
+    return (Frame(index, flags), length)
+
+  def ParseHeader(self, buffer, offset):
+    end = offset + BINARY_HEADER.size
+    if len(buffer) < end:
+      return None
+
+    frame, size = self._ParseHeader(buffer[offset:end])
+    return (frame, size, end)
+
+
+FRAMINGS = {
+    JsonFraming.name: JsonFraming,
+    BinaryFraming.name: BinaryFraming,
+}
+
+
+class FrameDecoder:
+  """Incremental frame decoder.
+
+  Accepts input in chunks of any size using Feed() and hands out complete
+  frames using Next(). The framing is passed to each Next() call since the
+  peer may switch framings in between two frames.
+
+  Chunks are kept as they were fed. A frame's header is decoded as soon as it
+  is complete and its payload is copied out of the chunks once, when all of
+  it has arrived, no matter how many chunks it arrived in.
+  """
+
+  def __init__(self):
+    self.chunks = deque()
+    # Read position within the first chunk.
+    self.offset = 0
+    self.pending = 0
+
+    # Decoded header and payload size of the frame whose payload is still
+    # incomplete.
+    self.frame = None
+    self.size = None
+
+    # How far a newline terminated payload has been searched for its end, as
+    # the index of the next chunk to search and the bytes searched so far.
+    self.scan = (0, 0)
+
+  def Feed(self, data):
+    if data:
+      self.chunks.append(data)
+      self.pending += len(data)
+
+  def Next(self, framing):
+    """Returns the next complete frame, or None if more input is needed."""
+    if self.frame is None and not self._NextHeader(framing):
+      return None
+
+    if self.size is LINE:
+      size = self._ScanLine()
+      if size is None:
+        return None
+    elif self.size is None:
+      size = 0
+    else:
+      size = self.size
+      if self.pending < size:
+        return None
+
+    frame = self.frame
+    if self.size is not None:
+      frame.payload = self._Take(size)
+    self.frame = None
+    self.size = None
+    self.scan = (0, 0)
+    return frame
+
+  def _NextHeader(self, framing):
+    """Decodes the next header. Returns False if it's incomplete."""
+    while self.chunks:
+      result = framing.ParseHeader(self.chunks[0], self.offset)
+      if result is not None:
+        self.frame, self.size, end = result
+        self._Skip(end - self.offset)
+        return True
+      if len(self.chunks) == 1:
+        return False
+
+      # The header straddles two chunks. It's decoded from a copy of the end
+      # of the first one and of just enough of the second, which may be a
+      # large chunk mostly holding the payload.
+      head = self.chunks[0][self.offset:]
+      following = self.chunks[1]
+      size = HEADER_PROBE_SIZE
+      while True:
+        result = framing.ParseHeader(head + following[:size], 0)
+        if result is not None:
+          self.frame, self.size, end = result
+          self._Skip(end)
+          return True
+        if size >= len(following):
+          break
+        size *= 2
+
+      # The header goes on past the second chunk.
+      self.chunks.popleft()
+      self.chunks[0] = head + following
+      self.offset = 0
+    return False
+
+  def _ScanLine(self):
+    """Returns the size of a newline terminated payload, or None if it hasn't
+    been received in full."""
+    index, scanned = self.scan
+    while index < len(self.chunks):
+      chunk = self.chunks[index]
+      start = self.offset if index == 0 else 0
+      newline = chunk.find('\n', start)
+      if newline != -1:
+        return scanned + newline + 1 - start
+      scanned += len(chunk) - start
+      index += 1
+    self.scan = (index, scanned)
+    return None
+
+  def _Skip(self, size):
+    self.pending -= size
+    self.offset += size
+    while self.chunks and self.offset >= len(self.chunks[0]):
+      self.offset -= len(self.chunks.popleft())
+
+  def _Take(self, size):
+    if size == 0:
+      return ''
+    first = self.chunks[0]
+    if self.offset + size <= len(first):
+      if self.offset == 0 and size == len(first):
+        payload = first
+      else:
+        payload = first[self.offset:self.offset + size]
+      self._Skip(size)
+      return payload
+
+    pieces = [first[self.offset:]]
+    remaining = size - len(pieces[0])
+    index = 1
+    while remaining > len(self.chunks[index]):
+      pieces.append(self.chunks[index])
+      remaining -= len(self.chunks[index])
+      index += 1
+    pieces.append(self.chunks[index][:remaining])
+    self._Skip(size)
+    return ''.join(pieces)
+
+  def Pending(self):
+    return self.pending
+
+  def HasPartialFrame(self):
+    if self.frame is not None:
+      return True
+    # Trailing whitespace is tolerated just like stray newlines are.
+    return any(
+        chunk[self.offset if index == 0 else 0:].strip() != ''
+        for (index, chunk) in enumerate(self.chunks))
+
+
+class Compressor:
+  """Compresses the payloads sent in one direction of a pipe.
+
+  Payloads shorter than |threshold| are left alone. The rest are compressed
+  using one zlib stream, so they must be sent in the order they were passed to
+  Compress()."""
+
+  def __init__(self, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+    self.threshold = threshold
+    self.zlib = zlib.compressobj()
+    self.stats = {'frames': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+  def Compress(self, data):
+    """Returns (payload, flags) for |data|."""
+    if len(data) < self.threshold:
+      return (data, 0)
+
+    start = time.time()
+    compressed = (self.zlib.compress(data) +
+                  self.zlib.flush(zlib.Z_SYNC_FLUSH))
+    _Account(self.stats, start, len(data), len(compressed))
+    return (compressed, FLAG_COMPRESSED)
+
+  def Stats(self):
+    return _CompressionStats(self.stats, self.stats['bytes_in'],
+                             self.stats['bytes_out'])
+
+
+class Decompressor:
+  """Inflates compressed payloads in the order they were received."""
+
+  def __init__(self):
+    self.zlib = zlib.decompressobj()
+    self.stats = {'frames': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+
+  def Decompress(self, data):
+    start = time.time()
+    try:
+      inflated = self.zlib.decompress(data)
+    except zlib.error as e:
+      raise IOError('Bad compressed payload: {}'.format(e))
+    _Account(self.stats, start, len(data), len(inflated))
+    return inflated
+
+  def Stats(self):
+    return _CompressionStats(self.stats, self.stats['bytes_out'],
+                             self.stats['bytes_in'])
+
+
+def _Account(stats, start, bytes_in, bytes_out):
+  stats['seconds'] += time.time() - start
+  stats['frames'] += 1
+  stats['bytes_in'] += bytes_in
+  stats['bytes_out'] += bytes_out
+
+
+def _CompressionStats(stats, uncompressed, compressed):
+  stats = dict(stats)
+  stats['ratio'] = float(uncompressed) / compressed if compressed else 0.0
+  return stats
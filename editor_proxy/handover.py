@@ -0,0 +1,89 @@
+"""Hands file descriptors from one process to another over a Unix socket.
+
+Proxies started with --via_zygote or --daemon don't serve their stdin and
+stdout themselves. They pass the descriptors on to a process that has ycmd
+loaded already, using SCM_RIGHTS, followed by a request object. The two then
+exchange newline terminated JSON messages over the same connection.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import json
+import os
+import socket
+from _multiprocessing import recvfd, sendfd
+
+
+def Connect(path):
+  """Connects to the Unix socket |path|. Raises socket.error if nothing
+  listens on it."""
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(path)
+  except socket.error:
+    connection.close()
+    raise
+  return connection
+
+
+def Listen(path):
+  """Returns a socket listening on |path| that only this user can connect to.
+
+  A socket left behind by a process that's gone is replaced. Raises
+  RuntimeError if something is still listening on |path|."""
+  if os.path.exists(path):
+    try:
+      Connect(path).close()
+    except socket.error:
+      os.unlink(path)
+    else:
+      raise RuntimeError('Something is listening on {} already'.format(path))
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  umask = os.umask(0o077)
+  try:
+    listener.bind(path)
+  finally:
+    os.umask(umask)
+  listener.listen(16)
+  return listener
+
+
+def SetCloseOnExec(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def WriteMessage(connection, obj):
+  connection.sendall(json.dumps(obj) + '\n')
+
+
+def ReadMessage(reader):
+  """Returns the next message from |reader|, or None if there's none."""
+  line = reader.readline()
+  return json.loads(line) if line else None
+
+
+def HandOver(connection, fds, request):
+  """Sends |fds| followed by the object |request| over |connection|. Returns a
+  file to read the replies from."""
+  for fd in fds:
+    sendfd(connection.fileno(), fd)
+  WriteMessage(connection, request)
+  return connection.makefile('rb')
+
+
+def TakeOver(connection, count):
+  """Receives |count| descriptors and the request sent by HandOver().
+
+  Returns the descriptors and the request."""
+  fds = [recvfd(connection.fileno()) for _ in range(count)]
+  request = ReadMessage(connection.makefile('rb'))
+  if request is None:
+    for fd in fds:
+      os.close(fd)
+    raise IOError('Connection closed during hand over')
+  return fds, request
@@ -0,0 +1,219 @@
+"""Lets more clients share a proxy by connecting to it over a socket.
+
+Each editor window that starts a proxy of its own gets a ycmd of its own, which
+indexes the same project all over again. A proxy started with --listen SOCKET
+or --listen_tcp PORT also accepts clients on the Unix socket SOCKET or on PORT
+of the loopback interface. They talk the same chunked protocol over the
+connection as a client does over stdin and stdout, and their requests are
+served by the same app. Stream ids, buffer versions and superseded requests
+are kept apart for each client, and the worker pool has the clients take
+turns.
+
+Anyone on the machine can connect to a TCP port, so a TCP client has to send
+the proxy's token first, as a line such as '{"token":"..."}'. The token is
+reported on the out-of-band stream 0 of the proxy's own session, as are the
+socket and the port. Only the user running the proxy can connect to the Unix
+socket, so clients there don't need the token.
+
+Once the session on stdin and stdout is over, the proxy stops accepting
+clients, and exits once the ones that are connected are done.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import hmac
+import json
+import logging
+import os
+import select
+import socket
+import time
+from threading import Lock, Thread, current_thread
+
+from .handover import Listen, SetCloseOnExec
+
+LOOPBACK = '127.0.0.1'
+
+# How long a TCP client has to send the token, in seconds, and how long the
+# line with the token may be.
+AUTH_TIMEOUT = 10.0
+MAX_TOKEN_LINE = 256
+
+
+def ListenTcp(port, host=LOOPBACK):
+  """Returns a socket listening on |port| of |host|. A |port| of 0 picks a
+  free one."""
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind((host, port))
+  listener.listen(16)
+  return listener
+
+
+class Listener:
+  """Serves the clients connecting on a Unix socket or a TCP port with
+  |server|.
+
+  |open_pipe| is called with the input and output file of each connection and
+  returns a ChunkedPipe for them. Clients on TCP have to present |token|
+  first."""
+
+  def __init__(self, server, open_pipe, token):
+    self.server = server
+    self.open_pipe = open_pipe
+    self.token = token
+    self.lock = Lock()
+    self.path = None
+    self.port = None
+    # Listening sockets, mapped to whether their clients need the token.
+    self.sockets = {}
+    self.clients = set()
+    self.count = 0
+    self.thread = None
+    # Written to by Close() to stop accepting clients.
+    self.wake_r = None
+    self.wake_w = None
+
+  def ListenUnix(self, path):
+    """Accepts clients on the Unix socket |path|. Raises RuntimeError if
+    something is listening there already."""
+    self.sockets[Listen(path)] = False
+    self.path = path
+    logging.info('Serving clients on %s', path)
+
+  def ListenTcp(self, port):
+    """Accepts clients on |port| of the loopback interface."""
+    listener = ListenTcp(port)
+    self.sockets[listener] = True
+    self.port = listener.getsockname()[1]
+    logging.info('Serving clients on port %d', self.port)
+
+  def Details(self):
+    """Returns what clients need to know to connect."""
+    details = {}
+    if self.path is not None:
+      details['socket'] = self.path
+    if self.port is not None:
+      details['port'] = self.port
+      details['token'] = self.token
+    return details
+
+  def IsListening(self):
+    return bool(self.sockets)
+
+  def Start(self):
+    (self.wake_r, self.wake_w) = os.pipe()
+    SetCloseOnExec(self.wake_r)
+    SetCloseOnExec(self.wake_w)
+    for listener in self.sockets:
+      SetCloseOnExec(listener.fileno())
+    self.thread = Thread(target=self._Accept)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Close(self):
+    """Stops accepting clients and waits for the connected ones to go away."""
+    if self.thread is None:
+      return
+    os.write(self.wake_w, 'x')
+    self.thread.join()
+    self.thread = None
+    while True:
+      with self.lock:
+        if not self.clients:
+          break
+        client = next(iter(self.clients))
+      client.join()
+    os.close(self.wake_r)
+    os.close(self.wake_w)
+
+  def Stats(self):
+    with self.lock:
+      return {'clients': len(self.clients), 'accepted': self.count}
+
+  def _Accept(self):
+    try:
+      while True:
+        try:
+          readable = select.select(
+              list(self.sockets) + [self.wake_r], [], [])[0]
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          continue
+        if self.wake_r in readable:
+          return
+        for listener in readable:
+          self._Admit(listener)
+    finally:
+      for listener in self.sockets:
+        listener.close()
+      if self.path is not None:
+        os.unlink(self.path)
+
+  def _Admit(self, listener):
+    try:
+      (connection, _) = listener.accept()
+    except socket.error as e:
+      logging.warning("Couldn't accept a client: %s", e)
+      return
+    SetCloseOnExec(connection.fileno())
+
+    with self.lock:
+      self.count += 1
+      name = '{}-{}'.format('tcp' if self.sockets[listener] else 'unix',
+                            self.count)
+      client = Thread(
+          target=self._Serve,
+          args=(connection, name, self.sockets[listener]))
+      client.daemon = True
+      self.clients.add(client)
+    client.start()
+
+  def _Serve(self, connection, name, authenticate):
+    input_file = connection.makefile('rb', 0)
+    output_file = connection.makefile('wb', 0)
+    try:
+      if authenticate and not self._Authenticate(connection):
+        logging.warning('Client %s failed to authenticate', name)
+        return
+
+      logging.info('Client %s connected', name)
+      self.server.Serve(self.open_pipe(input_file, output_file), name)
+      logging.info('Client %s went away', name)
+    except (IOError, OSError, socket.error):
+      logging.exception('Lost client %s', name)
+    finally:
+      for f in (input_file, output_file, connection):
+        f.close()
+      with self.lock:
+        self.clients.discard(current_thread())
+
+  def _Authenticate(self, connection):
+    """Returns True if the client sent the token."""
+    deadline = time.time() + AUTH_TIMEOUT
+    line = ''
+    try:
+      while not line.endswith('\n'):
+        remaining = deadline - time.time()
+        if remaining <= 0 or len(line) >= MAX_TOKEN_LINE:
+          return False
+        connection.settimeout(remaining)
+        # A byte at a time, so that nothing after the line is read.
+        data = connection.recv(1)
+        if not data:
+          return False
+        line += data
+    except socket.timeout:
+      return False
+    finally:
+      connection.settimeout(None)
+
+    try:
+      token = json.loads(line)['token'].encode('utf-8')
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return False
+    return hmac.compare_digest(token, self.token)
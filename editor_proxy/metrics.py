@@ -0,0 +1,170 @@
+"""Instrumentation of the proxy.
+
+Metrics holds counters, histograms and gauges that components update as they
+go. Histograms have fixed, roughly logarithmic buckets, so recording a value is
+cheap and memory doesn't grow with the number of values. Percentiles are
+estimated from the buckets and are only as precise as those are.
+
+PipeServer answers requests for METRICS_PATH itself with a snapshot of its
+metrics and the stats of its components. MetricsDumper writes the same
+snapshot to a file periodically.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import json
+import logging
+import os
+import time
+from threading import Event, Lock, Thread
+
+# Upper bounds of the buckets of latency histograms, in milliseconds. Values
+# above the last bound fall into an overflow bucket.
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+                      5000, 10000, 30000)
+
+# Upper bounds of the buckets of size histograms, in bytes.
+SIZE_BUCKETS = tuple(4**n for n in range(3, 14))
+
+# Most distinct labels kept per histogram. Further labels are counted as
+# OTHER_LABEL, so that unexpected paths can't make the metrics grow forever.
+MAX_LABELS = 64
+OTHER_LABEL = '(other)'
+
+DEFAULT_DUMP_INTERVAL = 60.0
+
+
+class Histogram:
+  """Counts values in buckets with the upper bounds |bounds|."""
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def Record(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def Percentile(self, p):
+    """Returns the upper bound of the bucket holding the |p| quantile.
+
+    Values in the overflow bucket are reported as the largest value seen."""
+    if not self.count:
+      return None
+    rank = p * self.count
+    seen = 0
+    for (bound, count) in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return min(bound, self.max)
+    return self.max
+
+  def Snapshot(self):
+    return {
+        'count': self.count,
+        'mean': self.total / self.count if self.count else None,
+        'min': self.min,
+        'max': self.max,
+        'p50': self.Percentile(0.5),
+        'p90': self.Percentile(0.9),
+        'p99': self.Percentile(0.99),
+        'buckets': [[bound, count]
+                    for (bound, count) in zip(self.bounds + (None,),
+                                              self.counts)
+                    if count]
+    }
+
+
+class Metrics:
+  """Thread safe collection of named counters, histograms and gauges."""
+
+  def __init__(self):
+    self.lock = Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.gauges = {}
+
+  def Add(self, name, value=1):
+    """Adds |value| to the counter |name|. Counters may go down as well."""
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def Observe(self, name, value, label=None, bounds=LATENCY_BUCKETS_MS):
+    """Records |value| in the histogram |name| for |label|.
+
+    |bounds| are the bucket bounds used if the histogram doesn't exist yet."""
+    with self.lock:
+      by_label = self.histograms.setdefault(name, {})
+      histogram = by_label.get(label)
+      if histogram is None:
+        if len(by_label) >= MAX_LABELS:
+          label = OTHER_LABEL
+        histogram = by_label.setdefault(label, Histogram(bounds))
+      histogram.Record(value)
+
+  def Track(self, name, gauge):
+    """Reports the value returned by calling |gauge| as |name|."""
+    with self.lock:
+      self.gauges[name] = gauge
+
+  def Snapshot(self):
+    with self.lock:
+      gauges = self.gauges.items()
+      snapshot = {
+          'counters': dict(self.counters),
+          'histograms': dict(
+              (name, dict((label, histogram.Snapshot())
+                          for (label, histogram) in by_label.items()))
+              for (name, by_label) in self.histograms.items())
+      }
+
+    # Gauges may take locks of their own, so they are read without holding
+    # this one.
+    snapshot['gauges'] = dict((name, gauge()) for (name, gauge) in gauges)
+    return snapshot
+
+
+class MetricsDumper(Thread):
+  """Writes the result of |snapshot| to |path| every |interval| seconds.
+
+  Each dump replaces the previous one. A final dump is written when the
+  thread is stopped."""
+
+  def __init__(self, path, snapshot, interval=DEFAULT_DUMP_INTERVAL):
+    super(MetricsDumper, self).__init__(name='MetricsDumper')
+    self.daemon = True
+    self.path = path
+    self.snapshot = snapshot
+    self.interval = interval
+    self.stopped = Event()
+
+  def Stop(self):
+    self.stopped.set()
+    self.join()
+
+  def Dump(self):
+    data = {'time': time.time(), 'metrics': self.snapshot()}
+    temporary = self.path + '.tmp'
+    try:
+      with open(temporary, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=1)
+      os.rename(temporary, self.path)
+    except (IOError, OSError):
+      logging.exception("Can't write metrics to %s", self.path)
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.Dump()
+    self.Dump()
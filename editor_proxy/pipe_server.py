@@ -10,26 +10,271 @@ from __future__ import print_function
 import sys
 import json
 import logging
+import time
 from StringIO import StringIO
-from threading import Lock, Thread
+from threading import Lock, Thread, active_count
 from collections import deque
-from .chunked import ChunkedFileStream
+from .chunked import BufferedBody, EncodedPayload, RawPayload
+from .coalescer import Coalescer
+from .file_data import BufferCache, DigestCache, NeedContents
+from .framing import Serialize
+from .metrics import SIZE_BUCKETS, Metrics
+from .response_cache import FilepathOf, ResponseCache
+from .worker_pool import (WorkerPool, DEFAULT_PRIORITIES, DEFAULT_WORKERS,
+                          ParsePriority, PriorityForPath)
 
+# Long-poll endpoints would hold on to a pooled worker for the whole poll, so
+# they get a thread of their own instead.
+UNPOOLED_PATHS = frozenset(['/receive_messages'])
 
-class PipeRequestHandler(Thread):
+# Request header that lets the client pick the priority class of a request.
+PRIORITY_HEADER = 'HTTP_X_YCM_PRIORITY'
 
-  def __init__(self, stream, environ, app):
-    super(PipeRequestHandler, self).__init__()
+# WSGI environment key of a function that tells the app whether the client has
+# cancelled the request.
+CANCELLED_KEY = 'editor_proxy.is_cancelled'
+
+DEADLINE_EXCEEDED = '504 Gateway Timeout'
+CONTENTS_NEEDED = '412 Precondition Failed'
+BAD_REQUEST = '400 Bad Request'
+
+# Path answered by PipeServer itself with its metrics and stats.
+METRICS_PATH = '/_proxy/metrics'
+
+# Requests that only ask whether the app is up. They are answered right away
+# while it's still starting instead of waiting for it.
+STARTUP_PATHS = frozenset(['/healthy', '/ready'])
+
+UNAVAILABLE = '503 Service Unavailable'
+
+
+class PooledResponse:
+  """WSGI response that is written out on a worker of |pool| rather than on
+  the one that called the app.
+
+  An app returns it when producing |result| means waiting on something else,
+  such as another process, so that the wait doesn't tie up the workers that
+  run all the other requests."""
+
+  def __init__(self, pool, result):
+    self.pool = pool
+    self.result = result
+
+  def __iter__(self):
+    return iter(self.result)
+
+  def close(self):
+    if hasattr(self.result, 'close'):
+      self.result.close()
+
+
+class _PendingResponse:
+  """Pool item that writes out the PooledResponse |response| of |handler|."""
+
+  def __init__(self, handler, response):
+    self.handler = handler
+    self.response = response
+
+  def Run(self):
+    self.handler.WriteResponse(self.response)
+
+
+def SplicedFrame(obj, body):
+  """Returns the frame |obj| with the serialized JSON |body| as its "o" member.
+
+  |body| is copied into the frame as is. It isn't decoded and encoded again, so
+  it had better be valid JSON."""
+  if isinstance(body, unicode):
+    body = body.encode('utf-8')
+  if not body.strip():
+    body = 'null'
+  return EncodedPayload(Serialize(obj)[:-1] + ',"o":' + body + '}')
+
+
+class PipeClient:
+  """A pipe served by a PipeServer, along with the state the server keeps for
+  it.
+
+  Clients are told apart by |name|. Each has its own BufferCache |buffers|,
+  since versions of buffers are only meaningful to the client that sent them.
+  Requests from different clients don't supersede each other either."""
+
+  def __init__(self, name, pipe, buffers):
+    self.name = name
+    self.pipe = pipe
+    self.buffers = buffers
+    self.connected = time.time()
+    self.requests = 0
+
+    # Requests whose file_data is still to be expanded, in the order they
+    # arrived. Only the thread dispatching the client's requests adds to it.
+    self.expansions = deque()
+    self.lock = Lock()
+    # Held while expanding the requests in |expansions|.
+    self.expanding = Lock()
+
+  def MayExpandNow(self):
+    """True if no request that arrived earlier has its file_data still to be
+    expanded."""
+    with self.lock:
+      return not self.expansions
+
+  def DeferExpansion(self, handler):
+    with self.lock:
+      self.expansions.append(handler)
+
+  def ExpandThrough(self, handler):
+    """Expands the file_data of the deferred requests that arrived up to
+    |handler|, in the order they arrived.
+
+    This waits for the bodies of those requests, and expands them for the
+    workers that run them later."""
+    with self.expanding:
+      while handler.expand_with is not None:
+        with self.lock:
+          earliest = self.expansions[0]
+        earliest.ExpandDeferred()
+        with self.lock:
+          self.expansions.popleft()
+
+  def Stats(self):
+    return {
+        'pipe': self.pipe.Stats() if self.pipe is not None else None,
+        'buffers': self.buffers.Stats(),
+        'requests': self.requests,
+        'connected_seconds': time.time() - self.connected
+    }
+
+
+class PipeRequestHandler:
+
+  def __init__(self,
+               stream,
+               environ,
+               app,
+               splice_json=True,
+               metrics=None,
+               client=None):
     self.stream = stream
     self.environ = environ
     self.app = app
+    self.metrics = metrics
+    self.client = client
 
     self.status = None
     self.headers = None
     self.headers_sent = False
-    self.buffered_body = ''
+    self.buffered_body = []
     self.buffering = False
 
+    # Whether buffered JSON responses are spliced into the response frame
+    # instead of being decoded and encoded again.
+    self.splice_json = splice_json
+
+    # Request body, if it came along with the request header.
+    self.body = None
+
+    # Time by which the client no longer cares about the response.
+    self.deadline = None
+
+    # Whether file_data may leave out buffer contents, and the versions to
+    # acknowledge in the status frame of the response.
+    self.elided_file_data = False
+    self.acks = None
+    # Set by DeferExpansion() to the client and DigestCache to expand
+    # file_data with once the request runs, and the error doing so.
+    self.expand_with = None
+    self.expand_error = None
+
+    # Set by Coalesce() if newer requests may supersede this one.
+    self.coalescer = None
+    self.coalesce_key = None
+    # When the request arrived, as told by the coalescer.
+    self.arrival = None
+    # Set by CoalesceOnRun() if the body wasn't in when the request was queued.
+    self.run_coalescer = None
+
+    # Priority class the request was queued with.
+    self.priority = None
+
+    # Set by RecordFor() if the response should be cached.
+    self.cache = None
+    self.cache_key = None
+    self.recorded = None
+
+    # Set by InvalidateOnRun() to the cache held until the file the request
+    # is about is known.
+    self.invalidates = None
+
+  def RecordFor(self, cache, key):
+    """Records the response so that it can be stored in |cache| as |key|.
+
+    Frames are recorded as the arguments to Write(), so that replaying them
+    adds the acks of the request they are replayed for."""
+    self.cache = cache
+    self.cache_key = key
+    self.recorded = []
+
+  def InvalidateOnRun(self, cache):
+    """Drops the responses in |cache| for the file named in the body once the
+    request runs. Until then |cache| replays nothing."""
+    cache.Hold()
+    self.invalidates = cache
+
+  def _Invalidate(self, filepath):
+    cache, self.invalidates = self.invalidates, None
+    if cache is not None:
+      cache.Release(filepath)
+
+  def Coalesce(self, coalescer):
+    """Lets the request supersede an older queued request for the same thing,
+    and be superseded by a newer one, as told by |coalescer|.
+
+    Requests are only comparable by their body, so this waits for it."""
+    self.ReadBody()
+    path = self.environ['PATH_INFO']
+    key = coalescer.Key(path, self.body, self.client.name)
+    if key is None:
+      return
+
+    self.coalescer = coalescer
+    self.coalesce_key = key
+    superseded = coalescer.Admit(key, self, self.arrival)
+    if superseded is not None:
+      superseded.Supersede()
+
+  def CoalesceOnRun(self, coalescer):
+    """Calls Coalesce() right before the request runs instead of now.
+
+    The request then can't be superseded while it's queued, but waiting for
+    its body doesn't hold up the thread queueing it. It's superseded once it
+    runs if a request that arrived after it is still queued."""
+    self.run_coalescer = coalescer
+
+  def Supersede(self):
+    """Answers the request with a stand-in response for a superseded one."""
+    path = self.environ['PATH_INFO']
+    logging.debug('Request %r superseded', self.stream)
+    self.Write(self.coalescer.SupersededResponse(path, self.body))
+    self.Close()
+
+  def Write(self, obj, body=None):
+    """Writes the frame |obj|. If |body| is set, it's the serialized JSON to
+    send as the "o" member of the frame."""
+    if self.recorded is not None:
+      self.recorded.append((obj, body))
+    if self.acks and 'st' in obj:
+      # Acks are specific to this request, so they aren't recorded.
+      obj = dict(obj, fd=self.acks)
+      self.acks = None
+    self.stream.Write(obj if body is None else SplicedFrame(obj, body))
+
+  def Replay(self, recorded):
+    """Answers the request with the frames |recorded| for an earlier one."""
+    for (obj, body) in recorded:
+      self.Write(obj, body)
+    self.Close()
+
   def SendHeadersIfNotBuffering(self):
     if self.headers_sent or self.buffering:
       return
@@ -38,10 +283,10 @@ class PipeRequestHandler(Thread):
     d = dict()
     d['st'] = self.status
     d['h'] = self.headers
-    self.stream.Write(d)
+    self.Write(d)
 
   def OnStartResponse(self, status, headers, exc_info):
-    logging.debug('start_response(%s, %s)', repr(status), repr(headers))
+    logging.debug('start_response(%r, %r)', status, headers)
     if exc_info:
       try:
         if self.headers_sent:
@@ -64,36 +309,37 @@ class PipeRequestHandler(Thread):
     self.SendHeadersIfNotBuffering()
 
     if self.buffering:
-      self.buffered_body += data
+      self.buffered_body.append(data)
       return
 
-    d = dict()
-    d['d'] = data
-    self.stream.Write(d)
+    self.Write(RawPayload(data))
 
-  def run(self):
+  def ReadRequest(self):
+    """Reads the request header and sets up the WSGI environment.
 
+    Returns False if the request is malformed, in which case the stream is
+    closed."""
     try:
       head = self.stream.Read()
-      logging.debug('Received headers %s', repr(head))
+      logging.debug('Received headers %r', head)
 
       assert head is not None, 'Unexpected EOF while reading request header'
       assert 'p' in head, '"p" not found in header object: {}'.format(
           repr(head))
 
       if 'd' in head:
-        data = body.get('d', '')
+        data = head.get('d', '')
         bodystream = StringIO(data)
       elif 'o' in head:
-        data = json.dumps(body.get('o'))
+        data = json.dumps(head.get('o'))
         bodystream = StringIO(data)
       else:
         data = None
-        bodystream = ChunkedFileStream(self.stream)
+        bodystream = BufferedBody(self.stream)
 
     except:
-      self.stream.Close()
-      return
+      self.Close()
+      return False
 
     environ = dict(self.environ.items())
     environ['wsgi.errors'] = sys.stderr
@@ -101,6 +347,7 @@ class PipeRequestHandler(Thread):
     environ['REQUEST_METHOD'] = head.get('m', 'GET')
     environ['PATH_INFO'] = head.get('p', '/')
     environ['QUERY_STRING'] = head.get('q', '')
+    environ[CANCELLED_KEY] = self.stream.IsCancelled
     if data is not None:
       environ['CONTENT_LENGTH'] = len(data)
 
@@ -108,36 +355,248 @@ class PipeRequestHandler(Thread):
       key_with_underscores = k.upper().replace('-', '_')
       environ['HTTP_{}'.format(key_with_underscores)] = v
 
+    # The deadline is relative to when the request arrived, since the clocks on
+    # either end of the pipe needn't agree.
+    if 'dl' in head:
+      self.deadline = self.stream.created + float(head['dl']) / 1000
+    self.elided_file_data = bool(head.get('fd'))
+
+    self.environ = environ
+    self.body = data
+    return True
+
+  def ReadBody(self):
+    """Reads the whole request body unless it came with the header."""
+    if self.body is not None:
+      return
+
+    bodystream = self.environ['wsgi.input']
+    chunks = []
+    while True:
+      chunk = bodystream.read()
+      if not chunk:
+        break
+      chunks.append(chunk)
+
+    self.body = ''.join(chunks)
+    self.environ['wsgi.input'] = StringIO(self.body)
+    self.environ['CONTENT_LENGTH'] = len(self.body)
+
+  def ExpandFileData(self, buffers, digests):
+    """Rebuilds file_data using the BufferCache |buffers| and the DigestCache
+    |digests|.
+
+    Returns False if the request can't be served, in which case it has
+    already been answered."""
+    error = self._Expand(buffers, digests)
+    if error is None:
+      return True
+    (status, message, fields) = error
+    self.Reject(status, message, **fields)
+    return False
+
+  def DeferExpansion(self, client, digests):
+    """Expands file_data once the request runs instead of now, after the
+    requests from |client| that arrived before it."""
+    self.expand_with = (client, digests)
+    client.DeferExpansion(self)
+
+  def ExpandDeferred(self):
+    """Expands the file_data of a request passed to DeferExpansion(), without
+    answering it if that fails."""
+    (client, digests) = self.expand_with
+    self.expand_error = self._Expand(client.buffers, digests)
+    self.expand_with = None
+
+  def _ExpandOnRun(self):
+    """Returns False if the request has been answered since its file_data
+    couldn't be expanded."""
+    self.expand_with[0].ExpandThrough(self)
+    if self.expand_error is None:
+      return True
+    (status, message, fields) = self.expand_error
+    self.Reject(status, message, **fields)
+    return False
+
+  def _Expand(self, buffers, digests):
+    """Rebuilds file_data. Returns None, or the status, message and fields to
+    reject the request with."""
+    self.ReadBody()
+    try:
+      request = json.loads(self.body)
+      self.acks = buffers.Expand(request, digests)
+    except NeedContents as e:
+      return (CONTENTS_NEEDED, str(e), {'need_contents': e.filepaths})
+    except (ValueError, TypeError, AttributeError) as e:
+      return (BAD_REQUEST, 'Bad file_data: {}'.format(e), {})
+
+    self.body = json.dumps(request)
+    self.environ['wsgi.input'] = StringIO(self.body)
+    self.environ['CONTENT_LENGTH'] = len(self.body)
+    return None
+
+  def Respond(self, status, body):
+    """Answers the request with the JSON |body| without running it."""
+    self.Write({
+        'st': status,
+        'h': [('Content-Type', 'application/json')],
+        'o': body
+    })
+    self.Close()
+
+  def Reject(self, status, message, **fields):
+    """Answers the request with an error without running it."""
+    self.Respond(status, dict(fields, message=message))
+
+  def Close(self):
+    """Closes the stream and records how long the request took."""
+    # A request that didn't run never told the app about the file.
+    self._Invalidate(None)
+    self.stream.Close()
+    if self.metrics is None:
+      return
+
+    stream = self.stream
+    path = self.environ.get('PATH_INFO')
+    self.metrics.Add('requests')
+    self.metrics.Observe('total_ms', (time.time() - stream.created) * 1000,
+                         path)
+    if stream.first_write is not None:
+      self.metrics.Observe('first_byte_ms',
+                           (stream.first_write - stream.created) * 1000, path)
+    self.metrics.Observe('request_bytes', stream.bytes_in, path, SIZE_BUCKETS)
+    self.metrics.Observe('response_bytes', stream.bytes_out, path,
+                         SIZE_BUCKETS)
+
+  def IsExpired(self):
+    return self.deadline is not None and time.time() >= self.deadline
+
+  def Abandon(self):
+    """Skips running the request if the client no longer wants the response.
+
+    Returns True if the request was abandoned."""
+    if self.stream.IsCancelled():
+      logging.debug('Dropping cancelled request %r', self.stream)
+      self.Close()
+      return True
+
+    if self.IsExpired():
+      logging.debug('Rejecting expired request %r', self.stream)
+      self.Reject(DEADLINE_EXCEEDED,
+                  'Deadline exceeded before the request was handled')
+      return True
+
+    return False
+
+  def Run(self):
+    if self.expand_with is not None and not self._ExpandOnRun():
+      return
+    if self.invalidates is not None:
+      self.ReadBody()
+      self._Invalidate(FilepathOf(self.body))
+    if self.run_coalescer is not None:
+      self.Coalesce(self.run_coalescer)
+    if (self.coalescer is not None and
+        not self.coalescer.Start(self.coalesce_key, self)):
+      # A newer request took over and this one has already been answered.
+      return
+
+    if self.Abandon():
+      return
+
+    if self.metrics is None:
+      self._Run()
+      return
+
+    self.metrics.Add('running_handlers')
+    try:
+      self._Run()
+    finally:
+      self.metrics.Add('running_handlers', -1)
+
+  def _Run(self):
+    environ = self.environ
+
     def start_response(s, h, e=None):
       return self.OnStartResponse(s, h, e)
 
     result = self.app(environ, start_response)
+    if isinstance(result, PooledResponse):
+      result.pool.Submit(
+          _PendingResponse(self, result), self.priority, self.client.name)
+      return
+    self.WriteResponse(result)
+
+  def WriteResponse(self, result):
+    """Writes out the WSGI response |result| and closes the stream."""
     try:
 
       for data in result:
+        if self.stream.IsCancelled():
+          return
         if data:
           self.OnWrite(data)
       if not self.headers_sent:
         self.OnWrite('')
 
+      if self.stream.IsCancelled():
+        return
+
       if self.buffering:
         d = dict()
         d['st'] = self.status
         d['h'] = self.headers
-        d['o'] = json.loads(self.buffered_body)
-        self.stream.Write(d)
+        body = ''.join(self.buffered_body)
+        if self.splice_json:
+          self.Write(d, body)
+        else:
+          d['o'] = json.loads(body)
+          self.Write(d)
+
+      if self.recorded is not None and self.status.startswith('200'):
+        self.cache.Put(self.cache_key, self.recorded, FilepathOf(self.body))
 
     finally:
       if hasattr(result, 'close'):
         result.close()
-      self.stream.Close()
+      self.Close()
 
 
 class PipeServer:
-
-  def __init__(self, app, pipe):
+  """Serves the requests arriving on |pipe| using the WSGI app |app|.
+
+  |app| may be None while the app is still being loaded. Requests are then
+  held until SetApp() is called, except for requests to STARTUP_PATHS, which
+  are answered with a 503 right away."""
+
+  def __init__(self,
+               app,
+               pipe,
+               workers=DEFAULT_WORKERS,
+               priorities=DEFAULT_PRIORITIES,
+               cache=None,
+               coalescer=None,
+               buffers=None,
+               digests=None,
+               splice_json=True,
+               metrics=None):
     self.app = app
+    self.lock = Lock()
+    self.waiting = []
+    self.startup_error = None
+    self.splice_json = splice_json
+    self.metrics = metrics if metrics is not None else Metrics()
+    self.metrics.Track('threads', active_count)
+    self.priorities = priorities
+    self.cache = cache if cache is not None else ResponseCache()
+    self.coalescer = coalescer if coalescer is not None else Coalescer()
+    self.buffers = buffers if buffers is not None else BufferCache()
+    self.digests = digests if digests is not None else DigestCache()
     self.request_map = {}
+    # The client served by Serve() without a name, and the named ones that are
+    # connected.
+    self.default_client = PipeClient(None, pipe, self.buffers)
+    self.clients = {}
     self.base_environ = {
         'wsgi.version': (1, 0),
         'wsgi.multithread': True,
@@ -152,16 +611,208 @@ class PipeServer:
         'HTTP_HOST': 'localhost'
     }
     self.pipe = pipe
+    self.pool = WorkerPool(workers)
+    self.pool.Start()
+
+  def DispatchRequest(self, stream, client=None):
+    if client is None:
+      client = self.default_client
+    handler = PipeRequestHandler(stream, self.base_environ, self.app,
+                                 self.splice_json, self.metrics, client)
+    if not handler.ReadRequest():
+      return
+    client.requests += 1
+
+    path = handler.environ['PATH_INFO']
+    if path == METRICS_PATH:
+      handler.Respond('200 OK', self.Stats())
+      return
 
-  def DispatchRequest(self, stream):
-    t = PipeRequestHandler(stream, self.base_environ, self.app)
-    t.start()
+    if path in STARTUP_PATHS and self.app is None:
+      if self.startup_error is None:
+        handler.Respond(UNAVAILABLE, {'state': 'starting'})
+      else:
+        handler.Reject(UNAVAILABLE, self.startup_error, state='failed')
+      return
+
+    # Deltas have to be applied in the order the requests arrived, since a
+    # request may build on a version stored by the one before it. Waiting here
+    # for a body that's still on its way would hold up the requests behind
+    # this one, so then the request's worker expands it.
+    if handler.elided_file_data:
+      if handler.body is None or not client.MayExpandNow():
+        handler.DeferExpansion(client, self.digests)
+      elif not handler.ExpandFileData(client.buffers, self.digests):
+        return
+
+    priority = ParsePriority(handler.environ.get(PRIORITY_HEADER))
+    if priority is None:
+      priority = PriorityForPath(path, self.priorities)
+    stream.SetPriority(priority)
+
+    if handler.Abandon() or self._ServeFromCache(handler):
+      return
+
+    self._Coalesce(handler)
+
+    with self.lock:
+      if self.app is None and self.startup_error is None:
+        self.waiting.append((handler, priority))
+        return
+    self._Start(handler, priority)
+
+  def _Start(self, handler, priority):
+    if self.app is None:
+      handler.Reject(UNAVAILABLE, self.startup_error, state='failed')
+      return
+
+    handler.app = self.app
+    handler.priority = priority
+    if handler.environ['PATH_INFO'] in UNPOOLED_PATHS:
+      Thread(target=handler.Run).start()
+      return
+
+    self.pool.Submit(handler, priority, handler.client.name)
+    # Cancelled requests don't wait for a worker to find out.
+    handler.stream.OnCancel(lambda: self._Withdraw(handler))
+
+  def _Withdraw(self, handler):
+    """Answers the cancelled request |handler| if it's still queued."""
+    if not self.pool.Remove(handler):
+      # A worker has it already, and sees that it's cancelled.
+      return
+    if (handler.coalescer is not None and
+        not handler.coalescer.Forget(handler.coalesce_key, handler)):
+      # It has been answered when it was superseded.
+      return
+    handler.Abandon()
+
+  def SetApp(self, app):
+    """Starts serving requests using |app|, including the ones that arrived
+    while there was no app."""
+    with self.lock:
+      self.app = app
+      waiting, self.waiting = self.waiting, []
+    logging.debug('Releasing %d requests held during startup', len(waiting))
+    for (handler, priority) in waiting:
+      self._Start(handler, priority)
+
+  def FailStartup(self, message):
+    """Answers requests with a 503 and |message| since the app couldn't be
+    started."""
+    with self.lock:
+      self.startup_error = message
+      waiting, self.waiting = self.waiting, []
+    for (handler, priority) in waiting:
+      self._Start(handler, priority)
+
+  def _ServeFromCache(self, handler):
+    """Replays a cached response if there is one. Returns True if it did.
+
+    Otherwise arranges for the response to be cached if it can be."""
+    environ = handler.environ
+    path = environ['PATH_INFO']
+    if path == '/event_notification':
+      if handler.body is None:
+        # The file it's about is only known once the whole body is in, and
+        # waiting for it here would hold up the requests behind this one.
+        handler.InvalidateOnRun(self.cache)
+      else:
+        filepath = FilepathOf(handler.body)
+        if filepath is not None:
+          self.cache.Invalidate(filepath)
+
+    if handler.expand_with is not None:
+      # The body isn't what the app gets until its file_data is expanded.
+      return False
+
+    body = handler.body
+    if body is None:
+      # The body is still on its way. That's only known to be empty for GETs.
+      if environ['REQUEST_METHOD'] != 'GET':
+        return False
+      body = ''
+
+    key = self.cache.Key(environ['REQUEST_METHOD'], path,
+                         environ['QUERY_STRING'], body)
+    if key is None:
+      return False
+
+    recorded = self.cache.Get(key)
+    if recorded is None:
+      handler.RecordFor(self.cache, key)
+      return False
+
+    handler.Replay(recorded)
+    return True
+
+  def _Coalesce(self, handler):
+    """Lets |handler| supersede an older queued request for the same thing."""
+    path = handler.environ['PATH_INFO']
+    if not self.coalescer.IsCoalesced(path):
+      return
+
+    handler.arrival = self.coalescer.Arrive()
+
+    # Waiting here for a body that's still on its way would hold up the
+    # requests behind this one. Nor can requests be compared before their
+    # file_data is expanded.
+    if handler.body is None or handler.expand_with is not None:
+      handler.CoalesceOnRun(self.coalescer)
+    else:
+      handler.Coalesce(self.coalescer)
+
+  def Stats(self):
+    with self.lock:
+      clients = self.clients.items()
+    return {
+        'pool': self.pool.Stats(),
+        'pipe': self.pipe.Stats() if self.pipe is not None else None,
+        'clients': dict((name, client.Stats()) for (name, client) in clients),
+        'cache': self.cache.Stats(),
+        'coalescer': self.coalescer.Stats(),
+        'buffers': self.buffers.Stats(),
+        'digests': self.digests.Stats(),
+        'metrics': self.metrics.Snapshot(),
+        'state': self.State()
+    }
+
+  def State(self):
+    """Returns 'starting', 'ready' or 'failed'."""
+    if self.app is not None:
+      return 'ready'
+    return 'starting' if self.startup_error is None else 'failed'
 
   def Shutdown(self):
-    pass
+    self.pool.Shutdown()
+
+  def Serve(self, pipe, name=None):
+    """Serves the requests arriving on |pipe| until its input ends and all
+    responses went out.
+
+    The server keeps its app and its caches afterwards, so it can go on to
+    serve another pipe. Pipes with a |name| are served as separate clients,
+    which may be served at the same time as others. Stats() reports on each of
+    those under 'clients', and on the last pipe without a name under 'pipe'."""
+    if name is None:
+      self.pipe = pipe
+      client = self.default_client
+      client.pipe = pipe
+    else:
+      client = PipeClient(name, pipe, BufferCache())
+      with self.lock:
+        self.clients[name] = client
+
+    try:
+      for stream in pipe:
+        logging.debug('Starting %r', stream)
+        self.DispatchRequest(stream, client)
+      pipe.Join()
+    finally:
+      if name is not None:
+        with self.lock:
+          del self.clients[name]
 
   def Run(self):
-    for stream in self.pipe:
-      logging.debug('Starting %s', repr(stream))
-      self.DispatchRequest(stream)
-    self.pipe.Close()
+    self.Serve(self.pipe)
+    self.Shutdown()
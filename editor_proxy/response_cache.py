@@ -0,0 +1,146 @@
+"""Cache of responses to idempotent ycmd requests.
+
+Editors poll endpoints such as /healthy and /debug_info much more often than
+their answers change. PipeServer looks requests up here before they are handed
+to the WSGI app and replays the recorded response frames on a hit.
+
+Only paths on the allowlist are cached, each for its own time to live. Entries
+are keyed by method, path, query string and a hash of the request body after
+normalizing its JSON. Entries for requests that named a file are dropped when
+an /event_notification arrives for that file. Until the body of a notification
+is in, and the file it's about known, no entry is replayed at all.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# Cacheable paths, and how many seconds a response for each stays fresh.
+DEFAULT_ALLOWLIST = {
+    '/healthy': 1.0,
+    '/ready': 1.0,
+    '/defined_subcommands': 30.0,
+    '/debug_info': 5.0,
+}
+
+DEFAULT_MAX_ENTRIES = 128
+
+
+def NormalizedBody(data):
+  """Returns |data| in a form that doesn't depend on JSON formatting."""
+  if not data:
+    return ''
+  try:
+    return json.dumps(json.loads(data), sort_keys=True, separators=(',', ':'))
+  except ValueError:
+    return data
+
+
+def FilepathOf(data):
+  """Returns the 'filepath' field of a JSON request body, if any."""
+  try:
+    body = json.loads(data) if data else None
+  except ValueError:
+    return None
+  if isinstance(body, dict):
+    return body.get('filepath')
+  return None
+
+
+class CacheEntry:
+
+  def __init__(self, frames, expires, filepath):
+    self.frames = frames
+    self.expires = expires
+    self.filepath = filepath
+
+
+class ResponseCache:
+  """LRU cache of recorded response frames.
+
+  |allowlist| maps cacheable paths to the time to live of their entries in
+  seconds. At most |max_entries| entries are kept."""
+
+  def __init__(self,
+               allowlist=DEFAULT_ALLOWLIST,
+               max_entries=DEFAULT_MAX_ENTRIES,
+               clock=time.time):
+    self.allowlist = allowlist
+    self.max_entries = max_entries
+    self.clock = clock
+    self.lock = Lock()
+    self.entries = OrderedDict()
+    # Number of invalidations whose file isn't known yet.
+    self.held = 0
+    self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+  def Key(self, method, path, query, data):
+    """Returns the cache key for a request, or None if it isn't cacheable."""
+    if path not in self.allowlist:
+      return None
+    digest = hashlib.sha1(NormalizedBody(data)).hexdigest()
+    return (method, path, query, digest)
+
+  def Get(self, key):
+    """Returns the frames recorded for |key|, or None."""
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None and entry.expires <= self.clock():
+        entry = None
+      elif entry is not None and self.held:
+        self.entries[key] = entry
+        entry = None
+      if entry is None:
+        self.stats['misses'] += 1
+        return None
+
+      # Re-inserting moves the entry to the most recently used end.
+      self.entries[key] = entry
+      self.stats['hits'] += 1
+      return entry.frames
+
+  def Put(self, key, frames, filepath=None):
+    ttl = self.allowlist[key[1]]
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = CacheEntry(frames, self.clock() + ttl, filepath)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.stats['evictions'] += 1
+
+  def Invalidate(self, filepath):
+    """Drops all entries for requests about |filepath|."""
+    with self.lock:
+      stale = [
+          key for (key, entry) in self.entries.items()
+          if entry.filepath == filepath
+      ]
+      for key in stale:
+        del self.entries[key]
+      self.stats['invalidations'] += len(stale)
+
+  def Hold(self):
+    """Stops replaying entries until Release() is called, for an invalidation
+    of a file that isn't known yet."""
+    with self.lock:
+      self.held += 1
+
+  def Release(self, filepath):
+    """Invalidates |filepath| unless it's None, and ends a Hold()."""
+    if filepath is not None:
+      self.Invalidate(filepath)
+    with self.lock:
+      self.held -= 1
+
+  def Stats(self):
+    with self.lock:
+      stats = dict(self.stats)
+      stats['entries'] = len(self.entries)
+      stats['held'] = self.held
+      return stats
@@ -0,0 +1,167 @@
+"""ChunkedPipe engine that services both directions of the pipe on one thread.
+
+The default engine runs an InputDispatchThread and an OutputDispatchThread for
+each pipe, and every frame written by a handler crosses a condition variable
+before it reaches the output file. SelectPipe instead multiplexes the input and
+output file descriptors with select() on a single EventLoopThread. Input is
+read in bulk and decoded incrementally. Handler threads wake the loop through a
+self-pipe, at most once for however many frames they queue in the meantime.
+
+Output is written whenever the output descriptor is writable, so a FlushPolicy
+doesn't apply to this engine. Both files must be backed by real file
+descriptors.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import fcntl
+import logging
+import os
+import select
+from threading import Lock
+
+from .chunked import READ_SIZE, ChunkedPipe, OutputDispatchThread
+
+
+class EventLoopThread(OutputDispatchThread):
+  """OutputDispatchThread that also reads and dispatches the pipe's input."""
+
+  def __init__(self, input_file, output_file, dispatcher):
+    super(EventLoopThread, self).__init__(output_file)
+    # The file is only read through its descriptor, but it has to be kept
+    # around since the descriptor is closed along with it.
+    self.input_file = input_file
+    self.input_fd = input_file.fileno()
+    self.output_fd = output_file.fileno()
+    self.dispatcher = dispatcher
+    self.outbuf = ''
+
+    self.wake_lock = Lock()
+    self.woken = False
+    self.wake_r, self.wake_w = os.pipe()
+
+  def _Put(self, v, control=False):
+    super(EventLoopThread, self)._Put(v, control)
+    self._Wake()
+
+  def Quit(self):
+    super(EventLoopThread, self).Quit()
+    self._Wake()
+
+  def _Wake(self):
+    with self.wake_lock:
+      if self.woken:
+        return
+      self.woken = True
+    os.write(self.wake_w, 'x')
+
+  def _ReadInput(self):
+    """Reads and dispatches available input. Returns False at EOF."""
+    try:
+      data = os.read(self.input_fd, READ_SIZE)
+    except OSError as e:
+      if e.errno in (errno.EINTR, errno.EAGAIN):
+        return True
+      raise
+
+    if data:
+      try:
+        self.dispatcher.Feed(data)
+        return True
+      except (IOError, ValueError):
+        logging.exception("Can't process input stream.")
+
+    logging.debug('Done with input')
+    self.dispatcher.Drain()
+    return False
+
+  def _WriteOutput(self):
+    if self.broken:
+      self.outbuf = ''
+      return
+    try:
+      written = os.write(self.output_fd, self.outbuf)
+    except OSError as e:
+      if e.errno in (errno.EINTR, errno.EAGAIN):
+        return
+      self._OutputFailed(e)
+      self.outbuf = ''
+      return
+    self.outbuf = self.outbuf[written:]
+    self.stats['flushes'] += 1
+
+  def run(self):
+    flags = fcntl.fcntl(self.output_fd, fcntl.F_GETFL)
+    fcntl.fcntl(self.output_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    input_open = True
+    closing = False
+    try:
+      while not closing or self.outbuf or self._Busy():
+        readers = [self.wake_r]
+        if input_open:
+          readers.append(self.input_fd)
+        writers = [self.output_fd] if self.outbuf else []
+        # Don't block if there's scheduled output that hasn't been encoded.
+        timeout = 0 if self._Busy() and not self.outbuf else None
+        readable, _, _ = select.select(readers, writers, [], timeout)
+
+        if self.input_fd in readable:
+          input_open = self._ReadInput()
+
+        if self.wake_r in readable:
+          # Drain the wake-up pipe *before* clearing the flag. Otherwise a
+          # wake-up that lands in between would be swallowed.
+          os.read(self.wake_r, READ_SIZE)
+          with self.wake_lock:
+            self.woken = False
+
+          while not closing:
+            batch = self.channel.TryGetAll()
+            if batch is None:
+              closing = True
+            elif not batch:
+              break
+            else:
+              self._Process(batch)
+
+        # Only schedule as much as the output can take right away, so that
+        # urgent frames queued meanwhile still get to go ahead of bulk data.
+        if not self.outbuf:
+          self._Schedule()
+        if self.pending:
+          self.outbuf += self._TakeOutput()
+
+        # The descriptor is non-blocking, so there's no need to wait for
+        # select() before trying to get rid of fresh output.
+        if self.outbuf:
+          self._WriteOutput()
+
+    except ValueError as e:
+      raise ValueError('While writing: {}'.format(e.message))
+
+    finally:
+      self._Finish()
+      self.outbuf += self._TakeOutput()
+      fcntl.fcntl(self.output_fd, fcntl.F_SETFL, flags)
+      while self.outbuf:
+        self._WriteOutput()
+      os.close(self.wake_r)
+      os.close(self.wake_w)
+
+
+class SelectPipe(ChunkedPipe):
+  """ChunkedPipe driven by a single select() loop.
+
+  |flush_policy| is accepted for compatibility and ignored.
+  """
+
+  def _StartDispatch(self, input_file, output_file, flush_policy):
+    output_file.flush()
+    self.output_thread = EventLoopThread(input_file, output_file,
+                                         self.input_dispatcher)
+    self.input_thread = None
+    self.output_thread.start()
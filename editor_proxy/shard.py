@@ -0,0 +1,430 @@
+"""Spreads requests over several ycmd processes behind one pipe.
+
+All of ycmd's request handlers share one interpreter, so a slow semantic
+request for one filetype holds up everything else on the GIL. With --shards N
+the proxy doesn't load ycmd itself. It starts N proxies of its own, the shards,
+each running ycmd in a separate process, and serves the client's pipe with a
+ShardedApp that relays every request to one of them.
+
+The shards are ordinary proxies talking the chunked protocol on their stdin
+and stdout. The proxy in front of them opens a stream on a shard's pipe for
+each request, and copies the response back. Response caching, coalescing and
+file_data deltas are dealt with in front, so the shards always see complete
+requests. The front proxy's workers only pick the shard. Each shard has
+workers of its own that wait for its responses, so a slow shard doesn't hold
+up requests for the others.
+
+Requests are routed by a key taken from the request, either its filetype or
+its project root. Each new key is assigned to the shard with the fewest keys,
+and sticks to it, since that's where its parsed files are. Requests without a
+key go to the default shard. Requests that change state every ycmd has, such
+as /shutdown, go to every shard.
+
+A shard that exits is started again after a delay that grows while it keeps
+crashing. Requests for it wait until it's back, for up to SEND_TIMEOUT seconds.
+They are answered with a 502 after that, and so are the ones it was working
+on.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import subprocess
+import time
+from threading import Condition, Event, Lock, Thread
+from urlparse import parse_qs
+
+from .chunked import ChunkedPipe, RawPayload
+from .pipe_server import PooledResponse, SplicedFrame
+from .worker_pool import DEFAULT_WORKERS, WorkerPool
+
+DEFAULT_SHARD = 0
+
+# Requests that are sent to every shard. Only the response of the default
+# shard makes it to the client.
+BROADCAST_PATHS = frozenset(
+    ['/shutdown', '/load_extra_conf_file', '/ignore_extra_conf_file'])
+
+BAD_GATEWAY = '502 Bad Gateway'
+
+# Files and directories found at the root of a project.
+PROJECT_MARKERS = ('.git', '.hg', '.svn', '.ycm_extra_conf.py',
+                   'compile_commands.json')
+
+# How long to wait before starting a shard that exited, in seconds. The delay
+# doubles with each exit up to MAX_RESTART_DELAY, and starts over once a shard
+# has been running for STABLE_SECONDS.
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+STABLE_SECONDS = 60.0
+
+# How long a stopped shard gets to exit before it's killed, in seconds.
+STOP_TIMEOUT = 5.0
+
+# How long a request waits for a shard that isn't running, in seconds.
+SEND_TIMEOUT = 10.0
+
+
+def FiletypeKey(environ, request):
+  """Returns the filetype of the file a request is about.
+
+  Falls back to the 'subserver' query parameter used by /ready and
+  /healthy."""
+  try:
+    return request['file_data'][request['filepath']]['filetypes'][0]
+  except (KeyError, IndexError, TypeError):
+    pass
+  subserver = parse_qs(environ.get('QUERY_STRING', '')).get('subserver')
+  return subserver[0] if subserver else None
+
+
+class ProjectRoots:
+  """Returns the root of the project the file a request is about is in.
+
+  That's the closest directory above the file which has one of the
+  PROJECT_MARKERS in it. Files outside of any project have no key."""
+
+  def __init__(self, markers=PROJECT_MARKERS):
+    self.markers = markers
+    self.lock = Lock()
+    self.roots = {}
+
+  def __call__(self, environ, request):
+    try:
+      filepath = request['filepath']
+    except (KeyError, TypeError):
+      return None
+    if not filepath:
+      return None
+    return self.RootOf(os.path.dirname(filepath))
+
+  def RootOf(self, directory):
+    with self.lock:
+      if directory in self.roots:
+        return self.roots[directory]
+
+    root = None
+    candidate = directory
+    while True:
+      if any(
+          os.path.exists(os.path.join(candidate, marker))
+          for marker in self.markers):
+        root = candidate
+        break
+      parent = os.path.dirname(candidate)
+      if parent == candidate:
+        break
+      candidate = parent
+
+    with self.lock:
+      self.roots[directory] = root
+    return root
+
+
+class ShardRouter:
+  """Picks one of |count| shards for each request, using |key| to tell which
+  requests belong together.
+
+  |key| is called with the WSGI environment and the decoded request body, and
+  returns None for requests that go to the default shard."""
+
+  def __init__(self, count, key):
+    self.count = count
+    self.key = key
+    self.lock = Lock()
+    self.assigned = {}
+
+  def ShardFor(self, environ, request):
+    key = self.key(environ, request)
+    if key is None or self.count == 1:
+      return DEFAULT_SHARD
+
+    with self.lock:
+      index = self.assigned.get(key)
+      if index is None:
+        # The default shard counts as having a key already, since it gets the
+        # requests without one.
+        load = [0] * self.count
+        load[DEFAULT_SHARD] += 1
+        for assigned in self.assigned.values():
+          load[assigned] += 1
+        index = load.index(min(load))
+        self.assigned[key] = index
+        logging.info('Routing %s to shard %d', key, index)
+    return index
+
+  def Stats(self):
+    with self.lock:
+      return dict(self.assigned)
+
+
+class Shard:
+  """Runs the proxy started by |command| in a process of its own, and starts
+  it again whenever it exits.
+
+  |command| is called each time the shard starts and returns its command line.
+  Objects the shard writes on its out-of-band streams are passed to
+  |on_output| along with the index of the shard and of the stream."""
+
+  def __init__(self, index, command, env=None, on_output=None):
+    self.index = index
+    self.command = command
+    self.env = env
+    self.on_output = on_output
+    self.condition = Condition()
+    self.stop_event = Event()
+    self.stopped = False
+    self.process = None
+    self.pipe = None
+    self.supervisor = None
+    self.state = None
+    self.restarts = 0
+
+  def Start(self):
+    self.supervisor = Thread(target=self._Supervise)
+    self.supervisor.daemon = True
+    self.supervisor.start()
+
+  def Stop(self):
+    """Closes the shard's input and waits for it to exit."""
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+      process = self.process
+      pipe = self.pipe
+    self.stop_event.set()
+    if process is None:
+      return
+
+    # The shard exits once its input ends and it has answered everything.
+    if pipe is not None:
+      pipe.Close()
+      pipe.output_thread.join()
+    process.stdin.close()
+    self.supervisor.join(STOP_TIMEOUT)
+    if self.supervisor.is_alive():
+      logging.warning("Shard %d didn't exit, killing it", self.index)
+      process.kill()
+      self.supervisor.join()
+
+  def Send(self, obj, timeout=None):
+    """Opens a stream on the shard and sends the request header |obj| on it.
+
+    Waits up to |timeout| seconds, SEND_TIMEOUT by default, for the shard to
+    start if it isn't running. Returns the stream, or None if the shard isn't
+    running."""
+    if timeout is None:
+      timeout = SEND_TIMEOUT
+    deadline = time.time() + timeout
+    while True:
+      with self.condition:
+        while self.pipe is None and not self.stopped:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            break
+          self.condition.wait(remaining)
+        if self.pipe is None or self.stopped:
+          return None
+        pipe = self.pipe
+
+      stream = pipe.OpenStream()
+      if not stream.ended:
+        stream.Write(obj)
+        return stream
+      # The shard's output has ended, so it's on its way out.
+      stream.Close()
+      self._Lost(pipe)
+
+  def Stats(self):
+    with self.condition:
+      return {
+          'state': self.state,
+          'restarts': self.restarts,
+          'pid': self.process.pid if self.process is not None else None,
+          'pipe': self.pipe.Stats() if self.pipe is not None else None
+      }
+
+  def _Supervise(self):
+    delay = RESTART_DELAY
+    while not self.stopped:
+      started = time.time()
+      try:
+        (process, pipe) = self._Spawn()
+      except OSError:
+        logging.exception("Can't start shard %d", self.index)
+      else:
+        code = process.wait()
+        self._Exited(process, pipe)
+        if self.stopped:
+          return
+        logging.error('Shard %d exited with %s', self.index, code)
+
+      if time.time() - started > STABLE_SECONDS:
+        delay = RESTART_DELAY
+      if self.stop_event.wait(delay):
+        return
+      delay = min(delay * 2, MAX_RESTART_DELAY)
+      self.restarts += 1
+
+  def _Spawn(self):
+    process = subprocess.Popen(
+        self.command(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        bufsize=0,
+        close_fds=True,
+        env=self.env)
+    pipe = ChunkedPipe(process.stdout, process.stdin)
+    for index in (0, 1):
+      reader = Thread(
+          target=self._ReadOutput,
+          args=(pipe.CreateStream(index, out_of_band=True),))
+      reader.daemon = True
+      reader.start()
+
+    with self.condition:
+      self.process = process
+      self.pipe = pipe
+      stopped = self.stopped
+      self.condition.notify_all()
+    logging.info('Started shard %d as %d', self.index, process.pid)
+    if stopped:
+      # Stop() came too early to see this process.
+      pipe.Close()
+      pipe.output_thread.join()
+      process.stdin.close()
+    return process, pipe
+
+  def _Lost(self, pipe):
+    """Stops sending requests on |pipe|."""
+    with self.condition:
+      if self.pipe is pipe:
+        self.pipe = None
+        self.state = None
+
+  def _Exited(self, process, pipe):
+    self._Lost(pipe)
+    with self.condition:
+      self.process = None
+    # Requests in flight end along with the shard's output.
+    pipe.Join()
+    for f in (process.stdin, process.stdout):
+      try:
+        f.close()
+      except IOError:
+        pass
+
+  def _ReadOutput(self, stream):
+    for obj in stream:
+      if stream.index == 0 and 'state' in obj:
+        self.state = obj['state']
+      if self.on_output is not None:
+        self.on_output(self.index, stream.index, obj)
+    if stream.index == 0:
+      self._Lost(stream.pipe)
+
+
+class ShardedApp:
+  """WSGI app that relays requests to |shards| as picked by |router|.
+
+  Responses are relayed by a pool of |workers| threads for each shard."""
+
+  def __init__(self, shards, router, workers=DEFAULT_WORKERS):
+    self.shards = shards
+    self.router = router
+    self.pools = [WorkerPool(workers) for _ in shards]
+    for pool in self.pools:
+      pool.Start()
+
+  def __call__(self, environ, start_response):
+    body = environ['wsgi.input'].read()
+    try:
+      request = json.loads(body) if body else None
+    except ValueError:
+      request = None
+    header = self._Header(environ, body, request is not None)
+
+    if environ['PATH_INFO'] in BROADCAST_PATHS:
+      for (index, shard) in enumerate(self.shards):
+        if index != DEFAULT_SHARD:
+          self._Broadcast(shard, header)
+      index = DEFAULT_SHARD
+    else:
+      index = self.router.ShardFor(environ, request)
+
+    return PooledResponse(self.pools[index],
+                          self._Relay(index, header, start_response))
+
+  def _Header(self, environ, body, is_json):
+    """Returns the header of the request to send to a shard. A JSON |body|
+    is passed on without encoding it again."""
+    header = {
+        'p': environ['PATH_INFO'],
+        'm': environ['REQUEST_METHOD'],
+        'q': environ.get('QUERY_STRING', ''),
+        'h': [(key[len('HTTP_'):].replace('_', '-'), value)
+              for (key, value) in environ.items()
+              if key.startswith('HTTP_')]
+    }
+    if is_json:
+      return SplicedFrame(header, body)
+    header['d'] = body
+    return header
+
+  def _Broadcast(self, shard, header):
+    """Sends the request |header| to |shard| if it's running, and ignores
+    the response."""
+    stream = shard.Send(header, timeout=0)
+    if stream is None:
+      return
+    for _ in stream:
+      pass
+    stream.Close()
+
+  def _Relay(self, index, header, start_response):
+    stream = self.shards[index].Send(header)
+    if stream is None:
+      start_response(BAD_GATEWAY, [('Content-Type', 'application/json')])
+      yield json.dumps({'message': 'Shard {} is down'.format(index)})
+      return
+
+    try:
+      head = stream.Read()
+      if head is None or 'st' not in head:
+        start_response(BAD_GATEWAY, [('Content-Type', 'application/json')])
+        yield json.dumps(
+            {'message': 'Shard {} failed to respond'.format(index)})
+        return
+
+      start_response(
+          str(head['st']),
+          [(str(key), str(value)) for (key, value) in head.get('h', [])])
+      if 'o' in head:
+        yield json.dumps(head['o'])
+      for obj in stream:
+        if isinstance(obj, RawPayload):
+          yield obj.data
+        elif 'd' in obj:
+          data = obj['d']
+          yield data.encode('utf-8') if isinstance(data, unicode) else data
+
+    finally:
+      # The client went away before the shard was done.
+      if not stream.ended:
+        stream.Cancel()
+      stream.Close()
+
+  def Shutdown(self):
+    for pool in self.pools:
+      pool.Shutdown()
+
+  def Stats(self):
+    return {
+        'routes': self.router.Stats(),
+        'shards': [shard.Stats() for shard in self.shards],
+        'relays': [pool.Stats() for pool in self.pools]
+    }
@@ -13,7 +13,7 @@ sys.path.insert(
     0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
 
 from threading import Thread
-from editor_proxy.channel import Channel
+from editor_proxy.channel import Channel, Empty
 
 
 class ChannelTest(unittest.TestCase):
@@ -102,6 +102,121 @@ class ChannelTest(unittest.TestCase):
 
     self.assertSequenceEqual(range(10), [x for x in c])
 
+  def testGetAll(self):
+    c = Channel()
+    c.Put(1)
+    c.Put(2)
+    self.assertEqual(2, c.Pending())
+    self.assertSequenceEqual([1, 2], c.GetAll())
+    c.Put(3)
+    c.Close()
+    self.assertSequenceEqual([3], c.GetAll())
+    self.assertSequenceEqual([], c.GetAll())
+
+  def testCapacityBlocksPut(self):
+    c = Channel(capacity=1)
+    c.Put(1)
+    r = []
+
+    def WriteMore():
+      c.Put(2)
+      r.append('put')
+
+    t = Thread(target=WriteMore)
+    t.start()
+    t.join(0.1)
+    self.assertSequenceEqual([], r)
+
+    self.assertEqual(1, c.Get())
+    t.join()
+    self.assertSequenceEqual(['put'], r)
+    self.assertEqual(2, c.Get())
+
+  def testForcedPutIgnoresCapacity(self):
+    c = Channel(capacity=1)
+    c.Put(1)
+    c.Put(2, force=True)
+    c.Close()
+    self.assertSequenceEqual([1, 2], c.GetAll())
+
+  def testPutMany(self):
+    c = Channel()
+    c.PutMany([1, 2, 3])
+    c.Close()
+    self.assertSequenceEqual([1, 2, 3], list(c))
+
+  def testPutManyRespectsCapacity(self):
+    c = Channel(capacity=2)
+    r = []
+
+    def WriteMany():
+      c.PutMany(range(5))
+      r.append('put')
+
+    t = Thread(target=WriteMany)
+    t.start()
+    t.join(0.1)
+    self.assertSequenceEqual([], r)
+    self.assertEqual(2, c.Pending())
+
+    got = []
+    while len(got) < 5:
+      got.extend(c.GetAll())
+    t.join()
+    self.assertSequenceEqual(range(5), got)
+    self.assertSequenceEqual(['put'], r)
+
+  def testPutAfterCloseIsDropped(self):
+    c = Channel()
+    c.Close()
+    c.Put(1)
+    self.assertEqual(None, c.Get())
+
+  def testTryGet(self):
+    c = Channel()
+    with self.assertRaises(Empty):
+      c.TryGet()
+    c.Put(1)
+    c.Close()
+    self.assertEqual(1, c.TryGet())
+    self.assertEqual(None, c.TryGet())
+
+  def testGetTimeout(self):
+    c = Channel()
+    with self.assertRaises(Empty):
+      c.Get(timeout=0.01)
+    c.Put(1)
+    self.assertEqual(1, c.Get(timeout=0.01))
+    c.Close()
+    self.assertEqual(None, c.Get(timeout=0.01))
+
+  def testCloseWakesAllConsumers(self):
+    c = Channel()
+    r = []
+
+    def ReadAll():
+      r.extend(c)
+
+    threads = [Thread(target=ReadAll) for x in range(3)]
+    for t in threads:
+      t.start()
+    c.PutMany(range(10))
+    c.Close()
+    for t in threads:
+      t.join(5)
+      self.assertFalse(t.is_alive())
+    self.assertSequenceEqual(range(10), sorted(r))
+
+  def testCloseWakesBlockedProducer(self):
+    c = Channel(capacity=1)
+    c.Put(1)
+    t = Thread(target=c.Put, args=(2,))
+    t.start()
+    c.Close()
+    t.join(5)
+    self.assertFalse(t.is_alive())
+    self.assertSequenceEqual([1], c.GetAll())
+
 
 if __name__ == '__main__':
   unittest.main()
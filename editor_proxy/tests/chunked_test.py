@@ -5,15 +5,46 @@ from __future__ import division
 from __future__ import print_function
 
 from StringIO import StringIO
+import json
 import os
 import sys
+import time
 import unittest
+from threading import Thread
 
 DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(
     0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
 
 from editor_proxy import chunked
+from editor_proxy import framing
+
+
+class CountingStringIO(StringIO):
+
+  def __init__(self, *args):
+    StringIO.__init__(self, *args)
+    self.writes = 0
+    self.flushes = 0
+
+  def write(self, s):
+    self.writes += 1
+    StringIO.write(self, s)
+
+  def flush(self):
+    self.flushes += 1
+    StringIO.flush(self)
+
+
+def _DecodeFrames(data, framing_name='json'):
+  decoder = framing.FrameDecoder()
+  decoder.Feed(data)
+  frames = []
+  while True:
+    frame = decoder.Next(framing.FRAMINGS[framing_name]())
+    if frame is None:
+      return frames
+    frames.append(frame)
 
 
 class ChunkedTest(unittest.TestCase):
@@ -89,6 +120,16 @@ class ChunkedTest(unittest.TestCase):
                      '{"i":6,"close":true}\n'
                      '{"i":7,"close":true}\n', out.getvalue())
 
+  def testChunkedFileStreamOutToken(self):
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(StringIO(''), out)
+    fs = chunked.ChunkedFileStream(pipe.CreateStream(1), out_token='stderr')
+    fs.write('oops')
+    fs.close()
+    pipe.Join()
+    self.assertEqual('{"i":1,"s":17}\n{"stderr":"oops"}'
+                     '{"i":1,"close":true}\n', out.getvalue())
+
   def testChunkedFileStreamRead(self):
     inp = StringIO(
         '{"i":6,"s":"l"}\n{"d":"abcd"}\n'
@@ -162,5 +203,414 @@ class ChunkedTest(unittest.TestCase):
     finally:
       pipe.Join()
 
+  def _FileStream(self, chunks):
+    stream = chunked.ChunkedStream(None, 1)
+    for chunk in chunks:
+      stream._Deliver({'d': chunk}, len(chunk))
+    stream._EndOfInput()
+    return chunked.ChunkedFileStream(stream)
+
+  def testChunkedFileStreamReadAcrossChunks(self):
+    fs = self._FileStream(['ab', 'cd\nef', 'g'])
+    self.assertEqual('ab', fs.read(3))
+    self.assertEqual('c', fs.read(1))
+    self.assertEqual('d\nef', fs.read())
+    self.assertEqual('g', fs.read(100))
+    self.assertEqual('', fs.read())
+
+  def testChunkedFileStreamReadLineLimit(self):
+    fs = self._FileStream(['abc', 'def\n', 'gh'])
+    self.assertEqual('', fs.readline(0))
+    self.assertEqual('abcd', fs.readline(4))
+    self.assertEqual('ef\n', fs.readline(10))
+    self.assertEqual('gh', fs.readline())
+
+  def testChunkedFileStreamReadInto(self):
+    fs = self._FileStream(['abc', 'def'])
+    b = bytearray(4)
+    self.assertEqual(3, fs.readinto(b))
+    self.assertEqual('abc', str(b[:3]))
+    self.assertEqual(3, fs.readinto(b))
+    self.assertEqual('def', str(b[:3]))
+    self.assertEqual(0, fs.readinto(b))
+
+  def testBufferedBody(self):
+    stream = chunked.ChunkedStream(None, 1)
+    lines = ['line {}\n'.format(x) for x in range(1000)]
+    body = ''.join(lines)
+    for offset in range(0, len(body), 7):
+      stream._Deliver(chunked.RawPayload(body[offset:offset + 7]), 7)
+    stream._EndOfInput()
+
+    reader = chunked.BufferedBody(stream, buffer_size=64)
+    self.assertEqual(lines[0], reader.readline())
+    self.assertEqual(''.join(lines[1:3]), reader.read(len(lines[1]) * 2))
+    self.assertEqual(lines[3:], reader.readlines())
+    self.assertEqual('', reader.read())
+
+  def testCoalescedOutput(self):
+    out = CountingStringIO()
+    thread = chunked.OutputDispatchThread(out)
+    stream = chunked.ChunkedStream(None, 1)
+
+    # Everything is queued before the thread starts, so the whole lot should
+    # be picked up as a single batch.
+    thread.Attach(stream)
+    for x in range(3):
+      thread.Write(stream, {'a': x})
+    thread.Close(stream)
+    thread.Quit()
+    thread.start()
+    thread.join()
+
+    self.assertEqual('{"i":1,"s":7}\n{"a":0}'
+                     '{"i":1,"s":7}\n{"a":1}'
+                     '{"i":1,"s":7}\n{"a":2}'
+                     '{"i":1,"close":true}\n', out.getvalue())
+    self.assertEqual(1, out.writes)
+    self.assertEqual(1, out.flushes)
+
+    stats = thread.Stats()
+    self.assertEqual(4, stats['frames'])
+    self.assertEqual(1, stats['flushes'])
+    self.assertEqual(4.0, stats['frames_per_flush'])
+
+  def testBinaryHandshake(self):
+    binary = framing.BinaryFraming()
+    inp = StringIO(''.join(('{"hs":{"framing":["binary","json"]}}\n',) +
+                           binary.EncodeData(4, '{"a":1}') +
+                           binary.EncodeClose(4)))
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(o)
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual(
+        ''.join(('{"hs":{"framing":"binary"}}\n',) +
+                binary.EncodeData(4, '{"a":1}') + binary.EncodeClose(4)),
+        out.getvalue())
+
+  def testHandshakeFallsBackToJson(self):
+    inp = StringIO('{"hs":{"framing":["binary"]}}\n'
+                   '{"i":4,"s":7}\n{"a":1}')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out, framings=('json',))
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(o)
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual('{"hs":{"framing":"json"}}\n'
+                     '{"i":4,"s":7}\n{"a":1}'
+                     '{"i":4,"close":true}\n', out.getvalue())
+
+  def testRawInput(self):
+    inp = StringIO('{"i":6,"s":4,"r":1}\nab"\n'
+                   '{"i":6,"s":"l"}\n{"d":"cd"}\n')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    try:
+      for stream in pipe:
+        try:
+          fs = chunked.ChunkedFileStream(stream)
+          self.assertEqual('ab"\n', fs.readline())
+          self.assertEqual('cd', fs.readline())
+        finally:
+          fs.close()
+
+    finally:
+      pipe.Join()
+
+  def testRawOutputNegotiated(self):
+    inp = StringIO('{"hs":{"framing":["json"],"features":["raw","x"]}}\n'
+                   '{"i":4,"s":2,"r":1}\nab')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(chunked.RawPayload(o.data + '"c'))
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual('{"hs":{"framing":"json","features":["raw"]}}\n'
+                     '{"i":4,"s":4,"r":1}\nab"c'
+                     '{"i":4,"close":true}\n', out.getvalue())
+
+  def testRawOutputNotNegotiated(self):
+    inp = StringIO('{"i":4,"s":2,"r":1}\nab')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(chunked.RawPayload(o.data + '"c'))
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual('{"i":4,"s":13}\n{"d":"ab\\"c"}'
+                     '{"i":4,"close":true}\n', out.getvalue())
+
+  def _Scheduled(self, items):
+    thread = chunked.OutputDispatchThread(StringIO(), max_frame_size=4)
+    thread.fragment_frames = True
+    thread._Process(items)
+    while thread._Busy():
+      thread._Schedule()
+    return [(f.index, f.payload, f.IsFragment())
+            for f in _DecodeFrames(thread._TakeOutput())
+            if not f.IsClose()]
+
+  def testLargePayloadsAreFragmented(self):
+    Create = chunked.OutputDispatchThread.CreateNewStream
+    self.assertEqual(
+        [(1, 'abcd', True), (2, 'xy', False), (2, 'z', False),
+         (1, 'efgh', True), (1, 'ij', False)],
+        self._Scheduled([(1, Create()), (2, Create()),
+                         (1, chunked.EncodedPayload('abcdefghij')),
+                         (2, chunked.EncodedPayload('xy')),
+                         (2, chunked.EncodedPayload('z'))]))
+
+  def testOutputIsScheduledByPriority(self):
+    Create = chunked.OutputDispatchThread.CreateNewStream
+    Priority = chunked.OutputDispatchThread.PriorityChange
+    self.assertEqual(
+        [(2, 'xy', False), (1, 'abcd', True), (1, 'ef', False)],
+        self._Scheduled([(1, Create()), (2, Create()),
+                         (1, Priority(chunked.PRIORITY_BACKGROUND)),
+                         (2, Priority(chunked.PRIORITY_INTERACTIVE)),
+                         (1, chunked.EncodedPayload('abcdef')),
+                         (2, chunked.EncodedPayload('xy'))]))
+
+  def testFragmentedInput(self):
+    inp = StringIO('{"i":4,"s":4,"m":1}\n{"a"'
+                   '{"i":5,"s":7}\n{"b":2}'
+                   '{"i":4,"s":4}\n:12}')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    received = {}
+    for stream in pipe:
+      received[stream.index] = stream.Read()
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual({4: {'a': 12}, 5: {'b': 2}}, received)
+
+  def testMalformedPayloadOnlyAffectsItsStream(self):
+    inp = StringIO('{"i":4,"s":3}\n{"a'
+                   '{"i":5,"s":7}\n{"b":2}'
+                   '{"i":4,"s":7}\n{"c":3}')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    received = {}
+    for stream in pipe:
+      if stream.index == 4:
+        # Payloads are decoded by the reader, not by the input thread.
+        with self.assertRaises(ValueError):
+          stream.Read()
+      received[stream.index] = stream.Read()
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual({4: {'c': 3}, 5: {'b': 2}}, received)
+
+  def testCancel(self):
+    inp = StringIO('{"i":4,"s":7}\n{"a":1}'
+                   '{"i":4,"cancel":true}\n'
+                   '{"i":9,"cancel":true}\n')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    for stream in pipe:
+      self.assertEqual([{'a': 1}], list(stream))
+      self.assertTrue(stream.IsCancelled())
+      stream.Write({'dropped': True})
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual('{"i":4,"close":true}\n', out.getvalue())
+
+  def testCloseWithoutStreams(self):
+    pipe = chunked.ChunkedPipe(StringIO(''), StringIO())
+    self.assertEqual([], list(pipe))
+    pipe.Join()
+    self.assertFalse(pipe.output_thread.is_alive())
+
+  def testBrokenOutput(self):
+
+    class BrokenPipe(StringIO):
+
+      def write(self, s):
+        raise IOError(32, 'Broken pipe')
+
+    pipe = chunked.ChunkedPipe(StringIO('{"i":4,"s":7}\n{"a":1}'), BrokenPipe())
+    for stream in pipe:
+      # Writers aren't held up by output that can't go anywhere.
+      for n in range(chunked.OUTPUT_QUEUE_CAPACITY * 4):
+        stream.Write({'n': n})
+      stream.Close()
+
+    pipe.Join()
+    self.assertFalse(pipe.output_thread.is_alive())
+    self.assertTrue(pipe.output_thread.broken)
+
+  def testOutgoingStream(self):
+    (in_r, in_w) = os.pipe()
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(os.fdopen(in_r, 'rb', 0), out)
+
+    stream = pipe.OpenStream()
+    self.assertEqual(chunked.FIRST_OUTGOING_INDEX, stream.index)
+    stream.Write({'p': '/ready'})
+    os.write(in_w, '{"i":2,"s":7}\n{"a":1}{"i":2,"close":true}\n')
+    self.assertEqual([{'a': 1}], list(stream))
+    stream.Close()
+
+    cancelled = pipe.OpenStream()
+    cancelled.Cancel()
+    os.write(in_w, '{"i":3,"close":true}\n')
+    self.assertEqual([], list(cancelled))
+    cancelled.Close()
+
+    os.close(in_w)
+    self.assertEqual([], list(pipe))
+    pipe.Join()
+    # Streams closed by the peer aren't closed again.
+    self.assertEqual('{"i":2,"s":14}\n{"p":"/ready"}{"i":3,"cancel":true}\n',
+                     out.getvalue())
+
+  def testStreamAttachedAfterDrain(self):
+    pipe = chunked.ChunkedPipe(StringIO(''), StringIO())
+    self.assertEqual([], list(pipe))
+    stream = pipe.OpenStream()
+    self.assertEqual(None, stream.Read())
+    stream.Close()
+    pipe.Join()
+
+  def testCompressionNegotiated(self):
+    message = {'a': 'b' * 1000}
+    payload, flags = framing.Compressor().Compress(framing.Serialize(message))
+    self.assertEqual(framing.FLAG_COMPRESSED, flags)
+    inp = StringIO('{"hs":{"framing":["json"],"features":["zlib"]}}\n' +
+                   ''.join(framing.JsonFraming().EncodeData(4, payload,
+                                                            flags)))
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(o)
+        stream.Write({'small': 1})
+      stream.Close()
+
+    pipe.Join()
+    handshake = '{"hs":{"framing":"json","features":["zlib"]}}\n'
+    self.assertTrue(out.getvalue().startswith(handshake))
+    frames = _DecodeFrames(out.getvalue()[len(handshake):])
+    self.assertTrue(frames[0].IsCompressed())
+    self.assertFalse(frames[1].IsCompressed())
+    self.assertEqual(message,
+                     json.loads(framing.Decompressor().Decompress(
+                         frames[0].payload)))
+    self.assertEqual('{"small":1}', frames[1].payload)
+
+    stats = pipe.Stats()
+    self.assertEqual(1, stats['input']['compression']['frames'])
+    self.assertEqual(1, stats['output']['compression']['frames'])
+    self.assertTrue(stats['output']['compression']['ratio'] > 10)
+
+  def testCompressedInputNotNegotiated(self):
+    payload, flags = framing.Compressor(threshold=0).Compress('{}')
+    inp = StringIO('{"i":3,"s":2}\n{}' + ''.join(
+        framing.JsonFraming().EncodeData(4, payload, flags)))
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out)
+
+    streams = []
+    for stream in pipe:
+      streams.append((stream.index, list(stream)))
+      stream.Close()
+
+    pipe.Join()
+    self.assertEqual([(3, [{}])], streams)
+
+  def testSendWindow(self):
+    window = chunked.SendWindow(4)
+    window.Acquire(7)
+    r = []
+
+    def WriteMore():
+      window.Acquire(1)
+      r.append('sent')
+
+    t = Thread(target=WriteMore)
+    t.start()
+    t.join(0.1)
+    self.assertSequenceEqual([], r)
+
+    window.Release(3)
+    t.join(0.1)
+    self.assertSequenceEqual([], r)
+
+    window.Release(1)
+    t.join()
+    self.assertSequenceEqual(['sent'], r)
+
+  def testSendWindowClose(self):
+    window = chunked.SendWindow(0)
+    t = Thread(target=lambda: window.Acquire(1))
+    t.start()
+    window.Close()
+    t.join()
+
+  def testFlowControl(self):
+    inp = StringIO('{"hs":{"framing":["json"],"features":["flow"],'
+                   '"window":4}}\n'
+                   '{"i":4,"s":7}\n{"a":1}'
+                   '{"i":4,"w":100}\n'
+                   '{"i":4,"s":7}\n{"a":2}'
+                   '{"i":4,"close":true}\n')
+    out = StringIO()
+    pipe = chunked.ChunkedPipe(inp, out, receive_window=8)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(o)
+      stream.Close()
+
+    pipe.Join()
+    # Window updates are sent as soon as they are queued, so they may go
+    # ahead of data that was queued before them.
+    handshake = framing.Serialize({'hs': {'framing': 'json',
+                                          'features': ['flow'],
+                                          'window': 8}}) + '\n'
+    self.assertTrue(out.getvalue().startswith(handshake))
+    frames = _DecodeFrames(out.getvalue()[len(handshake):])
+    self.assertEqual([7, 7], [f.window for f in frames if f.IsWindowUpdate()])
+    self.assertEqual(['{"a":1}', '{"a":2}'],
+                     [f.payload for f in frames if f.payload is not None])
+    self.assertTrue(frames[-1].IsClose())
+
+  def testFlushPolicy(self):
+    policy = chunked.FlushPolicy(max_bytes=100, max_delay=60)
+    now = time.time()
+    self.assertTrue(policy.ShouldFlush(1, now, True))
+    self.assertFalse(policy.ShouldFlush(1, now, False))
+    self.assertTrue(policy.ShouldFlush(100, now, False))
+    self.assertTrue(policy.ShouldFlush(1, now - 61, False))
+
+    eager = chunked.FlushPolicy(max_bytes=0)
+    self.assertTrue(eager.ShouldFlush(1, now, False))
+
+
 if __name__ == '__main__':
   unittest.main()
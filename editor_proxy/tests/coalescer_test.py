@@ -0,0 +1,103 @@
+"""Tests for coalescer."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import sys
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import coalescer
+
+
+def CompletionRequest(column_num, contents='int x;\n  foo.bar_b\n'):
+  return json.dumps({
+      'filepath': '/a.cc',
+      'line_num': 2,
+      'column_num': column_num,
+      'file_data': {
+          '/a.cc': {
+              'contents': contents,
+              'filetypes': ['cpp']
+          }
+      }
+  })
+
+
+class CoalescerTest(unittest.TestCase):
+
+  def testCompletionStartColumn(self):
+    contents = 'int x;\n  foo.bar_b\n'
+    self.assertEqual(7, coalescer.CompletionStartColumn(contents, 2, 12))
+    self.assertEqual(7, coalescer.CompletionStartColumn(contents, 2, 7))
+    self.assertEqual(3, coalescer.CompletionStartColumn(contents, 2, 5))
+    self.assertEqual(1, coalescer.CompletionStartColumn(contents, 2, 1))
+    self.assertEqual(4, coalescer.CompletionStartColumn(contents, 9, 4))
+
+  def testCompletionStartColumnCountsBytes(self):
+    # U+00E9 and U+00DF take two bytes each in UTF-8.
+    contents = u'x = "\xe9"; stra\xdfe.ab'
+    self.assertEqual(11, coalescer.CompletionStartColumn(contents, 1, 11))
+    self.assertEqual(11, coalescer.CompletionStartColumn(contents, 1, 18))
+    self.assertEqual(19, coalescer.CompletionStartColumn(contents, 1, 21))
+    self.assertEqual(
+        11, coalescer.CompletionStartColumn(contents.encode('utf-8'), 1, 18))
+
+  def testKeyIgnoresTypedPrefix(self):
+    c = coalescer.Coalescer()
+    self.assertEqual(
+        c.Key('/completions', CompletionRequest(10)),
+        c.Key('/completions', CompletionRequest(12)))
+    self.assertNotEqual(
+        c.Key('/completions', CompletionRequest(6)),
+        c.Key('/completions', CompletionRequest(12)))
+    self.assertIsNone(c.Key('/completions', '{"filepath":"/a.cc"}'))
+    self.assertIsNone(c.Key('/completions', 'not json'))
+    self.assertIsNone(c.Key('/debug_info', CompletionRequest(12)))
+
+  def testKeyScope(self):
+    c = coalescer.Coalescer()
+    self.assertNotEqual(
+        c.Key('/completions', CompletionRequest(10), 'a'),
+        c.Key('/completions', CompletionRequest(10), 'b'))
+
+  def testOnlyNewestQueuedRequestRuns(self):
+    c = coalescer.Coalescer()
+    key = c.Key('/completions', CompletionRequest(10))
+    self.assertIsNone(c.Admit(key, 'first'))
+    self.assertEqual('first', c.Admit(key, 'second'))
+    self.assertFalse(c.Start(key, 'first'))
+    self.assertTrue(c.Start(key, 'second'))
+
+    # Once running, a request can't be superseded anymore.
+    self.assertIsNone(c.Admit(key, 'third'))
+    self.assertEqual({'coalesced': {'/completions': 1}, 'queued': 1},
+                     c.Stats())
+
+  def testArrivalOrderDecides(self):
+    c = coalescer.Coalescer()
+    key = c.Key('/completions', CompletionRequest(10))
+    early = c.Arrive()
+    self.assertIsNone(c.Admit(key, 'late', c.Arrive()))
+    # A request admitted after a newer one supersedes itself.
+    self.assertEqual('early', c.Admit(key, 'early', early))
+    self.assertFalse(c.Start(key, 'early'))
+    self.assertTrue(c.Start(key, 'late'))
+
+  def testSupersededResponse(self):
+    c = coalescer.Coalescer()
+    response = c.SupersededResponse('/completions', CompletionRequest(12))
+    self.assertEqual('200 OK', response['st'])
+    self.assertIn((coalescer.SUPERSEDED_HEADER, '1'), response['h'])
+    self.assertEqual([], response['o']['completions'])
+    self.assertEqual(7, response['o']['completion_start_column'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,207 @@
+"""Tests for daemon."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import daemon
+from editor_proxy.chunked import ChunkedPipe
+from editor_proxy.framing import FrameDecoder, JsonFraming
+from editor_proxy.pipe_server import PipeServer
+
+REQUEST = '{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n'
+
+
+class DaemonTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'daemon')
+    self.served = []
+    self.updates = []
+    self.server = PipeServer(None, None)
+    self.daemon = None
+    self.thread = None
+    self.check_interval = daemon.IDLE_CHECK_INTERVAL
+    daemon.IDLE_CHECK_INTERVAL = 0.01
+
+  def tearDown(self):
+    if self.thread is not None:
+      self.daemon.Shutdown()
+      self.thread.join()
+      self.assertFalse(os.path.exists(self.path))
+    self.server.Shutdown()
+    daemon.IDLE_CHECK_INTERVAL = self.check_interval
+    shutil.rmtree(self.directory)
+
+  def App(self, environ, start_response):
+    self.served.append(environ['PATH_INFO'])
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(len(self.served))]
+
+  def Start(self, idle_timeout=daemon.DEFAULT_IDLE_SECONDS, options=None):
+    self.daemon = daemon.Daemon(self.path, self.server, ChunkedPipe,
+                                idle_timeout, options, self.updates.append)
+    self.daemon.Listen()
+    self.daemon.SetApp(self.App)
+    self.daemon.ReportState('ready')
+    self.thread = Thread(target=self.daemon.Serve)
+    self.thread.start()
+
+  def Attach(self, token, data=REQUEST, options=None):
+    """Runs a session that sends |data|. Returns its exit code and the
+    payloads it received on each stream."""
+    session = self.Open(token, options)
+    os.write(session['input'], data)
+    return self.Finish(session)
+
+  def Open(self, token, options=None):
+    """Starts a session that lasts until it's passed to Finish()."""
+    (in_r, in_w) = os.pipe()
+    (out_r, out_w) = os.pipe()
+    session = {'input': in_w, 'output': out_r}
+
+    def Run():
+      try:
+        session['code'] = daemon.Attach(self.path, token,
+                                        lambda: self.Start(options=options),
+                                        (in_r, out_w), options)
+      finally:
+        os.close(in_r)
+        os.close(out_w)
+
+    session['thread'] = Thread(target=Run)
+    session['thread'].start()
+    return session
+
+  def Finish(self, session):
+    """Ends the input of |session|. Returns its exit code and the payloads it
+    received on each stream."""
+    os.close(session['input'])
+    session['thread'].join()
+    with os.fdopen(session['output']) as output:
+      decoder = FrameDecoder()
+      decoder.Feed(output.read())
+
+    payloads = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        return session['code'], payloads
+      if frame.payload is not None:
+        payloads.setdefault(frame.index, []).append(json.loads(frame.payload))
+
+  def testSessionsShareTheApp(self):
+    # The first session starts the daemon.
+    (code, payloads) = self.Attach(None)
+    self.assertEqual(0, code)
+    self.assertEqual('ready', payloads[0][0]['state'])
+    token = payloads[0][0]['session']
+    self.assertEqual(1, payloads[1][0]['o'])
+
+    (code, payloads) = self.Attach(token)
+    self.assertEqual(0, code)
+    self.assertEqual([{'state': 'ready', 'session': token}], payloads[0])
+    self.assertEqual(2, payloads[1][0]['o'])
+
+  def testSessionOptions(self):
+    (code, payloads) = self.Attach(None, options={'a': 1})
+    self.assertEqual(0, code)
+    token = payloads[0][0]['session']
+    # The daemon was started with the options of the first session.
+    (code, payloads) = self.Attach(token, options={'a': 1})
+    self.assertEqual([], self.updates)
+
+    for options in ({'a': 2}, {'a': 2}, {'a': 1}):
+      (code, payloads) = self.Attach(token, options=options)
+      self.assertEqual(0, code)
+    self.assertEqual([{'a': 2}, {'a': 1}], self.updates)
+
+  def testOverlappingSessionsKeepTheOptions(self):
+    first = self.Open(None, {'a': 1})
+    try:
+      deadline = time.time() + 5
+      while not self.server.Stats()['clients'] and time.time() < deadline:
+        time.sleep(0.01)
+      token = self.daemon.token
+      # The first session is still attached.
+      self.assertEqual(0, self.Attach(token, options={'a': 2})[0])
+      self.assertEqual([], self.updates)
+    finally:
+      self.assertEqual(0, self.Finish(first)[0])
+
+    self.assertEqual(0, self.Attach(token, options={'a': 2})[0])
+    self.assertEqual([{'a': 2}], self.updates)
+
+  def testOverlappingSessionsAreSeparateClients(self):
+    (_, payloads) = self.Attach(None, '')
+    token = payloads[0][0]['session']
+
+    sessions = [self.Open(token) for _ in range(2)]
+    try:
+      deadline = time.time() + 5
+      while (len(self.server.Stats()['clients']) < 2 and
+             time.time() < deadline):
+        time.sleep(0.01)
+      self.assertEqual(['session-2', 'session-3'],
+                       sorted(self.server.Stats()['clients']))
+    finally:
+      codes = [self.Finish(session)[0] for session in sessions]
+    self.assertEqual([0, 0], codes)
+    self.assertEqual({}, self.server.Stats()['clients'])
+
+  def testWrongToken(self):
+    self.Start()
+    (code, payloads) = self.Attach(None, '')
+    self.assertEqual(0, code)
+    token = payloads[0][0]['session']
+
+    for wrong in (None, 'x' * len(token)):
+      (code, payloads) = self.Attach(wrong)
+      self.assertEqual(1, code)
+      self.assertEqual({}, payloads)
+    self.assertEqual([], self.served)
+
+  def testFailedStartup(self):
+    self.daemon = daemon.Daemon(self.path, self.server, ChunkedPipe)
+    self.daemon.Listen()
+    self.thread = Thread(target=self.daemon.Serve)
+    self.thread.start()
+    self.daemon.FailStartup('no ycmd')
+    self.daemon.ReportState('failed', message='no ycmd')
+    (code, payloads) = self.Attach(None)
+    self.assertEqual(1, code)
+    self.assertEqual('failed', payloads[0][0]['state'])
+    self.assertEqual('no ycmd', payloads[1][0]['o']['message'])
+
+    # The daemon doesn't stick around after that.
+    self.thread.join()
+    self.thread = None
+
+  def testIdleTimeout(self):
+    self.Start(idle_timeout=0.05)
+    self.thread.join()
+    self.thread = None
+    self.assertFalse(os.path.exists(self.path))
+
+  def testOnlyOneDaemon(self):
+    self.Start()
+    other = daemon.Daemon(self.path, self.server, ChunkedPipe)
+    self.assertRaises(RuntimeError, other.Listen)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+"""Tests for file_data."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import file_data
+
+
+def Sha1(data):
+  return hashlib.sha1(data).hexdigest()
+
+
+class FileDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _WriteFile(self, name, data):
+    path = os.path.join(self.temp_dir, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def testApplyDelta(self):
+    self.assertEqual(u'int bar = 1;',
+                     file_data.ApplyDelta(u'int foo = 0;',
+                                          [[4, 7, u'bar'], [10, 11, u'1']]))
+    self.assertEqual(u'abc', file_data.ApplyDelta(u'abc', []))
+    self.assertEqual(u'xabc', file_data.ApplyDelta(u'abc', [[0, 0, u'x']]))
+
+  def testApplyDeltaRejectsBadEdits(self):
+    with self.assertRaises(ValueError):
+      file_data.ApplyDelta(u'abc', [[2, 3, u''], [0, 1, u'']])
+    with self.assertRaises(ValueError):
+      file_data.ApplyDelta(u'abc', [[2, 9, u'']])
+    with self.assertRaises(ValueError):
+      file_data.ApplyDelta(u'abc', [[2, 1, u'']])
+
+  def testExpand(self):
+    cache = file_data.BufferCache()
+    request = {
+        'file_data': {
+            '/a.cc': {
+                'contents': u'int foo;',
+                'filetypes': ['cpp'],
+                'version': 1
+            }
+        }
+    }
+    self.assertEqual({'/a.cc': 1}, cache.Expand(request))
+    self.assertEqual({'contents': u'int foo;', 'filetypes': ['cpp']},
+                     request['file_data']['/a.cc'])
+
+    request = {
+        'file_data': {
+            '/a.cc': {
+                'base_version': 1,
+                'delta': [[4, 7, u'bar']],
+                'filetypes': ['cpp'],
+                'version': 2
+            },
+            '/b.h': {
+                'contents': u'',
+                'filetypes': ['cpp']
+            }
+        }
+    }
+    self.assertEqual({'/a.cc': 2}, cache.Expand(request))
+    self.assertEqual({'contents': u'int bar;', 'filetypes': ['cpp']},
+                     request['file_data']['/a.cc'])
+    self.assertEqual(u'int bar;', cache.Get('/a.cc', 2))
+
+  def testExpandWithUnknownBase(self):
+    cache = file_data.BufferCache()
+    request = {
+        'file_data': {
+            '/a.cc': {
+                'base_version': 7,
+                'delta': [],
+                'version': 8
+            },
+            '/b.cc': {
+                'contents': u'x',
+                'version': 1
+            }
+        }
+    }
+    with self.assertRaises(file_data.NeedContents) as context:
+      cache.Expand(request)
+    self.assertEqual(['/a.cc'], context.exception.filepaths)
+    # Nothing is stored for a request that can't be served.
+    self.assertIsNone(cache.Get('/b.cc', 1))
+
+  def testDigestCache(self):
+    path = self._WriteFile('a.cc', 'int f\xc3\xb6\xc3\xb6;')
+    digests = file_data.DigestCache()
+
+    self.assertEqual(u'int f\xf6\xf6;',
+                     digests.Contents(path, Sha1('int f\xc3\xb6\xc3\xb6;'), 10))
+    self.assertEqual(u'int f\xf6\xf6;',
+                     digests.Contents(path, Sha1('int f\xc3\xb6\xc3\xb6;')))
+    self.assertIsNone(digests.Contents(path, Sha1('int foo;')))
+    self.assertIsNone(digests.Contents(path, Sha1('int foo;'), 8))
+    self.assertIsNone(
+        digests.Contents(os.path.join(self.temp_dir, 'missing'), Sha1('')))
+    self.assertEqual({
+        'hits': 2,
+        'hashed': 1,
+        'mismatches': 2,
+        'entries': 1
+    }, digests.Stats())
+
+  def testDigestCacheNoticesChanges(self):
+    path = self._WriteFile('a.cc', 'int foo;')
+    digests = file_data.DigestCache()
+    self.assertIsNotNone(digests.Contents(path, Sha1('int foo;')))
+
+    self._WriteFile('a.cc', 'int barbaz;')
+    self.assertIsNone(digests.Contents(path, Sha1('int foo;')))
+    self.assertEqual(u'int barbaz;',
+                     digests.Contents(path, Sha1('int barbaz;')))
+
+  def testExpandByDigest(self):
+    path = self._WriteFile('a.cc', 'int foo;')
+    cache = file_data.BufferCache()
+    request = {
+        'file_data': {
+            path: {
+                'sha1': Sha1('int foo;'),
+                'size': 8,
+                'mtime': 1,
+                'filetypes': ['cpp'],
+                'version': 1
+            }
+        }
+    }
+    self.assertEqual({path: 1},
+                     cache.Expand(request, file_data.DigestCache()))
+    self.assertEqual({'contents': u'int foo;', 'filetypes': ['cpp']},
+                     request['file_data'][path])
+
+    request = {'file_data': {path: {'sha1': Sha1('int bar;'), 'size': 8}}}
+    with self.assertRaises(file_data.NeedContents) as context:
+      cache.Expand(request, file_data.DigestCache())
+    self.assertEqual([path], context.exception.filepaths)
+
+    request = {'file_data': {path: {'sha1': Sha1('int foo;')}}}
+    with self.assertRaises(file_data.NeedContents):
+      cache.Expand(request)
+
+  def testEviction(self):
+    cache = file_data.BufferCache(max_size=10)
+    self.assertTrue(cache.Put('/a', 1, u'aaaa'))
+    self.assertTrue(cache.Put('/b', 1, u'bbbb'))
+    cache.Get('/a', 1)
+    self.assertTrue(cache.Put('/c', 1, u'cccc'))
+
+    self.assertEqual(u'aaaa', cache.Get('/a', 1))
+    self.assertIsNone(cache.Get('/b', 1))
+    self.assertFalse(cache.Put('/d', 1, u'd' * 11))
+
+    stats = cache.Stats()
+    self.assertEqual(1, stats['evictions'])
+    self.assertEqual(8, stats['size'])
+    self.assertEqual(2, stats['entries'])
+
+
+if __name__ == '__main__':
+  unittest.main()
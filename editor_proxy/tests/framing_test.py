@@ -0,0 +1,277 @@
+"""Tests for framing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import random
+import sys
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import framing
+
+
+class FramingTest(unittest.TestCase):
+
+  def _Decode(self, codec, data, step=None):
+    """Returns the frames in |data| and the decoder, fed |step| bytes at a
+    time."""
+    decoder = framing.FrameDecoder()
+    frames = []
+    step = step or max(len(data), 1)
+    for offset in range(0, len(data), step):
+      decoder.Feed(data[offset:offset + step])
+      while True:
+        frame = decoder.Next(codec)
+        if frame is None:
+          break
+        frames.append(frame)
+    return (frames, decoder)
+
+  def _RoundTrip(self, codec, parts):
+    frames, decoder = self._Decode(codec, ''.join(parts))
+    self.assertFalse(decoder.HasPartialFrame())
+    return frames
+
+  def testJsonEncoding(self):
+    codec = framing.JsonFraming()
+    self.assertEqual('{"i":3,"s":7}\n{"a":1}',
+                     ''.join(codec.EncodeData(3, '{"a":1}')))
+    self.assertEqual('{"i":3,"close":true}\n', ''.join(codec.EncodeClose(3)))
+    self.assertEqual('{"hs":{"framing":"json"}}\n',
+                     ''.join(codec.EncodeHandshake({'framing': 'json'})))
+
+  def testJsonDecoding(self):
+    codec = framing.JsonFraming()
+    frames = self._RoundTrip(codec, [
+        '{"hs":{"framing":["binary"]}}\n', '\n', '{"i":"2","s":"l"}\n',
+        '{"a":1}\n', '{"i":2,"s":3}\nabc', '{"i":2,"close":true}\n'
+    ])
+    self.assertEqual(4, len(frames))
+    self.assertEqual({'framing': ['binary']}, frames[0].handshake)
+    self.assertEqual(2, frames[1].index)
+    self.assertEqual(framing.FLAG_LINE, frames[1].flags)
+    self.assertEqual('{"a":1}\n', frames[1].payload)
+    self.assertEqual('abc', frames[2].payload)
+    self.assertTrue(frames[3].IsClose())
+
+  def testRawFlag(self):
+    for codec in (framing.JsonFraming(), framing.BinaryFraming()):
+      frames = self._RoundTrip(codec,
+                               codec.EncodeData(1, '"x"', framing.FLAG_RAW) +
+                               codec.EncodeData(1, '"x"'))
+      self.assertTrue(frames[0].IsRaw())
+      self.assertEqual('"x"', frames[0].payload)
+      self.assertFalse(frames[1].IsRaw())
+
+  def testWindowUpdate(self):
+    for codec in (framing.JsonFraming(), framing.BinaryFraming()):
+      frames = self._RoundTrip(codec, codec.EncodeWindowUpdate(5, 4096))
+      self.assertEqual(1, len(frames))
+      self.assertTrue(frames[0].IsWindowUpdate())
+      self.assertEqual(5, frames[0].index)
+      self.assertEqual(4096, frames[0].window)
+      self.assertEqual(None, frames[0].payload)
+
+  def testMoreFlag(self):
+    for codec in (framing.JsonFraming(), framing.BinaryFraming()):
+      frames = self._RoundTrip(codec,
+                               codec.EncodeData(1, 'ab', framing.FLAG_MORE) +
+                               codec.EncodeData(1, 'c'))
+      self.assertTrue(frames[0].IsFragment())
+      self.assertEqual('ab', frames[0].payload)
+      self.assertFalse(frames[1].IsFragment())
+
+  def testCancel(self):
+    for codec in (framing.JsonFraming(), framing.BinaryFraming()):
+      frames = self._RoundTrip(codec, codec.EncodeCancel(5))
+      self.assertEqual(1, len(frames))
+      self.assertTrue(frames[0].IsCancel())
+      self.assertFalse(frames[0].IsClose())
+      self.assertEqual(5, frames[0].index)
+      self.assertEqual(None, frames[0].payload)
+
+  def testCompressedFlag(self):
+    for codec in (framing.JsonFraming(), framing.BinaryFraming()):
+      frames = self._RoundTrip(
+          codec, codec.EncodeData(1, 'ab', framing.FLAG_COMPRESSED))
+      self.assertTrue(frames[0].IsCompressed())
+      self.assertEqual('ab', frames[0].payload)
+
+  def testCompression(self):
+    compressor = framing.Compressor(threshold=10)
+    decompressor = framing.Decompressor()
+    self.assertEqual(('short', 0), compressor.Compress('short'))
+
+    message = '{"completions":[' + ','.join(['{"insertion_text":"x"}'] * 20)
+    first, flags = compressor.Compress(message)
+    self.assertEqual(framing.FLAG_COMPRESSED, flags)
+    second, _ = compressor.Compress(message)
+    # Shared context: the repeated message costs next to nothing.
+    self.assertTrue(len(second) < len(first))
+
+    self.assertEqual(message, decompressor.Decompress(first))
+    self.assertEqual(message, decompressor.Decompress(second))
+
+    stats = compressor.Stats()
+    self.assertEqual(2, stats['frames'])
+    self.assertEqual(2 * len(message), stats['bytes_in'])
+    self.assertTrue(stats['ratio'] > 1)
+    self.assertEqual(stats['ratio'], decompressor.Stats()['ratio'])
+
+  def testBadCompressedPayload(self):
+    with self.assertRaises(IOError):
+      framing.Decompressor().Decompress('not zlib')
+
+  def testJsonMalformed(self):
+    codec = framing.JsonFraming()
+    with self.assertRaises(IOError):
+      self._Decode(codec, '{"s":1}\n1')
+    with self.assertRaises(IOError):
+      self._Decode(codec, '{"i":1}\n')
+
+    frames, decoder = self._Decode(codec, '{"i":1,"s":10}\nabc')
+    self.assertEqual([], frames)
+    self.assertTrue(decoder.HasPartialFrame())
+
+  def testBinaryRoundTrip(self):
+    codec = framing.BinaryFraming()
+    frames = self._RoundTrip(codec,
+                             codec.EncodeData(7, '{"a":"b"}') +
+                             codec.EncodeData(70000, '') +
+                             codec.EncodeClose(7))
+    self.assertEqual(3, len(frames))
+    self.assertEqual(7, frames[0].index)
+    self.assertEqual('{"a":"b"}', frames[0].payload)
+    self.assertEqual(70000, frames[1].index)
+    self.assertEqual('', frames[1].payload)
+    self.assertTrue(frames[2].IsClose())
+
+  def testBinaryHeaderSize(self):
+    codec = framing.BinaryFraming()
+    header, payload = codec.EncodeData(1, 'xyz')
+    self.assertEqual(framing.BINARY_HEADER.size, len(header))
+    self.assertEqual('xyz', payload)
+
+  def testBinaryMalformed(self):
+    codec = framing.BinaryFraming()
+    with self.assertRaises(IOError):
+      self._Decode(codec, '{"i":1,"s":1}\n1')
+
+    frames, decoder = self._Decode(codec, codec.EncodeData(1, 'abc')[0][:4])
+    self.assertEqual([], frames)
+    self.assertTrue(decoder.HasPartialFrame())
+
+    frames, decoder = self._Decode(codec,
+                                   ''.join(codec.EncodeData(1, 'abc')) + 'a')
+    self.assertEqual(['abc'], [f.payload for f in frames])
+    self.assertTrue(decoder.HasPartialFrame())
+
+  def testDecoderAcceptsArbitraryChunks(self):
+    data = ''.join(framing.JsonFraming().EncodeData(1, '{"a":1}') +
+                   ('\n', '{"i":1,"s":"l"}\n', '{"b":2}\n') +
+                   framing.JsonFraming().EncodeClose(1))
+    for step in (1, 2, 5, len(data)):
+      frames, decoder = self._Decode(framing.JsonFraming(), data, step)
+      self.assertEqual(0, decoder.Pending())
+      self.assertSequenceEqual(['{"a":1}', '{"b":2}\n', None],
+                               [f.payload for f in frames])
+      self.assertTrue(frames[2].IsClose())
+
+  def testDecoderFuzz(self):
+    rng = random.Random(4)
+    captures = glob.glob(os.path.join(DIR_OF_CURRENT_SCRIPT, 'streams', '*.in'))
+    self.assertTrue(captures)
+
+    codec = framing.BinaryFraming()
+    binary = ''.join(
+        ''.join(codec.EncodeData(index, 'x' * size))
+        for (index, size) in ((1, 0), (2, 70000), (1, 3), (3, 20)))
+    inputs = [(framing.JsonFraming(), open(path, 'rb').read())
+              for path in captures] + [(codec, binary)]
+
+    for (codec, data) in inputs:
+      expected, _ = self._Decode(codec, data)
+      for _ in range(50):
+        decoder = framing.FrameDecoder()
+        frames = []
+        offset = 0
+        while offset < len(data):
+          size = rng.choice((1, 2, 3, 7, 64, 4096))
+          decoder.Feed(data[offset:offset + size])
+          offset += size
+          while rng.random() < 0.9:
+            frame = decoder.Next(codec)
+            if frame is None:
+              break
+            frames.append(frame)
+        while True:
+          frame = decoder.Next(codec)
+          if frame is None:
+            break
+          frames.append(frame)
+
+        self.assertEqual([(f.index, f.flags, f.payload) for f in expected],
+                         [(f.index, f.flags, f.payload) for f in frames])
+        self.assertFalse(decoder.HasPartialFrame())
+
+  def testDecoderWaitsForWholePayload(self):
+    codec = framing.BinaryFraming()
+    header, payload = codec.EncodeData(1, 'x' * 10000)
+    decoder = framing.FrameDecoder()
+    decoder.Feed(header)
+    self.assertEqual(None, decoder.Next(codec))
+    for offset in range(0, len(payload) - 100, 100):
+      decoder.Feed(payload[offset:offset + 100])
+      self.assertEqual(None, decoder.Next(codec))
+    # Nothing is copied until the whole payload is there.
+    self.assertEqual(99, len(decoder.chunks))
+    decoder.Feed(payload[-100:])
+    self.assertEqual(payload, decoder.Next(codec).payload)
+    self.assertEqual(0, decoder.Pending())
+
+  def testDecoderStraddlingHeader(self):
+    codec = framing.JsonFraming()
+    decoder = framing.FrameDecoder()
+    large = '"s":3}\nabc' + ''.join(codec.EncodeData(2, 'x' * 100000))
+    decoder.Feed('{"i":1,')
+    decoder.Feed(large)
+    self.assertEqual('abc', decoder.Next(codec).payload)
+    # Only the start of the large chunk was copied to decode the header.
+    self.assertIs(large, decoder.chunks[0])
+    self.assertEqual(100000, len(decoder.Next(codec).payload))
+
+    # Headers longer than the first probe, and spanning several chunks.
+    header = '{"i":3,"s":1,"pad":"%s"}\n' % ('p' * 1000)
+    for chunks in ((header[:5], header[5:] + 'a'),
+                   (header[:5], header[5:600], header[600:] + 'a')):
+      for chunk in chunks:
+        decoder.Feed(chunk)
+      frame = decoder.Next(codec)
+      self.assertEqual((3, 'a'), (frame.index, frame.payload))
+      self.assertEqual(0, decoder.Pending())
+
+  def testDecoderBinary(self):
+    codec = framing.BinaryFraming()
+    data = ''.join(codec.EncodeData(3, 'abc') + codec.EncodeClose(3))
+    decoder = framing.FrameDecoder()
+    decoder.Feed(data[:5])
+    self.assertEqual(None, decoder.Next(codec))
+    decoder.Feed(data[5:])
+    self.assertEqual('abc', decoder.Next(codec).payload)
+    self.assertTrue(decoder.Next(codec).IsClose())
+    self.assertEqual(None, decoder.Next(codec))
+
+  def testBinaryHandshakeNotAllowed(self):
+    with self.assertRaises(ValueError):
+      framing.BinaryFraming().EncodeHandshake({})
+
+
+if __name__ == '__main__':
+  unittest.main()
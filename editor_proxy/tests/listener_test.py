@@ -0,0 +1,160 @@
+"""Tests for listener."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import listener
+from editor_proxy.chunked import ChunkedPipe
+from editor_proxy.framing import FrameDecoder, JsonFraming
+from editor_proxy.pipe_server import PipeServer
+
+REQUEST = '{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n'
+
+TOKEN = 'secret'
+
+
+class ListenerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'proxy')
+    self.served = []
+    self.server = PipeServer(self.App, None)
+    self.listener = listener.Listener(self.server, ChunkedPipe, TOKEN)
+    self.listener.ListenUnix(self.path)
+    self.listener.ListenTcp(0)
+    self.listener.Start()
+
+  def tearDown(self):
+    self.listener.Close()
+    self.assertFalse(os.path.exists(self.path))
+    self.server.Shutdown()
+    shutil.rmtree(self.directory)
+
+  def App(self, environ, start_response):
+    self.served.append(environ['PATH_INFO'])
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(len(self.served))]
+
+  def Connect(self, tcp=False, token=TOKEN):
+    if tcp:
+      client = socket.create_connection((listener.LOOPBACK,
+                                         self.listener.Details()['port']))
+      client.sendall(json.dumps({'token': token}) + '\n')
+    else:
+      client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      client.connect(self.path)
+    # Otherwise closing the listener waits for the client.
+    self.addCleanup(client.close)
+    return client
+
+  def Finish(self, client):
+    """Ends the client's input and returns the payloads it received."""
+    client.shutdown(socket.SHUT_WR)
+    data = []
+    while True:
+      chunk = client.recv(4096)
+      if not chunk:
+        break
+      data.append(chunk)
+    client.close()
+
+    decoder = FrameDecoder()
+    decoder.Feed(''.join(data))
+    payloads = []
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        return payloads
+      if frame.payload is not None:
+        payloads.append((frame.index, json.loads(frame.payload)['o']))
+
+  def testClientsShareTheApp(self):
+    first = self.Connect()
+    second = self.Connect(tcp=True)
+    # Both clients use the same stream id.
+    first.sendall(REQUEST)
+    second.sendall(REQUEST)
+    while len(self.served) < 2:
+      time.sleep(0.01)
+
+    clients = self.server.Stats()['clients']
+    self.assertEqual(['tcp', 'unix'],
+                     sorted(name.split('-')[0] for name in clients))
+    self.assertEqual([1, 1],
+                     [client['requests'] for client in clients.values()])
+
+    self.assertEqual(1, len(self.Finish(first)))
+    self.assertEqual(1, len(self.Finish(second)))
+    self.assertEqual({}, self.server.Stats()['clients'])
+
+  def testTcpNeedsToken(self):
+    self.assertEqual({'port', 'socket', 'token'},
+                     set(self.listener.Details()))
+    client = self.Connect(tcp=True, token='wrong')
+    self.assertEqual([], self.Finish(client))
+    self.assertEqual([], self.served)
+
+    client = self.Connect(tcp=True)
+    client.sendall(REQUEST)
+    self.assertEqual([(1, 1)], self.Finish(client))
+
+  def testTokenLineIsBounded(self):
+    client = self.Connect(tcp=True, token='x' * listener.MAX_TOKEN_LINE)
+    try:
+      self.assertEqual('', client.recv(4096))
+    except socket.error as e:
+      # The client's input was cut off unread.
+      self.assertEqual(errno.ECONNRESET, e.errno)
+    self.assertEqual([], self.served)
+
+  def testTokenDeadline(self):
+    auth_timeout = listener.AUTH_TIMEOUT
+    listener.AUTH_TIMEOUT = 0.2
+    self.addCleanup(setattr, listener, 'AUTH_TIMEOUT', auth_timeout)
+    client = socket.create_connection((listener.LOOPBACK,
+                                       self.listener.Details()['port']))
+    self.addCleanup(client.close)
+
+    started = time.time()
+    with self.assertRaises(socket.error):
+      # Trickling the line in doesn't buy the client any more time.
+      for c in json.dumps({'token': TOKEN}) * 10:
+        client.sendall(c)
+        time.sleep(0.05)
+    self.assertLess(time.time() - started, 2)
+
+  def testCloseWaitsForClients(self):
+    client = self.Connect()
+    client.sendall(REQUEST)
+    while not self.served:
+      time.sleep(0.01)
+
+    closing = Thread(target=self.listener.Close)
+    closing.start()
+    closing.join(0.1)
+    self.assertTrue(closing.is_alive())
+    self.assertFalse(os.path.exists(self.path))
+    self.assertEqual([(1, 1)], self.Finish(client))
+    closing.join()
+    self.assertEqual({'clients': 0, 'accepted': 1}, self.listener.Stats())
+
+
+if __name__ == '__main__':
+  unittest.main()
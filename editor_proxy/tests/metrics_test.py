@@ -0,0 +1,88 @@
+"""Tests for metrics."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+  def testHistogram(self):
+    histogram = metrics.Histogram((1, 10, 100))
+    self.assertEqual(None, histogram.Percentile(0.5))
+    for value in (0.5, 2, 3, 5, 50, 500):
+      histogram.Record(value)
+
+    snapshot = histogram.Snapshot()
+    self.assertEqual(6, snapshot['count'])
+    self.assertEqual(0.5, snapshot['min'])
+    self.assertEqual(500, snapshot['max'])
+    self.assertEqual(10, snapshot['p50'])
+    self.assertEqual(500, snapshot['p99'])
+    self.assertEqual([[1, 1], [10, 3], [100, 1], [None, 1]],
+                     snapshot['buckets'])
+
+  def testPercentileNeverExceedsMax(self):
+    histogram = metrics.Histogram((1, 10, 100))
+    histogram.Record(20)
+    self.assertEqual(20, histogram.Percentile(0.5))
+
+  def testSnapshot(self):
+    m = metrics.Metrics()
+    m.Add('requests')
+    m.Add('requests', 2)
+    m.Add('running', 1)
+    m.Add('running', -1)
+    m.Observe('total_ms', 3, '/completions')
+    m.Observe('response_bytes', 100, '/completions', metrics.SIZE_BUCKETS)
+    m.Track('answer', lambda: 42)
+
+    snapshot = m.Snapshot()
+    self.assertEqual({'requests': 3, 'running': 0}, snapshot['counters'])
+    self.assertEqual({'answer': 42}, snapshot['gauges'])
+    self.assertEqual(1, snapshot['histograms']['total_ms']['/completions']
+                     ['count'])
+    self.assertEqual([[256, 1]], snapshot['histograms']['response_bytes']
+                     ['/completions']['buckets'])
+
+  def testLabelsAreLimited(self):
+    m = metrics.Metrics()
+    for n in range(metrics.MAX_LABELS + 10):
+      m.Observe('total_ms', 1, '/path{}'.format(n))
+    m.Observe('total_ms', 1, '/path0')
+
+    labels = m.Snapshot()['histograms']['total_ms']
+    self.assertEqual(metrics.MAX_LABELS + 1, len(labels))
+    self.assertEqual(10, labels[metrics.OTHER_LABEL]['count'])
+    self.assertEqual(2, labels['/path0']['count'])
+
+  def testDumper(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'metrics.json')
+      dumper = metrics.MetricsDumper(path, lambda: {'a': 1}, interval=60)
+      dumper.start()
+      dumper.Stop()
+
+      with open(path) as f:
+        self.assertEqual({'a': 1}, json.load(f)['metrics'])
+      self.assertEqual(['metrics.json'], os.listdir(directory))
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
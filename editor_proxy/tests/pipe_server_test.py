@@ -4,10 +4,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import os
 import sys
+import time
 import unittest
+from Queue import Queue
 from StringIO import StringIO
+from threading import Event, Thread
 
 DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(
@@ -19,8 +23,10 @@ sys.path.insert(
                      'third_party', 'bottle')))
 
 from bottle import get, post, request, Response, Bottle, debug
-from editor_proxy.pipe_server import PipeServer
+from editor_proxy.pipe_server import PipeServer, PooledResponse, SplicedFrame
+from editor_proxy.worker_pool import WorkerPool
 from editor_proxy.chunked import ChunkedPipe
+from editor_proxy.framing import FrameDecoder, JsonFraming
 
 debug(True)  # Enables debugging in Bottle.
 
@@ -47,6 +53,469 @@ class PipeServerTest(unittest.TestCase):
 
     self.assertEqual(expected, out.getvalue())
 
+  def testJsonResponseIsSpliced(self):
+
+    def App(environ, start_response):
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{"completions":', ' [1, 2]}']
+
+    for splice_json in (True, False):
+      out = StringIO()
+      inp = StringIO('{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n')
+      PipeServer(App, ChunkedPipe(inp, out), splice_json=splice_json).Run()
+
+      decoder = FrameDecoder()
+      decoder.Feed(out.getvalue())
+      payload = decoder.Next(JsonFraming()).payload
+      self.assertEqual({'completions': [1, 2]}, json.loads(payload)['o'])
+      # Spliced bodies go out exactly as the app wrote them.
+      self.assertEqual(splice_json, '"o":{"completions": [1, 2]}' in payload)
+
+  def testMetrics(self):
+
+    def App(environ, start_response):
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    out = StringIO()
+    inp = StringIO('{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n'
+                   '{"i":2,"s":"l"}\n{"p":"/_proxy/metrics"}\n')
+    server = PipeServer(App, ChunkedPipe(inp, out))
+    server.Run()
+
+    decoder = FrameDecoder()
+    decoder.Feed(out.getvalue())
+    responses = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        break
+      if frame.payload is not None:
+        responses[frame.index] = json.loads(frame.payload)
+
+    # The metrics request was answered by the server, not the app.
+    self.assertIn('pipe', responses[2]['o'])
+    histograms = server.Stats()['metrics']['histograms']
+    self.assertEqual(1, histograms['total_ms']['/completions']['count'])
+    self.assertEqual(1, histograms['first_byte_ms']['/completions']['count'])
+
+  def testRequestsWaitForApp(self):
+
+    def App(environ, start_response):
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['"done"']
+
+    out = StringIO()
+    inp = StringIO('{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n'
+                   '{"i":2,"s":"l"}\n{"p":"/ready"}\n')
+    server = PipeServer(None, ChunkedPipe(inp, out))
+    self.assertEqual('starting', server.State())
+    thread = Thread(target=server.Run)
+    thread.start()
+    while len(server.waiting) < 1:
+      time.sleep(0.01)
+
+    server.SetApp(App)
+    thread.join()
+    self.assertEqual('ready', server.State())
+
+    decoder = FrameDecoder()
+    decoder.Feed(out.getvalue())
+    responses = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        break
+      if frame.payload is not None:
+        responses[frame.index] = json.loads(frame.payload)
+
+    self.assertEqual('done', responses[1]['o'])
+    self.assertEqual('503 Service Unavailable', responses[2]['st'])
+    self.assertEqual({'state': 'starting'}, responses[2]['o'])
+
+  def testFailedStartup(self):
+    out = StringIO()
+    inp = StringIO('{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n')
+    server = PipeServer(None, ChunkedPipe(inp, out))
+    thread = Thread(target=server.Run)
+    thread.start()
+    while len(server.waiting) < 1:
+      time.sleep(0.01)
+
+    server.FailStartup('no ycmd')
+    thread.join()
+    self.assertEqual('failed', server.State())
+    self.assertIn('"message":"no ycmd"', out.getvalue())
+
+  def testServeSeveralPipes(self):
+    served = []
+
+    def App(environ, start_response):
+      served.append(environ['PATH_INFO'])
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return [json.dumps(len(served))]
+
+    server = PipeServer(App, None)
+    for n in range(2):
+      out = StringIO()
+      server.Serve(
+          ChunkedPipe(
+              StringIO('{"i":1,"s":"l"}\n{"p":"/completions","o":{}}\n'),
+              out))
+      self.assertIn('"o":{}'.format(n + 1), out.getvalue())
+    server.Shutdown()
+    self.assertEqual(0, server.Stats()['pipe']['streams']['active'])
+
+  def testClientsKeepTheirOwnBuffers(self):
+
+    def App(environ, start_response):
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return [environ['wsgi.input'].read()]
+
+    def Request(index, file_data):
+      return '{"i":%d,"s":"l"}\n' % index + json.dumps({
+          'p': '/completions',
+          'fd': 1,
+          'o': {
+              'filepath': '/a',
+              'file_data': {
+                  '/a': file_data
+              }
+          }
+      }) + '\n'
+
+    stored = Request(1, {'contents': 'abc', 'version': 1, 'filetypes': []})
+    edited = Request(3, {'base_version': 1, 'delta': [[0, 1, 'x']],
+                         'version': 2, 'filetypes': []})
+    server = PipeServer(App, None)
+    outputs = {}
+    for (name, data) in (('a', stored + edited), ('b', edited)):
+      outputs[name] = StringIO()
+      server.Serve(ChunkedPipe(StringIO(data), outputs[name]), name)
+    server.Shutdown()
+
+    self.assertIn('"contents": "xbc"', outputs['a'].getvalue())
+    self.assertIn('412 Precondition Failed', outputs['b'].getvalue())
+
+  def testStreamedEventNotificationInvalidates(self):
+    served = []
+
+    def App(environ, start_response):
+      served.append(environ['PATH_INFO'])
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    info = ('{"i":1,"s":"l"}\n'
+            '{"p":"/debug_info","m":"POST","o":{"filepath":"/a"}}\n')
+    # The body of the event notification follows its header.
+    event = ('{"i":3,"s":"l"}\n{"p":"/event_notification","m":"POST"}\n'
+             '{"i":3,"s":"l"}\n{"d":"{\\"filepath\\":"}\n'
+             '{"i":3,"s":"l"}\n{"d":" \\"/a\\"}"}\n'
+             '{"i":3,"close":true}\n')
+    server = PipeServer(App, None)
+    for data in (info, info, event, info):
+      server.Serve(ChunkedPipe(StringIO(data), StringIO()))
+    server.Shutdown()
+
+    self.assertEqual(['/debug_info', '/event_notification', '/debug_info'],
+                     served)
+    self.assertEqual(1, server.Stats()['cache']['invalidations'])
+
+  def testStreamedEventNotificationDoesntHoldUpOthers(self):
+    served = Queue()
+
+    def App(environ, start_response):
+      served.put((environ['PATH_INFO'], environ['wsgi.input'].read()))
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    info = ('{"i":%d,"s":"l"}\n'
+            '{"p":"/debug_info","m":"POST","o":{"filepath":"/a"}}\n')
+    (in_r, in_w) = os.pipe()
+    server = PipeServer(App, ChunkedPipe(os.fdopen(in_r, 'rb'), StringIO()))
+    thread = Thread(target=server.Run)
+    thread.start()
+    try:
+      os.write(in_w, info % 1)
+      self.assertEqual('/debug_info', served.get(timeout=5)[0])
+
+      # The body of the event notification is still on its way. The request
+      # after it is served, and not from the cache.
+      os.write(in_w, '{"i":3,"s":"l"}\n{"p":"/event_notification"}\n' +
+               info % 5)
+      self.assertEqual('/debug_info', served.get(timeout=5)[0])
+
+      os.write(in_w, '{"i":3,"s":"l"}\n{"d":"{\\"filepath\\":\\"/a\\"}"}\n'
+               '{"i":3,"close":true}\n')
+      self.assertEqual(('/event_notification', '{"filepath":"/a"}'),
+                       served.get(timeout=5))
+    finally:
+      os.close(in_w)
+      thread.join()
+    self.assertEqual(0, server.Stats()['cache']['held'])
+
+  def testStreamedFileDataDoesntHoldUpOthers(self):
+    served = Queue()
+
+    def App(environ, start_response):
+      served.put((environ['PATH_INFO'], environ['wsgi.input'].read()))
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    event = json.dumps({
+        'filepath': '/a',
+        'file_data': {
+            '/a': {'contents': 'abc', 'version': 1, 'filetypes': []}
+        }
+    })
+    completions = json.dumps({
+        'p': '/completions',
+        'fd': 1,
+        'o': {
+            'filepath': '/a',
+            'line_num': 1,
+            'column_num': 4,
+            'file_data': {
+                '/a': {
+                    'base_version': 1,
+                    'delta': [[3, 3, 'd']],
+                    'version': 2,
+                    'filetypes': []
+                }
+            }
+        }
+    })
+    (in_r, in_w) = os.pipe()
+    server = PipeServer(
+        App, ChunkedPipe(os.fdopen(in_r, 'rb'), StringIO()), workers=3)
+    thread = Thread(target=server.Run)
+    thread.start()
+    try:
+      # The completion request builds on the version stored by the event
+      # notification, whose body is still on its way.
+      os.write(in_w, '{"i":1,"s":"l"}\n'
+               '{"p":"/event_notification","m":"POST","fd":1}\n'
+               '{"i":3,"s":"l"}\n' + completions + '\n'
+               '{"i":5,"s":"l"}\n{"p":"/debug_info","o":{}}\n')
+      self.assertEqual(('/debug_info', '{}'), served.get(timeout=5))
+
+      os.write(in_w, '{"i":1,"s":"l"}\n' + json.dumps({'d': event}) + '\n'
+               '{"i":1,"close":true}\n')
+      bodies = dict(served.get(timeout=5) for _ in range(2))
+    finally:
+      os.close(in_w)
+      thread.join()
+
+    contents = dict((path, json.loads(body)['file_data']['/a']['contents'])
+                    for (path, body) in bodies.items())
+    self.assertEqual({
+        '/event_notification': 'abc',
+        '/completions': 'abcd'
+    }, contents)
+
+  def testSupersededRequestAcksFileData(self):
+    release = Event()
+
+    def App(environ, start_response):
+      release.wait()
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    def Completions(index, version):
+      return '{"i":%d,"s":"l"}\n' % index + json.dumps({
+          'p': '/completions',
+          'fd': 1,
+          'o': {
+              'filepath': '/a',
+              'line_num': 1,
+              'column_num': 2,
+              'file_data': {
+                  '/a': {'contents': 'ab', 'version': version, 'filetypes': []}
+              }
+          }
+      }) + '\n'
+
+    out = StringIO()
+    inp = StringIO('{"i":1,"s":"l"}\n{"p":"/slow","o":{}}\n' +
+                   Completions(3, 1) + Completions(5, 2))
+    server = PipeServer(App, ChunkedPipe(inp, out), workers=1)
+    thread = Thread(target=server.Run)
+    thread.start()
+    while server.Stats()['coalescer']['coalesced'] != {'/completions': 1}:
+      time.sleep(0.01)
+    release.set()
+    thread.join()
+
+    decoder = FrameDecoder()
+    decoder.Feed(out.getvalue())
+    responses = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        break
+      if frame.payload is not None:
+        responses[frame.index] = json.loads(frame.payload)
+
+    self.assertIn(['X-Superseded', '1'], responses[3]['h'])
+    self.assertEqual({'/a': 1}, responses[3]['fd'])
+    self.assertEqual({'/a': 2}, responses[5]['fd'])
+
+  def testStreamedCompletionsDontHoldUpOthers(self):
+    served = Queue()
+
+    def App(environ, start_response):
+      served.put((environ['PATH_INFO'], environ['wsgi.input'].read()))
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    (in_r, in_w) = os.pipe()
+    server = PipeServer(App, ChunkedPipe(os.fdopen(in_r, 'rb'), StringIO()))
+    thread = Thread(target=server.Run)
+    thread.start()
+
+    try:
+      # The body of the completion request is still on its way while the next
+      # request arrives.
+      os.write(in_w, '{"i":1,"s":"l"}\n{"p":"/completions","m":"POST"}\n'
+               '{"i":3,"s":"l"}\n{"p":"/debug_info","m":"GET"}\n'
+               '{"i":3,"close":true}\n')
+      self.assertEqual(('/debug_info', ''), served.get(timeout=5))
+
+      body = json.dumps({'filepath': '/a', 'line_num': 1, 'column_num': 1})
+      os.write(in_w, '{"i":1,"s":"l"}\n' + json.dumps({'d': body}) + '\n'
+               '{"i":1,"close":true}\n')
+      self.assertEqual(('/completions', body), served.get(timeout=5))
+    finally:
+      os.close(in_w)
+      thread.join()
+
+  def testStreamedRequestDoesntSupersedeNewerOne(self):
+    release = Event()
+
+    def App(environ, start_response):
+      release.wait()
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    body = json.dumps({'filepath': '/a', 'line_num': 1, 'column_num': 1})
+    # The older request's body comes in frames of its own, so it's only
+    # coalesced once it runs, after the newer one was queued. The slow request
+    # goes first, so that the others wait in the queue.
+    inp = StringIO('{"i":1,"s":"l"}\n'
+                   '{"p":"/slow","h":[["X-Ycm-Priority","interactive"]]}\n'
+                   '{"i":3,"s":"l"}\n{"p":"/completions","m":"POST"}\n'
+                   '{"i":3,"s":"l"}\n' + json.dumps({'d': body}) + '\n'
+                   '{"i":3,"close":true}\n'
+                   '{"i":5,"s":"l"}\n' + json.dumps({
+                       'p': '/completions',
+                       'o': json.loads(body)
+                   }) + '\n')
+    out = StringIO()
+    server = PipeServer(App, ChunkedPipe(inp, out), workers=1)
+    thread = Thread(target=server.Run)
+    thread.start()
+    # Only the newer request is admitted to the coalescer while it's queued.
+    while server.Stats()['coalescer']['queued'] < 1:
+      time.sleep(0.01)
+    release.set()
+    thread.join()
+
+    decoder = FrameDecoder()
+    decoder.Feed(out.getvalue())
+    responses = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        break
+      if frame.payload is not None:
+        responses[frame.index] = json.loads(frame.payload)
+
+    self.assertIn(['X-Superseded', '1'], responses[3]['h'])
+    self.assertEqual({}, responses[5]['o'])
+
+  def testCancelledRequestLeavesQueue(self):
+    release = Event()
+
+    def App(environ, start_response):
+      release.wait()
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['{}']
+
+    (in_r, in_w) = os.pipe()
+    out = StringIO()
+    server = PipeServer(App, ChunkedPipe(os.fdopen(in_r, 'rb'), out), workers=1)
+    thread = Thread(target=server.Run)
+    thread.start()
+    try:
+      os.write(in_w, '{"i":1,"s":"l"}\n{"p":"/slow","o":{}}\n'
+               '{"i":3,"s":"l"}\n{"p":"/queued","o":{}}\n')
+      while server.Stats()['pool']['depth'] < 1:
+        time.sleep(0.01)
+
+      # The cancelled request is dropped while the only worker is still busy.
+      os.write(in_w, '{"i":3,"cancel":true}\n')
+      deadline = time.time() + 5
+      while server.Stats()['pool']['depth'] > 0 and time.time() < deadline:
+        time.sleep(0.01)
+      self.assertEqual(0, server.Stats()['pool']['depth'])
+    finally:
+      release.set()
+      os.close(in_w)
+      thread.join()
+    self.assertNotIn('"i":3,"s"', out.getvalue())
+
+  def testPooledResponseFreesWorker(self):
+    release = Event()
+    served = Queue()
+    relays = WorkerPool(1)
+    relays.Start()
+
+    def Slow(start_response):
+      release.wait()
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      yield '"slow"'
+
+    def App(environ, start_response):
+      served.put(environ['PATH_INFO'])
+      if environ['PATH_INFO'] == '/slow':
+        return PooledResponse(relays, Slow(start_response))
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return ['"fast"']
+
+    (in_r, in_w) = os.pipe()
+    out = StringIO()
+    server = PipeServer(App, ChunkedPipe(os.fdopen(in_r, 'rb'), out), workers=1)
+    thread = Thread(target=server.Run)
+    thread.start()
+    try:
+      os.write(in_w, '{"i":1,"s":"l"}\n{"p":"/slow","o":{}}\n')
+      self.assertEqual('/slow', served.get(timeout=5))
+      # The only worker is free while the slow response is on its way.
+      os.write(in_w, '{"i":3,"s":"l"}\n{"p":"/fast","o":{}}\n')
+      self.assertEqual('/fast', served.get(timeout=5))
+    finally:
+      release.set()
+      os.close(in_w)
+      thread.join()
+      relays.Shutdown()
+
+    decoder = FrameDecoder()
+    decoder.Feed(out.getvalue())
+    payloads = {}
+    while True:
+      frame = decoder.Next(JsonFraming())
+      if frame is None:
+        break
+      if frame.payload is not None:
+        payloads[frame.index] = json.loads(frame.payload)['o']
+    self.assertEqual({1: 'slow', 3: 'fast'}, payloads)
+
+  def testSplicedFrame(self):
+    frame = SplicedFrame({'st': '200 OK'}, '{"a": 1}')
+    self.assertEqual({'st': '200 OK', 'o': {'a': 1}}, json.loads(frame.data))
+    self.assertEqual({'st': '200 OK', 'o': None},
+                     json.loads(SplicedFrame({'st': '200 OK'}, ' ').data))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,113 @@
+"""Tests for response_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import response_cache
+
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.cache = response_cache.ResponseCache(
+        allowlist={'/healthy': 1.0, '/debug_info': 5.0},
+        max_entries=2,
+        clock=self.clock)
+
+  def testOnlyAllowlistedPathsAreCacheable(self):
+    self.assertIsNone(self.cache.Key('POST', '/completions', '', '{}'))
+    self.assertIsNotNone(self.cache.Key('GET', '/healthy', '', ''))
+
+  def testKeyIgnoresJsonFormatting(self):
+    self.assertEqual(
+        self.cache.Key('POST', '/debug_info', '', '{"a": 1, "b": [2]}'),
+        self.cache.Key('POST', '/debug_info', '', '{"b":[2],"a":1}'))
+    self.assertNotEqual(
+        self.cache.Key('POST', '/debug_info', '', '{"a":1}'),
+        self.cache.Key('POST', '/debug_info', '', '{"a":2}'))
+    self.assertNotEqual(
+        self.cache.Key('GET', '/healthy', '', ''),
+        self.cache.Key('GET', '/healthy', 'subserver=cpp', ''))
+
+  def testHitAndExpiry(self):
+    key = self.cache.Key('GET', '/healthy', '', '')
+    self.assertIsNone(self.cache.Get(key))
+    self.cache.Put(key, ['frame'])
+    self.assertEqual(['frame'], self.cache.Get(key))
+
+    self.clock.now += 1.0
+    self.assertIsNone(self.cache.Get(key))
+    stats = self.cache.Stats()
+    self.assertEqual(1, stats['hits'])
+    self.assertEqual(2, stats['misses'])
+    self.assertEqual(0, stats['entries'])
+
+  def testLeastRecentlyUsedIsEvicted(self):
+    keys = [
+        self.cache.Key('POST', '/debug_info', '', '{"n":%d}' % n)
+        for n in range(3)
+    ]
+    self.cache.Put(keys[0], [0])
+    self.cache.Put(keys[1], [1])
+    self.cache.Get(keys[0])
+    self.cache.Put(keys[2], [2])
+
+    self.assertEqual([0], self.cache.Get(keys[0]))
+    self.assertIsNone(self.cache.Get(keys[1]))
+    self.assertEqual([2], self.cache.Get(keys[2]))
+    self.assertEqual(1, self.cache.Stats()['evictions'])
+
+  def testInvalidate(self):
+    a = self.cache.Key('POST', '/debug_info', '', '{"filepath":"/a.cc"}')
+    b = self.cache.Key('POST', '/debug_info', '', '{"filepath":"/b.cc"}')
+    self.cache.Put(a, ['a'], '/a.cc')
+    self.cache.Put(b, ['b'], '/b.cc')
+
+    self.cache.Invalidate('/a.cc')
+    self.assertIsNone(self.cache.Get(a))
+    self.assertEqual(['b'], self.cache.Get(b))
+    self.assertEqual(1, self.cache.Stats()['invalidations'])
+
+  def testHold(self):
+    a = self.cache.Key('POST', '/debug_info', '', '{"filepath":"/a.cc"}')
+    b = self.cache.Key('POST', '/debug_info', '', '{"filepath":"/b.cc"}')
+    self.cache.Put(a, ['a'], '/a.cc')
+    self.cache.Put(b, ['b'], '/b.cc')
+
+    self.cache.Hold()
+    self.assertIsNone(self.cache.Get(a))
+    self.assertIsNone(self.cache.Get(b))
+    self.cache.Release('/a.cc')
+    self.assertIsNone(self.cache.Get(a))
+    self.assertEqual(['b'], self.cache.Get(b))
+    self.assertEqual(0, self.cache.Stats()['held'])
+
+  def testFilepathOf(self):
+    self.assertEqual('/a.cc',
+                     response_cache.FilepathOf('{"filepath":"/a.cc"}'))
+    self.assertIsNone(response_cache.FilepathOf('[1]'))
+    self.assertIsNone(response_cache.FilepathOf('not json'))
+    self.assertIsNone(response_cache.FilepathOf(None))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,141 @@
+"""Tests for select_pipe."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gc
+import os
+import sys
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from threading import Thread
+from editor_proxy import framing
+from editor_proxy.select_pipe import SelectPipe
+
+
+class OutputCollector(Thread):
+
+  def __init__(self, fd):
+    super(OutputCollector, self).__init__()
+    self.fd = fd
+    self.chunks = []
+
+  def run(self):
+    while True:
+      data = os.read(self.fd, 4096)
+      if not data:
+        return
+      self.chunks.append(data)
+
+  def Value(self):
+    return ''.join(self.chunks)
+
+
+class SelectPipeTest(unittest.TestCase):
+
+  def _Echo(self, data):
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    collector = OutputCollector(out_r)
+    collector.start()
+
+    inp = os.fdopen(in_r, 'r')
+    out = os.fdopen(out_w, 'w')
+    pipe = SelectPipe(inp, out)
+
+    os.write(in_w, data)
+    os.close(in_w)
+
+    for stream in pipe:
+      for o in stream:
+        stream.Write(o)
+      stream.Close()
+
+    pipe.Join()
+    out.close()
+    inp.close()
+    collector.join()
+    os.close(out_r)
+    return collector.Value()
+
+  def testInterleavedInputs(self):
+    with open('streams/interleaved.in', 'r') as f:
+      data = f.read()
+
+    self.assertEqual('{"i":1,"s":7}\n{"a":1}'
+                     '{"i":1,"s":7}\n{"a":1}'
+                     '{"i":1,"close":true}\n'
+                     '{"i":2,"s":7}\n{"a":2}'
+                     '{"i":2,"s":7}\n{"a":2}'
+                     '{"i":2,"close":true}\n'
+                     '{"i":3,"s":7}\n{"a":3}'
+                     '{"i":3,"close":true}\n', self._Echo(data))
+
+  def testBinaryHandshake(self):
+    binary = framing.BinaryFraming()
+    data = ''.join(('{"hs":{"framing":["binary"]}}\n',) +
+                   binary.EncodeData(4, '{"a":1}') + binary.EncodeClose(4))
+    self.assertEqual(
+        ''.join(('{"hs":{"framing":"binary"}}\n',) +
+                binary.EncodeData(4, '{"a":1}') + binary.EncodeClose(4)),
+        self._Echo(data))
+
+  def testLargePayload(self):
+    payload = '"{}"'.format('x' * 200000)
+    data = '{{"i":1,"s":{}}}\n{}'.format(len(payload), payload)
+    self.assertEqual(
+        '{{"i":1,"s":{}}}\n{}{{"i":1,"close":true}}\n'.format(
+            len(payload), payload), self._Echo(data))
+
+  def testInputFileIsKeptOpen(self):
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    collector = OutputCollector(out_r)
+    collector.start()
+
+    # Nothing but the pipe refers to the input file.
+    out = os.fdopen(out_w, 'w')
+    pipe = SelectPipe(os.fdopen(in_r, 'r'), out)
+    gc.collect()
+
+    os.write(in_w, '{"i":1,"s":7}\n{"a":1}')
+    os.close(in_w)
+    for stream in pipe:
+      self.assertEqual({'a': 1}, stream.Read())
+      stream.Close()
+
+    pipe.Join()
+    out.close()
+    collector.join()
+    os.close(out_r)
+
+  def testBrokenOutput(self):
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    os.close(out_r)
+
+    inp = os.fdopen(in_r, 'r')
+    out = os.fdopen(out_w, 'w')
+    pipe = SelectPipe(inp, out)
+    os.write(in_w, '{"i":1,"s":7}\n{"a":1}')
+    os.close(in_w)
+
+    for stream in pipe:
+      for n in range(1000):
+        stream.Write({'n': n})
+      stream.Close()
+
+    pipe.Join()
+    self.assertFalse(pipe.output_thread.is_alive())
+    self.assertTrue(pipe.output_thread.broken)
+    out.close()
+    inp.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
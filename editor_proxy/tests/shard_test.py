@@ -0,0 +1,207 @@
+"""Tests for shard."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_PARENT = os.path.normpath(
+    os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..'))
+sys.path.insert(0, PACKAGE_PARENT)
+
+from editor_proxy import shard
+
+# A shard serving an app that describes the requests it gets.
+SHARD = """
+import json, os, sys
+sys.path.insert(0, {!r})
+from editor_proxy.chunked import ChunkedPipe
+from editor_proxy.pipe_server import PipeServer
+
+def App(environ, start_response):
+  path = environ['PATH_INFO']
+  if path == '/crash':
+    os._exit(1)
+  if path == '/text':
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['a', 'b']
+  body = environ['wsgi.input'].read()
+  start_response('200 OK', [('Content-Type', 'application/json')])
+  return [json.dumps({{
+      'pid': os.getpid(),
+      'path': path,
+      'body': body,
+      'header': environ.get('HTTP_X_TEST')
+  }})]
+
+pipe = ChunkedPipe(sys.stdin, sys.stdout)
+pipe.CreateStream(0, out_of_band=True).Write({{'state': 'ready'}})
+PipeServer(App, pipe).Run()
+""".format(PACKAGE_PARENT)
+
+
+def Request(filetype=None):
+  if filetype is None:
+    return {}
+  return {
+      'filepath': '/a',
+      'file_data': {
+          '/a': {
+              'filetypes': [filetype]
+          }
+      }
+  }
+
+
+class ShardedAppTest(unittest.TestCase):
+
+  def setUp(self):
+    self.restart_delay = shard.RESTART_DELAY
+    shard.RESTART_DELAY = 0.01
+    self.output = []
+    self.shards = [
+        shard.Shard(index, lambda: [sys.executable, '-c', SHARD],
+                    on_output=self.OnOutput) for index in range(2)
+    ]
+    for s in self.shards:
+      s.Start()
+    self.app = shard.ShardedApp(self.shards,
+                                shard.ShardRouter(2, shard.FiletypeKey))
+
+  def tearDown(self):
+    for s in self.shards:
+      s.Stop()
+    self.app.Shutdown()
+    shard.RESTART_DELAY = self.restart_delay
+
+  def OnOutput(self, index, stream, obj):
+    self.output.append((index, stream, obj))
+
+  def Call(self, path, body=''):
+    """Returns the status, headers and body of the response to a request."""
+    response = {}
+
+    def start_response(status, headers):
+      response['status'] = status
+      response['headers'] = headers
+
+    environ = {
+        'PATH_INFO': path,
+        'REQUEST_METHOD': 'POST',
+        'QUERY_STRING': '',
+        'HTTP_X_TEST': 'x',
+        'wsgi.input': StringIO(body)
+    }
+    data = ''.join(self.app(environ, start_response))
+    return response['status'], response['headers'], data
+
+  def Describe(self, filetype=None):
+    (status, headers, data) = self.Call('/completions',
+                                        json.dumps(Request(filetype)))
+    self.assertEqual('200 OK', status)
+    self.assertEqual([('Content-Type', 'application/json')], headers)
+    return json.loads(data)
+
+  def testRelaysRequests(self):
+    described = self.Describe('cpp')
+    self.assertEqual('/completions', described['path'])
+    self.assertEqual(Request('cpp'), json.loads(described['body']))
+    self.assertEqual('x', described['header'])
+
+    self.assertEqual(('200 OK', [('Content-Type', 'text/plain')], 'ab'),
+                     self.Call('/text'))
+
+  def testRoutesByFiletype(self):
+    default = self.Describe()['pid']
+    cpp = self.Describe('cpp')['pid']
+    self.assertNotEqual(default, cpp)
+    # Both shards have a key now, so the next one goes to the first.
+    self.assertEqual(default, self.Describe('python')['pid'])
+    self.assertEqual(cpp, self.Describe('cpp')['pid'])
+    self.assertEqual({'cpp': 1, 'python': 0}, self.app.Stats()['routes'])
+
+  def testRestartsCrashedShards(self):
+    pid = self.Describe()['pid']
+    (status, _, _) = self.Call('/crash')
+    self.assertEqual(shard.BAD_GATEWAY, status)
+
+    # The next request waits for the shard to come back.
+    self.assertNotEqual(pid, self.Describe()['pid'])
+    self.assertEqual(1, self.app.Stats()['shards'][0]['restarts'])
+    self.assertIn((0, 0, {'state': 'ready'}), self.output)
+
+  def testDownShard(self):
+    send_timeout = shard.SEND_TIMEOUT
+    shard.SEND_TIMEOUT = 0.2
+    self.addCleanup(setattr, shard, 'SEND_TIMEOUT', send_timeout)
+    down = shard.Shard(0, None)
+    app = shard.ShardedApp([down], shard.ShardRouter(1, shard.FiletypeKey))
+    self.addCleanup(app.Shutdown)
+
+    environ = {
+        'PATH_INFO': '/completions',
+        'REQUEST_METHOD': 'POST',
+        'wsgi.input': StringIO('')
+    }
+    statuses = []
+    started = time.time()
+    response = app(environ, lambda status, headers: statuses.append(status))
+    # The wait for the shard is left to its own workers.
+    self.assertIs(app.pools[0], response.pool)
+    self.assertLess(time.time() - started, shard.SEND_TIMEOUT)
+
+    self.assertIn('is down', ''.join(response))
+    self.assertEqual([shard.BAD_GATEWAY], statuses)
+    self.assertGreaterEqual(time.time() - started, shard.SEND_TIMEOUT)
+
+
+class ShardRouterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testFiletypeKey(self):
+    self.assertEqual('cpp', shard.FiletypeKey({}, Request('cpp')))
+    self.assertEqual(None, shard.FiletypeKey({}, None))
+    self.assertEqual('cs',
+                     shard.FiletypeKey({
+                         'QUERY_STRING': 'subserver=cs'
+                     }, {}))
+
+  def testProjectRoots(self):
+    project = os.path.join(self.directory, 'project')
+    os.makedirs(os.path.join(project, '.git'))
+    os.makedirs(os.path.join(project, 'src', 'deep'))
+    roots = shard.ProjectRoots()
+
+    self.assertEqual(project, roots({}, {
+        'filepath': os.path.join(project, 'src', 'deep', 'a.cc')
+    }))
+    self.assertEqual(project, roots({}, {
+        'filepath': os.path.join(project, 'b.cc')
+    }))
+    self.assertEqual(None, roots({}, {'filepath': '/c.cc'}))
+    self.assertEqual(None, roots({}, {}))
+
+  def testSpreadsKeys(self):
+    router = shard.ShardRouter(3, lambda environ, request: request)
+    self.assertEqual(shard.DEFAULT_SHARD, router.ShardFor({}, None))
+    self.assertEqual([1, 2, 0, 1, 2],
+                     [router.ShardFor({}, key) for key in 'abcde'])
+    self.assertEqual(2, router.ShardFor({}, 'b'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,149 @@
+"""Tests for worker_pool."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from threading import Event, Lock
+from editor_proxy import worker_pool
+
+
+class Item:
+
+  def __init__(self, name, log, lock):
+    self.name = name
+    self.log = log
+    self.lock = lock
+
+  def Run(self):
+    with self.lock:
+      self.log.append(self.name)
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+  def testPriorityForPath(self):
+    self.assertEqual(worker_pool.PRIORITY_INTERACTIVE,
+                     worker_pool.PriorityForPath('/completions'))
+    self.assertEqual(worker_pool.PRIORITY_PARSE,
+                     worker_pool.PriorityForPath('/event_notification'))
+    self.assertEqual(worker_pool.PRIORITY_BACKGROUND,
+                     worker_pool.PriorityForPath('/debug_info'))
+
+  def testQueueOrder(self):
+    q = worker_pool.RequestQueue()
+    q.Put('debug_info', worker_pool.PRIORITY_BACKGROUND)
+    q.Put('parse1', worker_pool.PRIORITY_PARSE)
+    q.Put('complete1', worker_pool.PRIORITY_INTERACTIVE)
+    q.Put('parse2', worker_pool.PRIORITY_PARSE)
+    q.Put('complete2', worker_pool.PRIORITY_INTERACTIVE)
+    self.assertEqual(5, q.Depth())
+    q.Close()
+
+    self.assertSequenceEqual(
+        ['complete1', 'complete2', 'parse1', 'parse2', 'debug_info'],
+        [q.Get() for x in range(5)])
+    self.assertEqual(None, q.Get())
+
+  def testQueueStats(self):
+    q = worker_pool.RequestQueue()
+    q.Put('a', worker_pool.PRIORITY_PARSE)
+    q.Put('b', worker_pool.PRIORITY_PARSE)
+    q.Put('c', worker_pool.PRIORITY_BACKGROUND)
+    q.Get()
+
+    stats = q.Stats()
+    self.assertEqual(2, stats['depth'])
+    self.assertEqual({'parse': 1, 'background': 1}, stats['depth_by_class'])
+    self.assertEqual(1, stats['wait']['parse']['count'])
+    self.assertTrue(stats['wait']['parse']['max'] >= 0)
+
+  def testParsePriority(self):
+    self.assertEqual(worker_pool.PRIORITY_INTERACTIVE,
+                     worker_pool.ParsePriority('interactive'))
+    self.assertEqual(worker_pool.PRIORITY_BACKGROUND,
+                     worker_pool.ParsePriority(' Background '))
+    self.assertEqual(worker_pool.PRIORITY_PARSE,
+                     worker_pool.ParsePriority('1'))
+    self.assertIsNone(worker_pool.ParsePriority('urgent'))
+    self.assertIsNone(worker_pool.ParsePriority(None))
+
+  def testClientsTakeTurns(self):
+    q = worker_pool.RequestQueue()
+    for n in range(3):
+      q.Put('a{}'.format(n), worker_pool.PRIORITY_PARSE, 'a')
+    q.Put('b0', worker_pool.PRIORITY_PARSE, 'b')
+    q.Put('complete', worker_pool.PRIORITY_INTERACTIVE, 'a')
+    self.assertEqual({'a': 4, 'b': 1}, q.Stats()['depth_by_client'])
+
+    self.assertEqual(['complete', 'a0', 'b0'], [q.Get() for x in range(3)])
+    # A client that was idle gets the next turn.
+    q.Put('c0', worker_pool.PRIORITY_PARSE, 'c')
+    q.Put('b1', worker_pool.PRIORITY_PARSE, 'b')
+    q.Close()
+    self.assertEqual(['a1', 'c0', 'b1', 'a2', None],
+                     [q.Get() for x in range(5)])
+
+  def testRemove(self):
+    q = worker_pool.RequestQueue()
+    for name in ('a', 'b', 'c'):
+      q.Put(name, worker_pool.PRIORITY_PARSE)
+    self.assertTrue(q.Remove('b'))
+    self.assertFalse(q.Remove('b'))
+    self.assertEqual(2, q.Depth())
+
+    self.assertEqual('a', q.Get())
+    self.assertFalse(q.Remove('a'))
+    q.Close()
+    self.assertEqual(['c', None], [q.Get() for x in range(2)])
+
+  def testPutAfterClose(self):
+    q = worker_pool.RequestQueue()
+    q.Close()
+    with self.assertRaises(ValueError):
+      q.Put('a', worker_pool.PRIORITY_PARSE)
+
+  def testPoolRunsQueuedItemsByPriority(self):
+    log = []
+    lock = Lock()
+    pool = worker_pool.WorkerPool(1)
+    pool.Submit(Item('debug', log, lock), worker_pool.PRIORITY_BACKGROUND)
+    pool.Submit(Item('parse', log, lock), worker_pool.PRIORITY_PARSE)
+    pool.Submit(Item('complete', log, lock), worker_pool.PRIORITY_INTERACTIVE)
+    pool.Start()
+    pool.Shutdown()
+
+    self.assertSequenceEqual(['complete', 'parse', 'debug'], log)
+    self.assertEqual(0, pool.Stats()['depth'])
+
+  def testPoolSurvivesExceptions(self):
+    done = Event()
+
+    class Failing:
+
+      def Run(self):
+        raise RuntimeError('boom')
+
+    class Signal:
+
+      def Run(self):
+        done.set()
+
+    pool = worker_pool.WorkerPool(1)
+    pool.Start()
+    pool.Submit(Failing(), worker_pool.PRIORITY_INTERACTIVE)
+    pool.Submit(Signal(), worker_pool.PRIORITY_INTERACTIVE)
+    self.assertTrue(done.wait(5))
+    pool.Shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+"""Tests for zygote."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+DIR_OF_CURRENT_SCRIPT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(
+    0, os.path.normpath(os.path.join(DIR_OF_CURRENT_SCRIPT, '..', '..')))
+
+from editor_proxy import zygote
+
+
+def EchoSession(argv):
+  """Echoes stdin to stdout, followed by the session's details."""
+  data = sys.stdin.readline()
+  sys.stdout.write(data)
+  sys.stdout.write(
+      json.dumps({
+          'argv': argv,
+          'cwd': os.getcwd(),
+          'pid': os.getpid()
+      }) + '\n')
+  sys.stdout.flush()
+  if argv == ['--exit']:
+    sys.exit(3)
+  return 4
+
+
+class ZygoteTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'zygote')
+    self.pid = os.fork()
+    if not self.pid:
+      try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        zygote.Zygote(self.path, EchoSession, children=2).Serve()
+      finally:
+        os._exit(0)
+    while not os.path.exists(self.path):
+      time.sleep(0.01)
+
+  def tearDown(self):
+    os.kill(self.pid, signal.SIGTERM)
+    os.waitpid(self.pid, 0)
+    self.assertFalse(os.path.exists(self.path))
+    shutil.rmtree(self.directory)
+
+  def Launch(self, argv, line):
+    """Runs a session with |argv| that reads |line|. Returns its exit code and
+    what it wrote."""
+    (stdin_r, stdin_w) = os.pipe()
+    (stdout_r, stdout_w) = os.pipe()
+    os.write(stdin_w, line)
+    os.close(stdin_w)
+    try:
+      code = zygote.Launch(self.path, argv, (stdin_r, stdout_w, stdout_w))
+    finally:
+      os.close(stdin_r)
+      os.close(stdout_w)
+    with os.fdopen(stdout_r) as output:
+      return code, output.read()
+
+  def testSessionGetsStdioAndArguments(self):
+    (code, output) = self.Launch(['--log', 'debug'], 'hello\n')
+    self.assertEqual(4, code)
+    (line, details) = output.splitlines()
+    self.assertEqual('hello', line)
+    details = json.loads(details)
+    self.assertEqual(['--log', 'debug'], details['argv'])
+    self.assertEqual(os.getcwd(), details['cwd'])
+    self.assertNotIn(details['pid'], (os.getpid(), self.pid))
+
+  def testExitCode(self):
+    (code, _) = self.Launch(['--exit'], '\n')
+    self.assertEqual(3, code)
+
+  def testEachSessionGetsItsOwnChild(self):
+    pids = set()
+    for n in range(5):
+      (_, output) = self.Launch([], '{}\n'.format(n))
+      (line, details) = output.splitlines()
+      self.assertEqual(str(n), line)
+      pids.add(json.loads(details)['pid'])
+    self.assertEqual(5, len(pids))
+
+  def testLaunchWithoutZygote(self):
+    self.assertRaises(socket.error, zygote.Launch,
+                      os.path.join(self.directory, 'missing'), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
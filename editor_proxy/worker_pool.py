@@ -0,0 +1,214 @@
+"""Bounded pool of request handler threads fed by a priority queue.
+
+Requests are classified into priority classes, either explicitly by the client
+or by PATH_INFO. Interactive requests like completions are picked up before
+parse events, which in turn go before everything else. Within a class requests
+are served in arrival order, except that requests from different clients take
+turns, so that a client sending a burst of requests doesn't hold up the others.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+import logging
+import time
+from threading import Condition, Thread
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PARSE = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_PARSE: 'parse',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+DEFAULT_PRIORITIES = {
+    '/completions': PRIORITY_INTERACTIVE,
+    '/filter_and_sort_candidates': PRIORITY_INTERACTIVE,
+    '/signature_help': PRIORITY_INTERACTIVE,
+    '/resolve_completion': PRIORITY_INTERACTIVE,
+    '/detailed_diagnostic': PRIORITY_INTERACTIVE,
+    '/run_completer_command': PRIORITY_INTERACTIVE,
+    '/event_notification': PRIORITY_PARSE,
+    '/semantic_completion_available': PRIORITY_PARSE,
+}
+
+DEFAULT_WORKERS = 4
+
+
+def PriorityForPath(path, priorities=DEFAULT_PRIORITIES):
+  return priorities.get(path, PRIORITY_BACKGROUND)
+
+
+def ParsePriority(value):
+  """Returns the priority class named by |value|, or None if there's none.
+
+  |value| is either a class name such as 'interactive' or its number."""
+  if value is None:
+    return None
+  value = value.strip().lower()
+  for priority, name in PRIORITY_NAMES.items():
+    if value in (name, str(priority)):
+      return priority
+  return None
+
+
+class RequestQueue:
+
+  def __init__(self):
+    self.cond = Condition()
+    self.heap = []
+    self.sequence = 0
+    self.done = False
+    self.waits = {}
+    # Within a class, a client's n-th queued request goes in the n-th round
+    # after the one being served. These are the last round handed out for each
+    # class, and the last round each client has a request queued in.
+    self.served = {}
+    self.rounds = {}
+
+  def Put(self, item, priority, client=None):
+    """Queues |item|. Items from different |client|s of the same priority
+    class take turns."""
+    with self.cond:
+      if self.done:
+        raise ValueError('Queue is closed')
+      last = self.rounds.get((priority, client), 0)
+      turn = max(last, self.served.get(priority, 0)) + 1
+      self.rounds[(priority, client)] = turn
+      heapq.heappush(self.heap, (priority, turn, self.sequence, time.time(),
+                                 client, item))
+      self.sequence += 1
+      self.cond.notify()
+
+  def Get(self):
+    """Returns the most urgent item, or None once the queue is closed."""
+    with self.cond:
+      while len(self.heap) == 0 and not self.done:
+        self.cond.wait()
+
+      if len(self.heap) == 0:
+        return None
+
+      priority, turn, _, queued_at, _, item = heapq.heappop(self.heap)
+      self.served[priority] = turn
+      if not self.heap:
+        # Rounds are only relative to the requests that are queued.
+        self.served.clear()
+        self.rounds.clear()
+      self._RecordWait(priority, time.time() - queued_at)
+    return item
+
+  def Remove(self, item):
+    """Takes |item| out of the queue. Returns False if it isn't queued, for
+    instance because it has been handed out already."""
+    with self.cond:
+      for (index, entry) in enumerate(self.heap):
+        if entry[-1] is item:
+          break
+      else:
+        return False
+
+      self.heap[index] = self.heap[-1]
+      self.heap.pop()
+      heapq.heapify(self.heap)
+      if not self.heap:
+        self.served.clear()
+        self.rounds.clear()
+      return True
+
+  def Close(self):
+    """Wakes up all consumers once the remaining items have been handed out."""
+    with self.cond:
+      self.done = True
+      self.cond.notify_all()
+
+  def Depth(self):
+    with self.cond:
+      return len(self.heap)
+
+  def _RecordWait(self, priority, waited):
+    name = PRIORITY_NAMES.get(priority, str(priority))
+    stats = self.waits.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+    stats['count'] += 1
+    stats['total'] += waited
+    stats['max'] = max(stats['max'], waited)
+
+  def Stats(self):
+    with self.cond:
+      depths = {}
+      clients = {}
+      for (priority, _, _, _, client, _) in self.heap:
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        depths[name] = depths.get(name, 0) + 1
+        if client is not None:
+          clients[client] = clients.get(client, 0) + 1
+      waits = {}
+      for name, stats in self.waits.items():
+        waits[name] = dict(stats)
+        waits[name]['mean'] = stats['total'] / stats['count']
+      return {
+          'depth': len(self.heap),
+          'depth_by_class': depths,
+          'depth_by_client': clients,
+          'wait': waits
+      }
+
+
+class Worker(Thread):
+
+  def __init__(self, queue):
+    super(Worker, self).__init__()
+    self.daemon = True
+    self.queue = queue
+
+  def run(self):
+    while True:
+      item = self.queue.Get()
+      if item is None:
+        return
+      try:
+        item.Run()
+      except Exception:
+        logging.exception('Unhandled exception in worker')
+
+
+class WorkerPool:
+  """Runs submitted items on a fixed number of reusable threads.
+
+  Items are objects with a Run() method.
+  """
+
+  def __init__(self, size=DEFAULT_WORKERS):
+    assert size > 0
+    self.size = size
+    self.queue = RequestQueue()
+    self.workers = []
+
+  def Start(self):
+    for x in range(self.size):
+      worker = Worker(self.queue)
+      worker.start()
+      self.workers.append(worker)
+
+  def Submit(self, item, priority, client=None):
+    self.queue.Put(item, priority, client)
+
+  def Remove(self, item):
+    """Drops |item| unless a worker has picked it up already. Returns True if it
+    was dropped."""
+    return self.queue.Remove(item)
+
+  def Shutdown(self, timeout=None):
+    self.queue.Close()
+    for worker in self.workers:
+      worker.join(timeout)
+
+  def Stats(self):
+    stats = self.queue.Stats()
+    stats['workers'] = self.size
+    return stats
@@ -0,0 +1,222 @@
+"""Forks proxies for sessions from a process that has loaded ycmd already.
+
+Most of the time it takes the proxy to start goes into importing ycmd and
+preloading the global extra conf. A Zygote does that once and then keeps a
+number of forks of itself waiting for sessions on a Unix socket. Launch() hands
+the stdin, stdout and stderr of a session to one of them along with the
+session's command line, and returns the exit code of the session once it's
+over. The zygote replaces every child that takes a session, so that the next
+session finds one waiting as well.
+
+Everything that's read before the fork, such as the global extra conf, comes
+from the zygote's own options. Options that only matter later, including the
+user options in --options_file, are applied by the child after the fork. The
+child runs in the working directory of the launcher, but keeps the environment
+of the zygote.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+
+from .handover import (Connect, HandOver, Listen, ReadMessage, SetCloseOnExec,
+                       TakeOver, WriteMessage)
+
+DEFAULT_CHILDREN = 2
+
+STDIO_FDS = (0, 1, 2)
+
+# How often the zygote looks for children that exited, in seconds.
+REAP_INTERVAL = 1.0
+
+
+def ExitCode(code):
+  """Returns the status a process exits with for sys.exit(|code|)."""
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  return 1
+
+
+class Zygote:
+  """Serves sessions on the Unix socket |path| with forks of this process.
+
+  Each session is run in a child by calling |session| with the command line
+  arguments the session was launched with. |session| returns the exit code of
+  the session, or raises SystemExit. |children| children are kept waiting for
+  sessions at all times."""
+
+  def __init__(self, path, session, children=DEFAULT_CHILDREN):
+    self.path = path
+    self.session = session
+    self.children = children
+    self.pid = os.getpid()
+    self.waiting = set()
+    self.listener = None
+    # Children write their pid to |taken_w| once they took a session.
+    self.taken_r = None
+    self.taken_w = None
+    # Only the zygote holds |alive_w|. Children see |alive_r| become readable
+    # once the zygote is gone.
+    self.alive_r = None
+    self.alive_w = None
+
+  def Serve(self):
+    """Serves sessions until the zygote is interrupted.
+
+    Only returns, or raises, in the zygote. Children exit once their session
+    is over."""
+    self.taken_r, self.taken_w = os.pipe()
+    self.alive_r, self.alive_w = os.pipe()
+    # The finally clause below removes the socket, so it starts right after
+    # the socket is created. Even a SIGTERM must not leave it behind.
+    self.listener = Listen(self.path)
+    try:
+      self.listener.setblocking(0)
+      logging.info('Zygote serving sessions on %s', self.path)
+      while True:
+        self._Reap()
+        while len(self.waiting) < self.children:
+          self._Fork()
+        try:
+          readable = select.select([self.taken_r], [], [], REAP_INTERVAL)[0]
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          continue
+        if readable:
+          for pid in os.read(self.taken_r, 4096).split():
+            logging.info('Session handed to %s', pid)
+            self.waiting.discard(int(pid))
+    finally:
+      if os.getpid() == self.pid:
+        self.listener.close()
+        os.unlink(self.path)
+        for fd in (self.taken_r, self.taken_w, self.alive_r, self.alive_w):
+          os.close(fd)
+
+  def _Reap(self):
+    while True:
+      try:
+        (pid, _) = os.waitpid(-1, os.WNOHANG)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.ECHILD:
+          return
+        raise
+      if not pid:
+        return
+      self.waiting.discard(pid)
+
+  def _Fork(self):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+      self.waiting.add(pid)
+      return
+
+    # In the child. Nothing may propagate into the zygote's code until a
+    # session was taken.
+    try:
+      os.close(self.alive_w)
+      connection = self._Accept()
+      os.write(self.taken_w, '{}\n'.format(os.getpid()))
+      self.listener.close()
+      for fd in (self.taken_r, self.taken_w, self.alive_r):
+        os.close(fd)
+    except SystemExit:
+      os._exit(0)
+    except BaseException:
+      logging.exception('Zygote child failed')
+      os._exit(1)
+    sys.exit(self._RunSession(connection))
+
+  def _Accept(self):
+    """Waits for a session. Exits if the zygote goes away first."""
+    while True:
+      try:
+        readable = select.select([self.listener, self.alive_r], [], [])[0]
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+        continue
+      if self.alive_r in readable:
+        os._exit(0)
+      try:
+        (connection, _) = self.listener.accept()
+      except socket.error as e:
+        # Another child was quicker.
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          continue
+        raise
+      connection.setblocking(1)
+      SetCloseOnExec(connection.fileno())
+      return connection
+
+  def _RunSession(self, connection):
+    (fds, request) = TakeOver(connection, len(STDIO_FDS))
+    for (fd, target) in zip(fds, STDIO_FDS):
+      if fd != target:
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    WriteMessage(connection, {'pid': os.getpid()})
+
+    code = 1
+    try:
+      code = ExitCode(self.session(request['argv']))
+    except SystemExit as e:
+      code = ExitCode(e.code)
+    except Exception:
+      logging.exception('Session failed')
+    finally:
+      try:
+        WriteMessage(connection, {'exit_code': code})
+      except socket.error:
+        pass
+    return code
+
+
+def Launch(path, argv, fds=STDIO_FDS):
+  """Runs a session with the command line |argv| in the zygote at |path|.
+
+  |fds| are handed to the session as its stdin, stdout and stderr. Returns the
+  exit code of the session. Raises socket.error if no zygote listens at
+  |path|. SIGTERM and SIGINT are forwarded to the session while it runs."""
+  connection = Connect(path)
+
+  handlers = {}
+  try:
+    reader = HandOver(connection, fds, {'argv': argv, 'cwd': os.getcwd()})
+    reply = ReadMessage(reader)
+    if reply is None:
+      return 1
+    pid = reply['pid']
+
+    def Forward(signum, frame):
+      os.kill(pid, signum)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+      handlers[sig] = signal.signal(sig, Forward)
+    reply = ReadMessage(reader)
+    if reply is None:
+      return 1
+    return reply['exit_code']
+  except socket.error:
+    logging.exception('Lost the connection to the zygote')
+    return 1
+  finally:
+    for (sig, handler) in handlers.items():
+      signal.signal(sig, handler)
+    connection.close()